@@ -0,0 +1,245 @@
+import asyncio
+import datetime
+import logging
+import os
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from rollover import ARCHIVE_SCHEMA
+from week_calendar import week_start
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# پوشه فایل‌های تحلیلی (Parquet)؛ در صورت خالی بودن، تهیه فایل‌های تحلیلی غیرفعال است.
+# بسته pyarrow وابستگی اختیاری است و با extra به نام analytics نصب می‌شود (pip install ".[analytics]")
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR", "")
+
+# تعداد سطرهایی که در هر دسته از cursor سمت سرور خوانده و در فایل نوشته می‌شود
+BATCH_SIZE = 10000
+
+# تعداد آخرین هفته‌های بسته شده که در هر اجرا دوباره نوشته می‌شوند تا نوشتن‌های دیرهنگام
+# (اعمال دفتر نوشتن‌ها پس از قطع دیتابیس و تحویل‌های ثبت شده پس از پایان هفته) در فایل بیایند
+REWRITE_WEEKS = 1
+
+# ساعت اجرای روزانه (پس از تغییر روزانه رزروها و خارج از زمان شلوغی)
+RUN_AT = datetime.time(3, 0)
+
+# ستون‌های فایل رزروهای هر هفته
+RESERVATION_COLUMNS = [
+    "id", "reservation_date", "day", "meal_type", "dish_id", "student_id",
+    "is_delivered", "delivery_time", "reservation_time",
+]
+
+
+def _reservation_schema(pa):
+    return pa.schema([
+        ("id", pa.int64()),
+        ("reservation_date", pa.date32()),
+        ("day", pa.string()),
+        ("meal_type", pa.string()),
+        ("dish_id", pa.int32()),
+        ("student_id", pa.int32()),
+        ("is_delivered", pa.bool_()),
+        ("delivery_time", pa.timestamp("us")),
+        ("reservation_time", pa.timestamp("us")),
+    ])
+
+def _student_schema(pa):
+    # شناسه تلگرام و شماره تلفن در فایل‌های تحلیلی ذخیره نمی‌شوند
+    return pa.schema([
+        ("id", pa.int32()),
+        ("feeding_code", pa.string()),
+        ("registration_date", pa.timestamp("us")),
+    ])
+
+def _dish_schema(pa):
+    return pa.schema([
+        ("id", pa.int32()),
+        ("name", pa.string()),
+    ])
+
+
+def _week_tables(connection):
+    """جدول رزروهای هر هفته (هفته ← جدول) از پارتیشن‌های فعلی و بایگانی شده"""
+    tables = {}
+    partitions = connection.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'reservations'
+    """)).scalars().all()
+    archived = connection.execute(text("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = :schema AND column_name = 'dish_id' AND table_name LIKE 'reservations_w%'
+    """), {"schema": ARCHIVE_SCHEMA}).scalars().all()
+    for name in sorted(archived):
+        week = _partition_week(name)
+        if week is not None:
+            tables[week] = f"{ARCHIVE_SCHEMA}.{name}"
+    for name in sorted(partitions):
+        week = _partition_week(name)
+        if week is not None:
+            tables[week] = name
+    return tables
+
+def _partition_week(name):
+    try:
+        return datetime.datetime.strptime(name, "reservations_w%Y%m%d").date()
+    except ValueError:
+        # نسخه‌های پشتیبان حذف رزروها (reservations_w..._cleared_...) در فایل‌های تحلیلی نیستند
+        return None
+
+
+class AnalyticsSnapshots:
+    """تهیه فایل‌های ستونی (Parquet) از رزروهای هفته‌های بسته شده برای تحلیل
+
+    رزروهای هر هفته‌ای که تمام شده در reservations/week_start=YYYY-MM-DD/ نوشته می‌شوند (پارتیشن‌بندی
+    hive که pyarrow و pandas و duckdb مستقیماً می‌خوانند). REWRITE_WEEKS هفته آخر در هر اجرا دوباره
+    نوشته می‌شوند و فایل هفته‌های قدیمی‌تر فقط در صورت تفاوت تعداد سطرها با دیتابیس بازنویسی می‌شود.
+    جدول‌های کوچک دانشجویان و غذاها در هر اجرا کامل بازنویسی می‌شوند. فقط پردازش رهبر آن را اجرا می‌کند.
+    سطرها با cursor سمت سرور دسته‌دسته خوانده و نوشته می‌شوند و فایل‌ها با تغییر نام اتمیک جایگزین
+    می‌شوند تا خواننده‌ها هیچ‌گاه فایل نیمه‌کاره نبینند. pyarrow وابستگی اختیاری است.
+    """
+
+    def __init__(self, directory=ANALYTICS_DIR):
+        self.directory = directory
+        self._Session = None
+        self._task = None
+
+        # متریک‌ها
+        self.runs_total = 0
+        self.weeks_written_total = 0
+        self.rows_written_total = 0
+        self.last_run = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _week_path(self, week):
+        return os.path.join(self.directory, "reservations", f"week_start={week.isoformat()}", "part-0.parquet")
+
+    def _is_current(self, connection, week, table):
+        """آیا فایل هفته week وجود دارد و تعداد سطرهای آن با دیتابیس یکی است"""
+        import pyarrow.parquet as pq
+
+        path = self._week_path(week)
+        if not os.path.exists(path):
+            return False
+        rows = connection.execute(
+            text(f"SELECT COUNT(*) FROM {table} WHERE week_start = :week"), {"week": week}
+        ).scalar()
+        return pq.ParquetFile(path).metadata.num_rows == rows
+
+    def _write(self, connection, path, schema, query, params=None):
+        """نوشتن نتیجه query در فایل Parquet به صورت دسته‌ای؛ تعداد سطرها برگردانده می‌شود"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        rows = 0
+        result = connection.execution_options(stream_results=True, max_row_buffer=BATCH_SIZE).execute(
+            text(query), params or {}
+        )
+        try:
+            with pq.ParquetWriter(temporary, schema, compression="zstd") as writer:
+                for partition in result.partitions(BATCH_SIZE):
+                    columns = list(zip(*partition))
+                    writer.write_batch(pa.RecordBatch.from_arrays(
+                        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                        schema=schema
+                    ))
+                    rows += len(partition)
+            os.replace(temporary, path)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return rows
+
+    def run_once(self, today=None):
+        import pyarrow as pa
+
+        today = today or datetime.date.today()
+        current_week = week_start(today)
+        rewrite_from = current_week - datetime.timedelta(days=7 * REWRITE_WEEKS)
+        session = self._Session()
+        try:
+            connection = session.connection()
+            written = 0
+            for week, table in sorted(_week_tables(connection).items()):
+                # فقط هفته‌های تمام شده
+                if week >= current_week:
+                    continue
+                if week < rewrite_from and self._is_current(connection, week, table):
+                    continue
+                rows = self._write(
+                    connection,
+                    self._week_path(week),
+                    _reservation_schema(pa),
+                    f"SELECT {', '.join(RESERVATION_COLUMNS)} FROM {table} WHERE week_start = :week ORDER BY id",
+                    {"week": week}
+                )
+                written += 1
+                self.rows_written_total += rows
+                logger.info(f"فایل تحلیلی رزروهای هفته {week} نوشته شد ({rows} سطر)")
+
+            self._write(
+                connection,
+                os.path.join(self.directory, "students.parquet"),
+                _student_schema(pa),
+                "SELECT id, feeding_code, registration_date FROM students ORDER BY id"
+            )
+            self._write(
+                connection,
+                os.path.join(self.directory, "dishes.parquet"),
+                _dish_schema(pa),
+                "SELECT id, name FROM dishes ORDER BY id"
+            )
+        finally:
+            session.close()
+        self.weeks_written_total += written
+        self.runs_total += 1
+        self.last_run = datetime.datetime.now().timestamp()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"خطا در تهیه فایل‌های تحلیلی: {e}")
+            now = datetime.datetime.now()
+            next_run = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), RUN_AT)
+            await asyncio.sleep((next_run - now).total_seconds())
+
+    async def start(self, engine):
+        if not self.enabled:
+            return
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.error('برای تهیه فایل‌های تحلیلی (ANALYTICS_DIR) بسته pyarrow باید نصب باشد (pip install ".[analytics]")')
+            return
+        self._Session = sessionmaker(bind=engine)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self):
+        return {
+            "enabled": int(self.enabled),
+            "runs_total": self.runs_total,
+            "weeks_written_total": self.weeks_written_total,
+            "rows_written_total": self.rows_written_total,
+            "last_run_timestamp": self.last_run,
+        }
+
+
+analytics_snapshots = AnalyticsSnapshots()
+register_collector("analytics", analytics_snapshots.metrics)
@@ -0,0 +1,142 @@
+"""مقایسه مصرف CPU در حالت بیکار، تعداد threadها و تاخیر درخواست‌های HTTP بین دو روش اجرای سرور
+
+نمونه اجرا (نسخه قدیمی Flask از تاریخچه git در پوشه‌ای جداگانه باز شده است):
+
+    git worktree add /tmp/legacy <commit-before-aiohttp>
+    python benchmark_server.py \
+        --baseline "cd /tmp/legacy && python main.py" \
+        --candidate "python main.py" \
+        --url http://127.0.0.1:8080/metrics
+
+فقط روی لینوکس کار می‌کند (از /proc برای خواندن مصرف CPU استفاده می‌شود).
+"""
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def _process_tree(pid):
+    """شناسه پردازش و تمام فرزندان آن (gunicorn و shardها پردازش فرزند می‌سازند)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def _cpu_seconds(pid):
+    total = 0
+    for current in _process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except OSError:
+            pass
+    return total / CLOCK_TICKS
+
+
+def _threads(pid):
+    total = 0
+    for current in _process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def _wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def _request(url):
+    started = time.perf_counter()
+    urllib.request.urlopen(url, timeout=10).read()
+    return time.perf_counter() - started
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(command, url, idle_seconds, requests, concurrency, startup_timeout):
+    process = subprocess.Popen(command, shell=True, start_new_session=True)
+    try:
+        if not _wait_ready(url, startup_timeout):
+            raise RuntimeError(f"سرور در {startup_timeout} ثانیه آماده نشد: {command}")
+
+        # مصرف CPU در حالت بیکار (بدون درخواست)
+        time.sleep(2)
+        cpu_before = _cpu_seconds(process.pid)
+        time.sleep(idle_seconds)
+        idle_cpu = (_cpu_seconds(process.pid) - cpu_before) / idle_seconds * 100
+        threads = _threads(process.pid)
+
+        # تاخیر درخواست‌ها با چند درخواست هم‌زمان
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            started = time.perf_counter()
+            latencies = list(pool.map(lambda _: _request(url), range(requests)))
+            elapsed = time.perf_counter() - started
+
+        return {
+            "idle_cpu_percent": idle_cpu,
+            "threads": threads,
+            "requests_per_second": requests / elapsed,
+            "latency_ms_p50": statistics.median(latencies) * 1000,
+            "latency_ms_p95": _percentile(latencies, 0.95) * 1000,
+            "latency_ms_p99": _percentile(latencies, 0.99) * 1000,
+        }
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", required=True, help="دستور اجرای روش قدیمی")
+    parser.add_argument("--candidate", required=True, help="دستور اجرای روش جدید")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/metrics")
+    parser.add_argument("--idle-seconds", type=float, default=30)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    results = {}
+    for name, command in (("baseline", args.baseline), ("candidate", args.candidate)):
+        print(f"اندازه‌گیری {name}: {command}")
+        results[name] = measure(command, args.url, args.idle_seconds, args.requests,
+                                args.concurrency, args.startup_timeout)
+
+    print(f"\n{'metric':<22}{'baseline':>12}{'candidate':>12}")
+    for metric in results["baseline"]:
+        print(f"{metric:<22}{results['baseline'][metric]:>12.2f}{results['candidate'][metric]:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,12 @@ from dotenv import load_dotenv
 from jdatetime import date as JalaliDate
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
-import nest_asyncio
 from models import init_db, Student, Reservation, Menu, DatabaseBackup, load_default_menu, migrate_from_json_to_db
 from sqlalchemy import text
 
 # بارگذاری متغیرهای محیطی از فایل .env
 load_dotenv()
 
-# فعال کردن nest_asyncio برای اجازه دادن به حلقه‌های رویداد تودرتو
-nest_asyncio.apply()
-
 # فعال کردن لاگ
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -3,20 +3,41 @@ import logging
 import json
 import os
 import datetime
+from collections import OrderedDict
 from dotenv import load_dotenv
 from jdatetime import date as JalaliDate
-from telegram.ext import Application, CallbackContext, CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, filters
+from telegram.ext import Application, CallbackContext, CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, TypeHandler, filters
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, BotCommand
-import nest_asyncio
-from models import init_db, Student, Reservation, Menu, DatabaseBackup, load_default_menu, migrate_from_json_to_db
+from models import init_db, Student, Reservation, DatabaseBackup, load_default_menu, migrate_from_json_to_db
 from sqlalchemy import text
+from send_queue import send_queue, PRIORITY_INTERACTIVE
+from sms import sms_worker, transport_from_env
+from capacity import capacity_manager
+from kitchen import kitchen_counters
+from dishes import dish_catalog
+from menu_store import menu_store
+from reservation_pipeline import reservation_pipeline, RESULT_SOLD_OUT, ENABLED as RESERVATION_COALESCING
+from dedupe import callback_deduplicator, single_flight
+from render_cache import edit_message_text
+from persistence import create_persistence
+from callback_router import callback_router, ChoiceField, IntField, DateField
+from reservation_clear import start_clear, stop_clear
+from export import export_reservations, FORMATS, FORMAT_CSV
+from broadcast import start_broadcast, resume_broadcasts, stop_broadcasts, tomorrow, KIND_MENU_CHANGE, KIND_REMINDER
+from state_sweeper import state_sweeper, STATE_TTL
+from leader import create_leader_elector
+from sharding import create_shard_pool, read_updates, SHARD_WORKERS
+from db_routing import create_session_router
+from circuit_breaker import db_breaker, is_db_unavailable
+from write_journal import write_journal, KIND_RESERVE, KIND_DELIVER
+from week_calendar import upcoming_date, jalali_label, jalali_calendar, weekday_name, CACHE_PAST_DAYS
+from rollover import weekly_rollover
+from analytics import analytics_snapshots
+from metrics import register_collector
 
 # بارگذاری متغیرهای محیطی از فایل .env
 load_dotenv()
 
-# فعال کردن nest_asyncio برای اجازه دادن به حلقه‌های رویداد تودرتو
-nest_asyncio.apply()
-
 # فعال کردن لاگ
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -54,43 +75,216 @@ EDIT_MENU_DAY = 1
 EDIT_MENU_MEAL = 2
 EDIT_MENU_FOOD = 3
 DATABASE_BACKUP_DESC = 4
+EDIT_MEAL_CAPACITY = 5
 
 # ایجاد اتصال به دیتابیس
 db_session = init_db()
 
+# نشست‌های جداگانه برای خواندن‌هایی که در thread جداگانه اجرا می‌شوند (از replica در صورت تنظیم REPLICA_DATABASE_URL)
+session_router = create_session_router(db_session.get_bind())
+
+# در صورت قطع دیتابیس، کوئری‌های نشست‌های دیتابیس اصلی بدون انتظار رد می‌شوند و ربات در حالت فقط‌خواندنی از کش‌ها پاسخ می‌دهد
+db_breaker.attach(db_session.get_bind(), db_session, session_router.PrimarySession)
+
 # بارگذاری منوی پیش‌فرض به دیتابیس
 load_default_menu(db_session)
 
 # مهاجرت داده‌ها از فایل JSON به دیتابیس (اگر فایل وجود داشته باشد)
 migrate_from_json_to_db(RESERVATION_FILE, db_session)
 
-# دیکشنری موقت برای کش کردن کد تغذیه‌ها (شناسه کاربری به کد تغذیه)
+# نگاشت شناسه غذاها به نام آن‌ها برای نمایش منو و رزروها
+dish_catalog.attach(db_session.get_bind())
+
+# دیکشنری موقت برای کش کردن کد تغذیه‌ها (شناسه عددی کاربر تلگرام به کد تغذیه)
 students = {}
 
+# آخرین رزروهای خوانده شده هر کاربر برای نمایش در زمان قطع دیتابیس (فقط کاربرانی که اخیراً رزروهای خود را دیده‌اند)
+RESERVATION_VIEWS_MAX = 5000
+reservation_views = OrderedDict()
+register_collector("reservation_views", lambda: {"entries": len(reservation_views)})
+
+# پیام تغییر منو بین نمایش منو و انتخاب وعده
+MENU_CHANGED_NOTICE = "\U000026A0 منوی این روز تغییر کرده است؛ لطفاً منوی جدید را بررسی و دوباره انتخاب کنید.\n\n"
+
+# سابقه رزروها: بازه روزهای گذشته (در محدوده کش تقویم شمسی) و حداکثر تعداد وعده‌های نمایش داده شده
+HISTORY_DAYS = CACHE_PAST_DAYS
+HISTORY_LIMIT = 30
+
+# داشبورد آشپزخانه: فاصله به‌روزرسانی خودکار و مدت نمایش زنده (ثانیه)
+KITCHEN_REFRESH_INTERVAL = 15
+KITCHEN_LIVE_SECONDS = 2 * 60 * 60
+
+# به‌روزرسانی زنده داشبورد آشپزخانه (شناسه چت ← task)
+kitchen_live = {}
+
+# چت‌هایی که خروجی رزروهای آن‌ها در حال آماده شدن است (هر چت یک خروجی در هر لحظه)
+exports_running = set()
+
+# پیام حالت فقط‌خواندنی
+DB_UNAVAILABLE_MESSAGE = (
+    "\U000026A0 ارتباط با دیتابیس موقتاً برقرار نیست.\n\n"
+    "مشاهده منو و راهنما امکان‌پذیر است، اما ثبت و تغییر اطلاعات تا چند دقیقه دیگر ممکن نیست. "
+    "لطفاً کمی بعد دوباره تلاش کنید."
+)
+
 # بارگذاری دانشجویان از دیتابیس به کش
 def load_students_to_cache():
     all_students = db_session.query(Student).all()
     for student in all_students:
-        students[student.user_id] = student.feeding_code
+        # دانشجویان وارد شده از فایل JSON تا زمان ثبت کد تغذیه شناسه کاربری ندارند
+        if student.user_id is not None:
+            students[student.user_id] = student.feeding_code
 
 # بارگذاری دانشجویان به کش در شروع کار
 load_students_to_cache()
 
-# بارگذاری منوی غذا از دیتابیس
-def get_menu_data():
-    menu_items = db_session.query(Menu).all()
-    menu_data = {}
-    for item in menu_items:
-        menu_data[item.day] = item.meal_data
-    return menu_data
+# بارگذاری منوی غذا از دیتابیس (روز ← وعده ← شناسه غذا)
+menu_store.load(db_session)
+
+# هم‌خوان کردن شمارنده‌های ظرفیت وعده‌ها با رزروهای موجود
+capacity_manager.reconcile(db_session)
 
-# دریافت منوی غذا
-menu_data = get_menu_data()
+# دریافت رزروهای یک روز به همراه کد تغذیه دانشجو (در thread جداگانه اجرا می‌شود)
+def load_day_roster(selected_day, user_id=None):
+    session = session_router.read_session(user_id)
+    try:
+        rows = session.query(
+            Reservation.id, Reservation.meal_type, Reservation.dish_id, Reservation.is_delivered, Student.feeding_code
+        ).join(Student, Reservation.student_id == Student.id).filter(
+            Reservation.on_date(upcoming_date(selected_day))
+        ).order_by(Reservation.id).all()
+        return [
+            {
+                "id": reservation_id,
+                "meal_type": meal_type,
+                "feeding_code": feeding_code,
+                "dish_id": dish_id,
+                "is_delivered": is_delivered
+            }
+            for reservation_id, meal_type, dish_id, is_delivered, feeding_code in rows
+        ]
+    finally:
+        session.close()
+
+# دریافت رزروهای یک دانشجو؛ اگر دانشجو پیدا نشود None برمی‌گرداند (در thread جداگانه اجرا می‌شود)
+def load_student_reservations(feeding_code, user_id=None):
+    session = session_router.read_session(user_id)
+    try:
+        student_id = session.query(Student.id).filter_by(feeding_code=feeding_code).scalar()
+        if student_id is None:
+            return None
+        return session.query(
+            Reservation.day, Reservation.reservation_date, Reservation.meal_type, Reservation.dish_id, Reservation.is_delivered
+        ).filter(
+            Reservation.student_id == student_id, Reservation.upcoming()
+        ).order_by(Reservation.reservation_date, Reservation.id).all()
+    finally:
+        session.close()
+
+# دریافت رزروهای گذشته دانشجو در بازه HISTORY_DAYS روز اخیر (در thread جداگانه اجرا می‌شود)
+def load_reservation_history(feeding_code, user_id=None):
+    today = datetime.date.today()
+    session = session_router.read_session(user_id)
+    try:
+        student_id = session.query(Student.id).filter_by(feeding_code=feeding_code).scalar()
+        if student_id is None:
+            return []
+        return session.query(
+            Reservation.day, Reservation.reservation_date, Reservation.meal_type, Reservation.dish_id, Reservation.is_delivered
+        ).filter(
+            Reservation.student_id == student_id,
+            Reservation.between(today - datetime.timedelta(days=HISTORY_DAYS), today - datetime.timedelta(days=1))
+        ).order_by(Reservation.reservation_date.desc(), Reservation.id).limit(HISTORY_LIMIT).all()
+    finally:
+        session.close()
+
+# متن رزروها گروه‌بندی شده بر اساس تاریخ (ترتیب رزروها حفظ می‌شود)
+def format_reservations_by_date(reservations):
+    reservations_by_date = {}
+    for reservation in reservations:
+        reservations_by_date.setdefault(reservation.reservation_date, []).append(reservation)
+    
+    message = ""
+    for reservation_date, date_reservations in reservations_by_date.items():
+        persian_day = persian_days.get(weekday_name(reservation_date))
+        message += f"<b>\U0001F4C6 روز {persian_day} ({jalali_label(reservation_date)}):</b>\n"
+        for reservation in date_reservations:
+            persian_meal = persian_meals.get(reservation.meal_type, reservation.meal_type)
+            status = "\U00002705 تحویل شده" if reservation.is_delivered else "\U0001F551 در انتظار تحویل"
+            message += f"  \U0001F374 {persian_meal}: {dish_catalog.name(reservation.dish_id)} - {status}\n"
+        message += "\n"
+    return message
+
+# دریافت شمارنده‌های آشپزخانه برای چند تاریخ (در thread جداگانه اجرا می‌شود)
+def load_kitchen_counters(dates, user_id=None):
+    session = session_router.read_session(user_id)
+    try:
+        return {reservation_date: kitchen_counters.on_date(session, reservation_date) for reservation_date in dates}
+    finally:
+        session.close()
+
+# متن داشبورد آشپزخانه: تعداد رزرو، تحویل شده و باقی‌مانده هر وعده
+def format_kitchen_dashboard(counters):
+    message = "<b>\U0001F373 داشبورد آشپزخانه:</b>\n\n"
+    for reservation_date, meals in counters.items():
+        persian_day = persian_days.get(weekday_name(reservation_date))
+        message += f"<b>\U0001F4C6 روز {persian_day} ({jalali_label(reservation_date)}):</b>\n"
+        for meal_type, persian_meal in persian_meals.items():
+            reserved, delivered = meals.get(meal_type, (0, 0))
+            message += (
+                f"  \U0001F374 {persian_meal}: {reserved} رزرو، "
+                f"{delivered} تحویل شده، {reserved - delivered} باقی‌مانده\n"
+            )
+        message += "\n"
+    message += f"\U0001F551 آخرین به‌روزرسانی: {datetime.datetime.now().strftime('%H:%M:%S')}"
+    return message
+
+# تهیه فایل خروجی رزروهای یک بازه تاریخ (در thread جداگانه اجرا می‌شود)
+def load_reservations_export(start, end, fmt, user_id=None):
+    session = session_router.read_session(user_id)
+    try:
+        return export_reservations(session, start, end, fmt)
+    finally:
+        session.close()
+
+# تبدیل تاریخ ورودی مدیر (شمسی مانند 1403/07/01 یا میلادی مانند 2024-09-22) به تاریخ میلادی
+def parse_export_date(token):
+    year, month, day = (int(part) for part in token.replace("-", "/").split("/"))
+    if year < 1700:
+        return JalaliDate(year, month, day).togregorian()
+    return datetime.date(year, month, day)
+
+# دریافت تعداد کل کاربران و آخرین کاربران ثبت‌نام شده (در thread جداگانه اجرا می‌شود)
+def load_users_summary(user_id=None, limit=10):
+    session = session_router.read_session(user_id)
+    try:
+        total_users = session.query(Student).count()
+        latest_users = session.query(
+            Student.feeding_code, Student.user_id, Student.registration_date
+        ).order_by(Student.registration_date.desc()).limit(limit).all()
+        return total_users, latest_users
+    finally:
+        session.close()
 
 # بررسی اینکه آیا کاربر مدیر است یا خیر
 def is_owner(chat_id):
     return chat_id in OWNER_CHAT_IDS
 
+# بازنشانی نشست مشترک پس از خطای اتصال به دیتابیس
+def reset_db_session():
+    try:
+        db_session.rollback()
+    except Exception:
+        pass
+
+# ارسال رسید تحویل به صورت پیامک در پس‌زمینه
+def send_delivery_receipt(reservation):
+    sms_worker.enqueue(
+        f"غذای {persian_meals.get(reservation['meal_type'], reservation['meal_type'])} روز "
+        f"{persian_days.get(reservation['day'], reservation['day'])} ({reservation['food']}) به شما تحویل داده شد.",
+        student_id=reservation['student_id']
+    )
+
 # تابع‌های پردازش دستورها
 async def start(update: Update, context: CallbackContext) -> None:
     """شروع کار با ربات و نمایش منوی اصلی"""
@@ -134,7 +328,7 @@ async def main_menu(update: Update, context: CallbackContext) -> None:
     if update.message:
         await update.message.reply_text(welcome_message, reply_markup=reply_markup)
     elif update.callback_query:
-        await update.callback_query.edit_message_text(welcome_message, reply_markup=reply_markup)
+        await edit_message_text(update.callback_query, welcome_message, reply_markup=reply_markup)
 
 async def help_command(update: Update, context: CallbackContext) -> None:
     """نمایش اطلاعات راهنما"""
@@ -154,7 +348,7 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(help_text, parse_mode="HTML", reply_markup=reply_markup)
     elif update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(help_text, parse_mode="HTML", reply_markup=reply_markup)
+        await edit_message_text(update.callback_query, help_text, parse_mode="HTML", reply_markup=reply_markup)
 
 async def register_command(update: Update, context: CallbackContext) -> int:
     """شروع فرآیند ثبت کد تغذیه"""
@@ -168,14 +362,14 @@ async def process_feeding_code(update: Update, context: CallbackContext) -> int:
     code = update.message.text.strip()
     
     if code.isdigit():
-        user_id = str(update.effective_user.id)
+        user_id = update.effective_user.id
         
         try:
             # بررسی اینکه آیا دانشجو قبلاً در دیتابیس وجود دارد
             student = db_session.query(Student).filter_by(user_id=user_id).first()
             
             # بررسی اینکه آیا کد تغذیه توسط کاربر دیگری استفاده شده‌است
-            existing_code = db_session.query(Student).filter(Student.feeding_code == code, Student.user_id != user_id).first()
+            existing_code = db_session.query(Student).filter(Student.feeding_code == code, Student.user_id.isnot(None), Student.user_id != user_id).first()
             if existing_code:
                 await update.message.reply_text(
                     f"\U0001F6AB این کد تغذیه قبلاً توسط کاربر دیگری ثبت شده است. لطفاً کد دیگری وارد کنید."
@@ -205,6 +399,7 @@ async def process_feeding_code(update: Update, context: CallbackContext) -> int:
             
             # به‌روزرسانی کش
             students[user_id] = code
+            session_router.mark_write(user_id)
             
             await update.message.reply_text(
                 f"\U00002705 کد تغذیه شما ({code}) با موفقیت ثبت شد!\n"
@@ -240,17 +435,21 @@ async def cancel(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 async def view_menu(update: Update, context: CallbackContext) -> None:
-    """نمایش منوی هفتگی با دکمه‌های انتخاب روز"""
+    """نمایش منوی هفتگی با دکمه‌های انتخاب تاریخ (امروز تا یک هفته آینده)"""
     days_keyboard = [
-        [InlineKeyboardButton(f"\U0001F4C6 {persian_days[day]}", callback_data=f"day_{day}")] 
-        for day in menu_data.keys()
+        [InlineKeyboardButton(
+            f"\U0001F4C6 {persian_days[weekday_name(date)]} {jalali_label(date)}",
+            callback_data=callback_router.encode("date", date)
+        )]
+        for date in jalali_calendar.booking_dates() if menu_store.has_day(weekday_name(date))
     ]
     days_keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data="back_to_menu")])
     reply_markup = InlineKeyboardMarkup(days_keyboard)
     
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(
+        await edit_message_text(
+            update.callback_query,
             "\U0001F4D6 لطفاً روز مورد نظر خود را انتخاب کنید:", 
             reply_markup=reply_markup
         )
@@ -262,7 +461,7 @@ async def view_menu(update: Update, context: CallbackContext) -> None:
 
 async def show_reservations(update: Update, context: CallbackContext) -> None:
     """نمایش رزروهای فعلی کاربر"""
-    user_id = str(update.effective_user.id)
+    user_id = update.effective_user.id
     
     if user_id not in students:
         message = "\U0001F6AB شما هنوز کد تغذیه خود را ثبت نکرده‌اید. لطفاً ابتدا کد تغذیه خود را ثبت کنید."
@@ -270,52 +469,66 @@ async def show_reservations(update: Update, context: CallbackContext) -> None:
     else:
         feeding_code = students[user_id]
         
-        # دریافت دانشجو از دیتابیس
-        student = db_session.query(Student).filter_by(feeding_code=feeding_code).first()
+        # دریافت رزروهای دانشجو از دیتابیس (replica، مگر اینکه کاربر به تازگی رزرو کرده باشد)
+        stale = False
+        try:
+            reservations = await asyncio.to_thread(load_student_reservations, feeding_code, user_id)
+            reservation_views[user_id] = reservations
+            reservation_views.move_to_end(user_id)
+            if len(reservation_views) > RESERVATION_VIEWS_MAX:
+                reservation_views.popitem(last=False)
+        except Exception as e:
+            # در زمان قطع دیتابیس آخرین رزروهای خوانده شده نمایش داده می‌شوند
+            if not is_db_unavailable(e) or user_id not in reservation_views:
+                raise
+            reservations = reservation_views[user_id]
+            stale = True
         
-        if not student:
+        if reservations is None:
             message = "\U0001F6AB خطا در بازیابی اطلاعات شما. لطفاً دوباره کد تغذیه خود را ثبت کنید."
             keyboard = [[InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")]]
         else:
-            # دریافت رزروهای دانشجو از دیتابیس
-            reservations = db_session.query(Reservation).filter_by(student_id=student.id).all()
-            
             if not reservations:
                 message = "\U0001F4C5 شما هیچ رزروی ندارید. لطفاً از منوی غذا، وعده‌های مورد نظر خود را رزرو کنید."
                 keyboard = [[InlineKeyboardButton("\U0001F4D6 مشاهده منو", callback_data="view_menu")]]
             else:
                 message = f"<b>\U0001F4C5 رزروهای شما با کد تغذیه {feeding_code}:</b>\n\n"
-                
-                # گروه‌بندی رزروها بر اساس روز
-                reservations_by_day = {}
-                for reservation in reservations:
-                    if reservation.day not in reservations_by_day:
-                        reservations_by_day[reservation.day] = []
-                    reservations_by_day[reservation.day].append(reservation)
-                
-                # نمایش رزروها به صورت گروه‌بندی شده بر اساس روز
-                for day, day_reservations in reservations_by_day.items():
-                    persian_day = persian_days.get(day, day)
-                    message += f"<b>\U0001F4C6 روز {persian_day}:</b>\n"
-                    
-                    for reservation in day_reservations:
-                        persian_meal = persian_meals.get(reservation.meal_type, reservation.meal_type)
-                        status = "\U00002705 تحویل شده" if reservation.is_delivered else "\U0001F551 در انتظار تحویل"
-                        message += f"  \U0001F374 {persian_meal}: {reservation.food} - {status}\n"
-                    
-                    message += "\n"
-                
+                message += format_reservations_by_date(reservations)
                 keyboard = []
+            
+            keyboard.append([InlineKeyboardButton("\U0001F4DC سابقه رزروها", callback_data="reservation_history")])
+            
+            if stale:
+                message += "\U000026A0 ارتباط با دیتابیس موقتاً برقرار نیست؛ این اطلاعات ممکن است به‌روز نباشد.\n"
     
     keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(message, parse_mode="HTML", reply_markup=reply_markup)
+        await edit_message_text(update.callback_query, message, parse_mode="HTML", reply_markup=reply_markup)
     else:
         await update.message.reply_text(message, parse_mode="HTML", reply_markup=reply_markup)
 
+async def show_reservation_history(update: Update, context: CallbackContext) -> None:
+    """نمایش رزروهای گذشته کاربر (هفته‌هایی که هنوز بایگانی نشده‌اند)"""
+    user_id = update.effective_user.id
+    keyboard = [[InlineKeyboardButton("\U0001F4C5 رزروهای فعلی", callback_data="show_reservations")]]
+    
+    if user_id not in students:
+        message = "\U0001F6AB شما هنوز کد تغذیه خود را ثبت نکرده‌اید. لطفاً ابتدا کد تغذیه خود را ثبت کنید."
+    else:
+        reservations = await asyncio.to_thread(load_reservation_history, students[user_id], user_id)
+        if not reservations:
+            message = "\U0001F4DC رزروی در روزهای گذشته ثبت نشده است."
+        else:
+            message = f"<b>\U0001F4DC سابقه رزروهای شما (آخرین {HISTORY_LIMIT} وعده):</b>\n\n"
+            message += format_reservations_by_date(reservations)
+    
+    keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")])
+    await update.callback_query.answer()
+    await edit_message_text(update.callback_query, message, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
+
 async def admin_panel(update: Update, context: CallbackContext) -> None:
     """نمایش پنل مدیریت برای مدیران سیستم"""
     chat_id = update.effective_chat.id
@@ -324,7 +537,7 @@ async def admin_panel(update: Update, context: CallbackContext) -> None:
     if not is_owner(chat_id):
         if update.callback_query:
             await update.callback_query.answer()
-            await update.callback_query.edit_message_text("\U0001F6AB شما دسترسی کافی برای استفاده از پنل مدیریت را ندارید.")
+            await edit_message_text(update.callback_query, "\U0001F6AB شما دسترسی کافی برای استفاده از پنل مدیریت را ندارید.")
         else:
             await update.message.reply_text("\U0001F6AB شما دسترسی کافی برای استفاده از پنل مدیریت را ندارید.")
         return
@@ -335,33 +548,210 @@ async def admin_panel(update: Update, context: CallbackContext) -> None:
         [InlineKeyboardButton("\U0001F464 لیست کاربران", callback_data="admin_users_list")],
         [InlineKeyboardButton("\U0001F4BE پشتیبان‌گیری از دیتابیس", callback_data="admin_backup")],
         [InlineKeyboardButton("\U0001F4E6 مدیریت تحویل غذا", callback_data="admin_delivery_management")],
+        [InlineKeyboardButton("\U0001F373 داشبورد آشپزخانه", callback_data="admin_kitchen")],
+        [InlineKeyboardButton("\U0001F4E4 خروجی رزروها", callback_data="admin_export")],
+        [InlineKeyboardButton("\U0001F4E2 یادآوری رزرو فردا", callback_data="admin_reminder_broadcast")],
         [InlineKeyboardButton("\U0001F5D1 حذف همه رزروها", callback_data="admin_clear_reservations")],
+        [InlineKeyboardButton("\U0001F4DD نوشتن‌های در انتظار", callback_data="admin_write_journal")],
         [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(admin_keyboard)
     
     message = "<b>\U0001F680 پنل مدیریت:</b>\n\nلطفاً یکی از گزینه‌های زیر را انتخاب کنید:"
+    await write_journal.refresh()
+    if write_journal.pending:
+        message += f"\n\n\U000026A0 {write_journal.pending} نوشتن در انتظار ثبت در دیتابیس است."
     
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(message, parse_mode="HTML", reply_markup=reply_markup)
+        await edit_message_text(update.callback_query, message, parse_mode="HTML", reply_markup=reply_markup)
     else:
         await update.message.reply_text(message, parse_mode="HTML", reply_markup=reply_markup)
 
+async def admin_write_journal(update: Update, context: CallbackContext) -> None:
+    """نمایش وضعیت دفتر نوشتن‌هایی که در زمان قطع دیتابیس دریافت شده‌اند"""
+    if not is_owner(update.effective_chat.id):
+        return
+    
+    await write_journal.refresh()
+    database_status = "\U0001F534 قطع" if db_breaker.is_open else "\U0001F7E2 متصل"
+    message = (
+        "<b>\U0001F4DD نوشتن‌های در انتظار:</b>\n\n"
+        f"وضعیت دیتابیس: {database_status}\n"
+        f"تعداد نوشتن‌های در انتظار: {write_journal.pending}\n"
+        f"قدمت قدیمی‌ترین نوشتن: {int(write_journal.lag_seconds)} ثانیه\n"
+        f"اعمال شده: {write_journal.replayed_total}\n"
+        f"رد شده (مثلاً تکمیل ظرفیت): {write_journal.rejected_total}"
+    )
+    await edit_message_text(
+        update.callback_query,
+        message,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F504 به‌روزرسانی", callback_data="admin_write_journal")],
+            [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
+        ])
+    )
+
+async def render_kitchen_dashboard(query, user_id):
+    today = datetime.date.today()
+    counters = await asyncio.to_thread(
+        load_kitchen_counters, [today, today + datetime.timedelta(days=1)], user_id
+    )
+    await edit_message_text(
+        query,
+        format_kitchen_dashboard(counters),
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F504 به‌روزرسانی", callback_data="admin_kitchen")],
+            [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
+        ])
+    )
+
+async def refresh_kitchen_dashboard(query, chat_id, user_id):
+    """به‌روزرسانی خودکار داشبورد آشپزخانه در زمان سرو غذا"""
+    deadline = asyncio.get_running_loop().time() + KITCHEN_LIVE_SECONDS
+    try:
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(KITCHEN_REFRESH_INTERVAL)
+            try:
+                await render_kitchen_dashboard(query, user_id)
+            except Exception as e:
+                # پیام حذف شده یا دیتابیس قطع است؛ مدیر می‌تواند داشبورد را دوباره باز کند
+                logger.warning(f"خطا در به‌روزرسانی داشبورد آشپزخانه: {e}")
+                return
+    finally:
+        if kitchen_live.get(chat_id) is asyncio.current_task():
+            kitchen_live.pop(chat_id, None)
+
+async def stop_kitchen_live():
+    tasks = list(kitchen_live.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    kitchen_live.clear()
+
+async def admin_kitchen_dashboard(update: Update, context: CallbackContext) -> None:
+    """داشبورد آشپزخانه: تعداد رزرو و تحویل وعده‌های امروز و فردا از شمارنده‌ها"""
+    chat_id = update.effective_chat.id
+    if not is_owner(chat_id):
+        return
+    
+    query = update.callback_query
+    await render_kitchen_dashboard(query, update.effective_user.id)
+    
+    # فقط آخرین داشبورد باز شده در هر چت به‌روزرسانی خودکار می‌شود
+    previous = kitchen_live.get(chat_id)
+    if previous is not None:
+        previous.cancel()
+    kitchen_live[chat_id] = asyncio.create_task(refresh_kitchen_dashboard(query, chat_id, update.effective_user.id))
+
+async def send_reservations_export(bot, chat_id, user_id, start, end, fmt):
+    """تهیه فایل خروجی رزروها و ارسال آن به صورت سند تلگرام"""
+    if chat_id in exports_running:
+        await send_queue.send_message(bot, chat_id=chat_id, text="\U000023F3 خروجی قبلی شما هنوز در حال آماده شدن است.")
+        return
+    
+    exports_running.add(chat_id)
+    path = None
+    try:
+        await send_queue.send_message(
+            bot,
+            chat_id=chat_id,
+            text=f"\U000023F3 در حال آماده کردن خروجی رزروها از {jalali_label(start)} تا {jalali_label(end)}..."
+        )
+        path, rows = await asyncio.to_thread(load_reservations_export, start, end, fmt, user_id)
+        filename = f"reservations_{start:%Y%m%d}_{end:%Y%m%d}.{fmt}"
+        
+        async def send_document():
+            # فایل در هر تلاش باز می‌شود تا ارسال دوباره پس از RetryAfter از ابتدای فایل باشد
+            with open(path, 'rb') as document:
+                return await bot.send_document(
+                    chat_id=chat_id,
+                    document=document,
+                    filename=filename,
+                    caption=f"\U0001F4E4 رزروهای {jalali_label(start)} تا {jalali_label(end)}: {rows} سطر"
+                )
+        
+        await send_queue.submit(chat_id, send_document)
+    except Exception as e:
+        logger.error(f"خطا در تهیه خروجی رزروها: {e}")
+        await send_queue.send_message(bot, chat_id=chat_id, text=f"\U0001F6AB خطا در تهیه خروجی رزروها: {str(e)}")
+    finally:
+        exports_running.discard(chat_id)
+        if path is not None:
+            os.remove(path)
+
+async def admin_export(update: Update, context: CallbackContext) -> None:
+    """انتخاب بازه و قالب خروجی رزروها"""
+    if not is_owner(update.effective_chat.id):
+        return
+    
+    today = datetime.date.today()
+    ranges = [
+        ("7 روز اخیر", today - datetime.timedelta(days=6)),
+        ("30 روز اخیر", today - datetime.timedelta(days=29)),
+    ]
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{label} ({fmt.upper()})", callback_data=callback_router.encode("export", start, today, fmt))
+            for fmt in FORMATS
+        ]
+        for label, start in ranges
+    ]
+    keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")])
+    
+    await edit_message_text(
+        update.callback_query,
+        "<b>\U0001F4E4 خروجی رزروها و تحویل‌ها:</b>\n\n"
+        "یکی از بازه‌های زیر را انتخاب کنید یا برای بازه دلخواه از دستور زیر استفاده کنید:\n"
+        "<code>/export 1403/07/01 1403/10/30 xlsx</code>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def export_callback(update: Update, context: CallbackContext, start, end, fmt) -> None:
+    if not is_owner(update.effective_chat.id):
+        return
+    await send_reservations_export(context.bot, update.effective_chat.id, update.effective_user.id, start, end, fmt)
+
+async def export_command(update: Update, context: CallbackContext) -> None:
+    """پردازش دستور /export تاریخ_شروع تاریخ_پایان [csv|xlsx]"""
+    if not is_owner(update.effective_chat.id):
+        return
+    
+    args = context.args or []
+    fmt = args[2].lower() if len(args) > 2 else FORMAT_CSV
+    try:
+        if len(args) < 2 or fmt not in FORMATS:
+            raise ValueError(fmt)
+        start, end = parse_export_date(args[0]), parse_export_date(args[1])
+    except ValueError:
+        await update.message.reply_text(
+            "\U0001F6AB قالب دستور: /export تاریخ_شروع تاریخ_پایان [csv|xlsx]\n"
+            "مثال: /export 1403/07/01 1403/10/30 xlsx"
+        )
+        return
+    if start > end:
+        start, end = end, start
+    
+    await send_reservations_export(context.bot, update.effective_chat.id, update.effective_user.id, start, end, fmt)
+
 async def admin_menu_management(update: Update, context: CallbackContext) -> None:
     """مدیریت منوی غذای هفتگی"""
     if not is_owner(update.effective_chat.id):
         return
     
     days_keyboard = [
-        [InlineKeyboardButton(f"\U0001F4C6 {persian_days[day]}", callback_data=f"edit_menu_{day}")] 
-        for day in menu_data.keys()
+        [InlineKeyboardButton(f"\U0001F4C6 {persian_days[day]}", callback_data=callback_router.encode("edit_menu", day))] 
+        for day in menu_store.days()
     ]
     days_keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")])
     reply_markup = InlineKeyboardMarkup(days_keyboard)
     
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
+    await edit_message_text(
+        update.callback_query,
         "<b>\U0001F37D مدیریت منوی غذا:</b>\n\nلطفاً روز مورد نظر برای ویرایش منو را انتخاب کنید:",
         parse_mode="HTML",
         reply_markup=reply_markup
@@ -372,25 +762,23 @@ async def admin_users_list(update: Update, context: CallbackContext) -> None:
     if not is_owner(update.effective_chat.id):
         return
     
-    # دریافت تعداد کل کاربران
-    total_users = db_session.query(Student).count()
-    
-    # دریافت کاربران به ترتیب تاریخ ثبت‌نام (10 کاربر آخر)
-    latest_users = db_session.query(Student).order_by(Student.registration_date.desc()).limit(10).all()
+    # دریافت تعداد کل کاربران و کاربران به ترتیب تاریخ ثبت‌نام (10 کاربر آخر)
+    total_users, latest_users = await asyncio.to_thread(load_users_summary, update.effective_user.id)
     
     message = f"<b>\U0001F464 لیست کاربران:</b>\n\nتعداد کل کاربران: {total_users}\n\n"
     message += "<b>آخرین کاربران ثبت‌نام شده:</b>\n"
     
     for i, user in enumerate(latest_users, start=1):
         registration_date = user.registration_date.strftime("%Y-%m-%d %H:%M:%S") if user.registration_date else "نامشخص"
-        message += f"{i}. کد تغذیه: {user.feeding_code} - شناسه کاربری: {user.user_id} - تاریخ ثبت‌نام: {registration_date}\n"
+        message += f"{i}. کد تغذیه: {user.feeding_code} - شناسه کاربری: {user.user_id or '-'} - تاریخ ثبت‌نام: {registration_date}\n"
     
     reply_markup = InlineKeyboardMarkup([
         [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
     ])
     
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
+    await edit_message_text(
+        update.callback_query,
         message,
         parse_mode="HTML",
         reply_markup=reply_markup
@@ -402,7 +790,8 @@ async def admin_backup_database(update: Update, context: CallbackContext) -> int
         return ConversationHandler.END
     
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
+    await edit_message_text(
+        update.callback_query,
         "<b>\U0001F4BE پشتیبان‌گیری از دیتابیس:</b>\n\n"
         "لطفاً توضیحی برای این نسخه پشتیبان وارد کنید (مثلاً: \"پشتیبان روزانه\" یا \"قبل از به‌روزرسانی\"):",
         parse_mode="HTML",
@@ -433,7 +822,8 @@ async def create_database_backup(description, chat_id, context: CallbackContext)
         db_session.commit()
         
         # ارسال پیام موفقیت‌آمیز
-        await context.bot.send_message(
+        await send_queue.send_message(
+            context.bot,
             chat_id=chat_id,
             text=f"<b>\U00002705 نسخه پشتیبان با موفقیت ایجاد شد:</b>\n\n"
                  f"نام فایل: {backup_filename}\n"
@@ -446,7 +836,8 @@ async def create_database_backup(description, chat_id, context: CallbackContext)
         )
     except Exception as e:
         # ارسال پیام خطا
-        await context.bot.send_message(
+        await send_queue.send_message(
+            context.bot,
             chat_id=chat_id,
             text=f"<b>\U0001F6AB خطا در ایجاد نسخه پشتیبان:</b>\n\n{str(e)}",
             parse_mode="HTML",
@@ -468,9 +859,11 @@ async def admin_clear_reservations(update: Update, context: CallbackContext) ->
     reply_markup = InlineKeyboardMarkup(confirm_keyboard)
     
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
+    await edit_message_text(
+        update.callback_query,
         "<b>\U0001F5D1 حذف تمام رزروها</b>\n\n"
-        "\U0001F6A8 <b>هشدار:</b> این عملیات غیرقابل بازگشت است و تمام رزروهای ثبت شده در سیستم حذف خواهند شد.\n\n"
+        "\U0001F6A8 <b>هشدار:</b> تمام رزروهای ثبت شده در سیستم حذف خواهند شد.\n"
+        "\U0001F4BE پیش از حذف، نسخه پشتیبان خودکار از رزروها گرفته می‌شود.\n\n"
         "آیا از حذف تمام رزروها اطمینان دارید؟",
         parse_mode="HTML",
         reply_markup=reply_markup
@@ -483,7 +876,7 @@ async def admin_delivery_management(update: Update, context: CallbackContext) ->
     
     # نمایش روزهای هفته برای انتخاب
     days_keyboard = [
-        [InlineKeyboardButton(f"\U0001F4C6 {persian_days[day]}", callback_data=f"delivery_day_{day}")] 
+        [InlineKeyboardButton(f"\U0001F4C6 {persian_days[day]}", callback_data=callback_router.encode("delivery_day", day))] 
         for day in persian_days.keys()
     ]
     days_keyboard.append([
@@ -493,7 +886,8 @@ async def admin_delivery_management(update: Update, context: CallbackContext) ->
     reply_markup = InlineKeyboardMarkup(days_keyboard)
     
     await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
+    await edit_message_text(
+        update.callback_query,
         "<b>\U0001F4E6 مدیریت تحویل غذا:</b>\n\n"
         "لطفاً روز مورد نظر را انتخاب کنید یا با کد تغذیه جستجو کنید:",
         parse_mode="HTML",
@@ -501,250 +895,293 @@ async def admin_delivery_management(update: Update, context: CallbackContext) ->
     )
 
 async def handle_callback(update: Update, context: CallbackContext) -> None:
-    """پردازش کالبک کوئری‌ها از کیبوردهای درون خطی"""
+    """پردازش کالبک کوئری‌ها با حذف کلیک‌های تکراری روی همان دکمه"""
+    query = update.callback_query
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    
+    handled = await callback_deduplicator.run(
+        update.effective_user.id,
+        message_id,
+        query.data,
+        lambda: dispatch_callback(update, context)
+    )
+    
+    if not handled:
+        # کلیک تکراری؛ فقط نشانگر بارگذاری را متوقف می‌کنیم
+        try:
+            await query.answer()
+        except Exception:
+            pass
+
+async def dispatch_callback(update: Update, context: CallbackContext) -> None:
+    """پردازش کالبک کوئری‌ها از کیبوردهای درون خطی از طریق جدول مسیریابی"""
     query = update.callback_query
     await query.answer()  # پاسخ به کالبک کوئری برای توقف نشانگر بارگذاری
     
-    # پردازش دکمه بازگشت به منوی اصلی
-    if query.data == "back_to_menu":
-        await main_menu(update, context)
+    await callback_router.dispatch(update, context)
+
+async def register_callback(update: Update, context: CallbackContext) -> None:
+    """درخواست کد تغذیه از طریق دکمه ثبت کد تغذیه"""
+    if hasattr(update.callback_query, 'message'):
+        await update.callback_query.message.reply_text(
+            "\U0001F4DD لطفاً کد تغذیه خود را ارسال کنید:"
+        )
+
+async def confirm_clear_reservations(update: Update, context: CallbackContext) -> None:
+    """حذف تمام رزروها پس از تایید مدیر در پس‌زمینه با نمایش پیشرفت"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش دکمه‌های اصلی منو
-    if query.data == "view_menu":
-        await view_menu(update, context)
-        return
-    elif query.data == "register":
-        if hasattr(update.callback_query, 'message'):
-            await update.callback_query.message.reply_text(
-                "\U0001F4DD لطفاً کد تغذیه خود را ارسال کنید:"
+    query = update.callback_query
+    back_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
+    ])
+    
+    async def progress(text, done=False):
+        # خطای ویرایش پیام (مثلاً حذف پیام توسط مدیر) نباید حذف رزروها را متوقف کند
+        try:
+            await edit_message_text(
+                query,
+                f"<b>\U0001F5D1 حذف تمام رزروها</b>\n\n{text}",
+                parse_mode="HTML",
+                reply_markup=back_markup if done else None
             )
-        return
-    elif query.data == "show_reservations":
-        await show_reservations(update, context)
-        return
-    elif query.data == "help":
-        await help_command(update, context)
-        return
-    elif query.data == "admin_panel":
-        await admin_panel(update, context)
+        except Exception as e:
+            logger.warning(f"خطا در نمایش پیشرفت حذف رزروها: {e}")
+    
+    if not await start_clear(db_session.get_bind(), progress, session_router.mark_write):
+        await progress("\U000023F3 حذف رزروها از قبل در حال انجام است.", done=True)
         return
     
-    # پردازش دکمه‌های پنل مدیریت
-    if query.data == "admin_menu_management":
-        await admin_menu_management(update, context)
+    await progress("\U000023F3 حذف رزروها شروع شد...")
+
+async def admin_reminder_broadcast(update: Update, context: CallbackContext) -> None:
+    """ارسال یادآوری رزرو فردا به دانشجویانی که رزرو نکرده‌اند"""
+    if not is_owner(update.effective_chat.id):
         return
-    elif query.data == "admin_users_list":
-        await admin_users_list(update, context)
+    
+    query = update.callback_query
+    reservation_date = tomorrow()
+    day = weekday_name(reservation_date)
+    await start_broadcast(
+        context.bot,
+        db_session.get_bind(),
+        KIND_REMINDER,
+        f"\U000023F0 یادآوری: شما هنوز برای فردا ({persian_days[day]}) غذا رزرو نکرده‌اید.\n"
+        "برای رزرو از دستور /menu استفاده کنید.",
+        day=day,
+        reservation_date=reservation_date,
+        requested_by=update.effective_chat.id
+    )
+    await edit_message_text(
+        query,
+        f"\U0001F4E2 ارسال یادآوری رزرو روز {persian_days[day]} در پس‌زمینه آغاز شد.\n"
+        "پس از پایان، گزارش ارسال برای شما فرستاده می‌شود.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
+        ])
+    )
+
+async def broadcast_menu_change(update: Update, context: CallbackContext, day: str) -> None:
+    """اطلاع‌رسانی تغییر منو به همه دانشجویان"""
+    if not is_owner(update.effective_chat.id):
         return
-    elif query.data == "admin_delivery_management":
-        await admin_delivery_management(update, context)
+    
+    query = update.callback_query
+    meals = menu_store.names(day)
+    await start_broadcast(
+        context.bot,
+        db_session.get_bind(),
+        KIND_MENU_CHANGE,
+        f"\U0001F4E2 منوی غذای روز {persian_days[day]} تغییر کرد:\n\n"
+        f"\U0001F374 صبحانه: {meals['breakfast']}\n"
+        f"\U0001F35C ناهار: {meals['lunch']}\n"
+        f"\U0001F35D شام: {meals['dinner']}",
+        day=day,
+        requested_by=update.effective_chat.id
+    )
+    await edit_message_text(
+        query,
+        f"\U0001F4E2 اطلاع‌رسانی تغییر منوی روز {persian_days[day]} در پس‌زمینه آغاز شد.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت منو", callback_data="admin_menu_management")]
+        ])
+    )
+
+async def show_day_menu(update: Update, context: CallbackContext, selected_day: str) -> None:
+    """نمایش منوی غذای یک روز (دکمه‌های قدیمی بدون تاریخ؛ نزدیک‌ترین روز آینده با این نام)"""
+    await show_date_menu(update, context, upcoming_date(selected_day))
+
+async def show_date_menu(update: Update, context: CallbackContext, reservation_date: datetime.date, notice: str = "") -> None:
+    """نمایش منوی غذای یک تاریخ با دکمه‌های رزرو (دکمه‌ها نسخه منوی نمایش داده شده را همراه دارند)"""
+    if not jalali_calendar.is_bookable(reservation_date):
+        await send_expired_date_message(update, reservation_date)
         return
-    elif query.data == "admin_clear_reservations":
-        await admin_clear_reservations(update, context)
+    
+    query = update.callback_query
+    selected_day = weekday_name(reservation_date)
+    meals = menu_store.names(selected_day)
+    
+    # بررسی اینکه آیا کاربر کد تغذیه خود را ثبت کرده است
+    user_id = update.effective_user.id
+    if user_id not in students:
+        await edit_message_text(
+            query,
+            "\U0001F6AB لطفاً ابتدا کد تغذیه خود را ثبت کنید.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
+                [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
+            ])
+        )
         return
-    elif query.data == "confirm_clear_reservations":
-        try:
-            # حذف تمام رزروها از دیتابیس
-            db_session.query(Reservation).delete()
-            db_session.commit()
-            
-            # نمایش پیام موفقیت‌آمیز
-            await query.edit_message_text(
-                "<b>\U00002705 موفقیت‌آمیز:</b>\n\n"
-                "تمام رزروها با موفقیت از سیستم حذف شدند.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
-                ])
-            )
-        except Exception as e:
-            # در صورت بروز خطا، رولبک کنید
-            db_session.rollback()
-            logger.error(f"خطا در حذف رزروها: {e}")
-            
-            # نمایش پیام خطا
-            await query.edit_message_text(
-                f"<b>\U0001F6AB خطا:</b>\n\n"
-                f"در حذف رزروها خطایی رخ داد: {str(e)}",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F519 بازگشت به پنل مدیریت", callback_data="admin_panel")]
-                ])
+    
+    # نمایش منوی غذا برای روز انتخاب شده
+    meals_keyboard = []
+    for meal_type, meal_name in meals.items():
+        persian_meal = persian_meals.get(meal_type, meal_type)
+        sold_out = " (تکمیل ظرفیت)" if capacity_manager.is_sold_out(selected_day, meal_type) else ""
+        meals_keyboard.append([
+            InlineKeyboardButton(
+                f"\U0001F374 {persian_meal}: {meal_name}{sold_out}", 
+                callback_data=callback_router.encode(
+                    "reserve_on", reservation_date, meal_type, menu_store.item_version(selected_day, meal_type)
+                )
             )
+        ])
+    
+    meals_keyboard.append([
+        InlineKeyboardButton("\U0001F4E6 رزرو همه وعده‌ها", callback_data=callback_router.encode(
+            "reserve_all_on", reservation_date, menu_store.day_version(selected_day)
+        ))
+    ])
+    meals_keyboard.append([
+        InlineKeyboardButton("\U0001F519 بازگشت به روزها", callback_data="view_menu")
+    ])
+    
+    reply_markup = InlineKeyboardMarkup(meals_keyboard)
+    
+    await edit_message_text(
+        query,
+        f"{notice}<b>\U0001F4D6 منوی غذای روز {persian_days[selected_day]} ({jalali_label(reservation_date)}):</b>\n\n"
+        f"\U0001F374 صبحانه: {meals['breakfast']}\n"
+        f"\U0001F35C ناهار: {meals['lunch']}\n"
+        f"\U0001F35D شام: {meals['dinner']}\n\n"
+        "لطفاً وعده مورد نظر خود را برای رزرو انتخاب کنید:",
+        parse_mode="HTML",
+        reply_markup=reply_markup
+    )
+
+async def edit_menu_day(update: Update, context: CallbackContext, selected_day: str) -> None:
+    """نمایش وعده‌های یک روز برای ویرایش منو و ظرفیت"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش انتخاب روز از منوی غذا
-    if query.data.startswith("day_"):
-        selected_day = query.data.split("_")[1]
-        meals = menu_data[selected_day]
-        
-        # بررسی اینکه آیا کاربر کد تغذیه خود را ثبت کرده است
-        user_id = str(update.effective_user.id)
-        if user_id not in students:
-            await query.edit_message_text(
-                "\U0001F6AB لطفاً ابتدا کد تغذیه خود را ثبت کنید.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
-                    [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
-                ])
-            )
-            return
-        
-        # نمایش منوی غذا برای روز انتخاب شده
-        meals_keyboard = []
-        for meal_type, meal_name in meals.items():
-            persian_meal = persian_meals.get(meal_type, meal_type)
-            meals_keyboard.append([
-                InlineKeyboardButton(
-                    f"\U0001F374 {persian_meal}: {meal_name}", 
-                    callback_data=f"reserve_{selected_day}_{meal_type}"
-                )
-            ])
-        
+    query = update.callback_query
+    current_meals = menu_store.names(selected_day)
+    
+    meals_keyboard = []
+    for meal_type, meal_name in current_meals.items():
+        persian_meal = persian_meals.get(meal_type, meal_type)
         meals_keyboard.append([
-            InlineKeyboardButton("\U0001F4E6 رزرو همه وعده‌ها", callback_data=f"reserve_all_{selected_day}")
+            InlineKeyboardButton(
+                f"\U0001F374 {persian_meal}: {meal_name}", 
+                callback_data=callback_router.encode("edit_meal", selected_day, meal_type)
+            )
         ])
+    
+    # دکمه‌های تعیین ظرفیت هر وعده
+    for meal_type in current_meals.keys():
+        persian_meal = persian_meals.get(meal_type, meal_type)
+        capacity = capacity_manager.capacity(selected_day, meal_type)
+        capacity_label = capacity if capacity else "نامحدود"
         meals_keyboard.append([
-            InlineKeyboardButton("\U0001F519 بازگشت به روزها", callback_data="view_menu")
+            InlineKeyboardButton(
+                f"\U0001F522 ظرفیت {persian_meal}: {capacity_label}",
+                callback_data=callback_router.encode("edit_capacity", selected_day, meal_type)
+            )
         ])
-        
-        reply_markup = InlineKeyboardMarkup(meals_keyboard)
-        
-        await query.edit_message_text(
-            f"<b>\U0001F4D6 منوی غذای روز {persian_days[selected_day]}:</b>\n\n"
-            f"\U0001F374 صبحانه: {meals['breakfast']}\n"
-            f"\U0001F35C ناهار: {meals['lunch']}\n"
-            f"\U0001F35D شام: {meals['dinner']}\n\n"
-            "لطفاً وعده مورد نظر خود را برای رزرو انتخاب کنید:",
-            parse_mode="HTML",
-            reply_markup=reply_markup
-        )
+    
+    meals_keyboard.append([
+        InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_menu_management")
+    ])
+    
+    reply_markup = InlineKeyboardMarkup(meals_keyboard)
+    
+    await edit_message_text(
+        query,
+        f"<b>\U0001F37D منوی روز {persian_days[selected_day]}:</b>\n\n"
+        f"\U0001F374 صبحانه: {current_meals['breakfast']}\n"
+        f"\U0001F35C ناهار: {current_meals['lunch']}\n"
+        f"\U0001F35D شام: {current_meals['dinner']}\n\n"
+        "لطفاً وعده مورد نظر برای ویرایش را انتخاب کنید:",
+        parse_mode="HTML",
+        reply_markup=reply_markup
+    )
+
+async def edit_meal_food(update: Update, context: CallbackContext, selected_day: str, selected_meal: str) -> None:
+    """درخواست نام غذای جدید برای یک وعده"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش رزرو غذا
-    if query.data.startswith("reserve_"):
-        parts = query.data.split("_")
-        
-        # رزرو همه وعده‌های یک روز
-        if parts[1] == "all":
-            selected_day = parts[2]
-            await reserve_all_meals(update, context, selected_day)
-            return
-        
-        # رزرو یک وعده خاص
-        selected_day = parts[1]
-        selected_meal = parts[2]
-        await reserve_meal(update, context, selected_day, selected_meal)
+    context.user_data['state'] = EDIT_MENU_FOOD
+    context.user_data['edit_day'] = selected_day
+    context.user_data['edit_meal'] = selected_meal
+    
+    await edit_message_text(
+        update.callback_query,
+        f"<b>\U0001F37D ویرایش وعده {persian_meals[selected_meal]} روز {persian_days[selected_day]}:</b>\n\n"
+        f"غذای فعلی: {dish_catalog.name(menu_store.dish_id(selected_day, selected_meal))}\n\n"
+        "لطفاً نام غذای جدید را وارد کنید:",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت", callback_data=callback_router.encode("edit_menu", selected_day))]
+        ])
+    )
+
+async def edit_meal_capacity(update: Update, context: CallbackContext, selected_day: str, selected_meal: str) -> None:
+    """درخواست ظرفیت جدید برای یک وعده"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش انتخاب روز برای ویرایش منو
-    if query.data.startswith("edit_menu_"):
-        selected_day = query.data.split("_")[2]
-        current_meals = menu_data[selected_day]
-        
-        meals_keyboard = []
-        for meal_type, meal_name in current_meals.items():
-            persian_meal = persian_meals.get(meal_type, meal_type)
-            meals_keyboard.append([
-                InlineKeyboardButton(
-                    f"\U0001F374 {persian_meal}: {meal_name}", 
-                    callback_data=f"edit_meal_{selected_day}_{meal_type}"
-                )
-            ])
-        
-        meals_keyboard.append([
-            InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_menu_management")
+    query = update.callback_query
+    context.user_data['state'] = EDIT_MEAL_CAPACITY
+    context.user_data['edit_day'] = selected_day
+    context.user_data['edit_meal'] = selected_meal
+    
+    await edit_message_text(
+        query,
+        f"<b>\U0001F522 تعیین ظرفیت وعده {persian_meals[selected_meal]} روز {persian_days[selected_day]}:</b>\n\n"
+        "لطفاً حداکثر تعداد رزرو را به صورت عدد وارد کنید (عدد 0 یعنی بدون محدودیت):",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت", callback_data=callback_router.encode("edit_menu", selected_day))]
         ])
-        
-        reply_markup = InlineKeyboardMarkup(meals_keyboard)
-        
-        await query.edit_message_text(
-            f"<b>\U0001F37D منوی روز {persian_days[selected_day]}:</b>\n\n"
-            f"\U0001F374 صبحانه: {current_meals['breakfast']}\n"
-            f"\U0001F35C ناهار: {current_meals['lunch']}\n"
-            f"\U0001F35D شام: {current_meals['dinner']}\n\n"
-            "لطفاً وعده مورد نظر برای ویرایش را انتخاب کنید:",
-            parse_mode="HTML",
-            reply_markup=reply_markup
-        )
-        
-        # تنظیم مرحله بعدی مکالمه
+    )
+
+async def admin_backup_callback(update: Update, context: CallbackContext) -> None:
+    """شروع پشتیبان‌گیری از طریق دکمه پنل مدیریت"""
+    if await admin_backup_database(update, context) == DATABASE_BACKUP_DESC:
+        context.user_data['state'] = DATABASE_BACKUP_DESC
+
+async def delivery_day_roster(update: Update, context: CallbackContext, selected_day: str) -> None:
+    """نمایش فهرست رزروهای یک روز برای مدیریت تحویل"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش دکمه‌های مدیریت تحویل غذا
-    if query.data.startswith("delivery_day_"):
-        selected_day = query.data.split("_")[2]
-        
-        # دریافت رزروهای روز انتخاب شده
-        reservations = db_session.query(Reservation).filter_by(day=selected_day).all()
-        
-        if not reservations:
-            await query.edit_message_text(
-                f"<b>\U0001F4E6 رزروهای روز {persian_days[selected_day]}:</b>\n\n"
-                "هیچ رزروی برای این روز ثبت نشده است.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
-                ])
-            )
-            return
-        
-        # گروه‌بندی رزروها بر اساس نوع وعده
-        breakfast = []
-        lunch = []
-        dinner = []
-        
-        for reservation in reservations:
-            student = db_session.query(Student).filter_by(id=reservation.student_id).first()
-            if not student:
-                continue
-                
-            reservation_info = {
-                "id": reservation.id,
-                "feeding_code": student.feeding_code,
-                "food": reservation.food,
-                "is_delivered": reservation.is_delivered
-            }
-            
-            if reservation.meal_type == "breakfast":
-                breakfast.append(reservation_info)
-            elif reservation.meal_type == "lunch":
-                lunch.append(reservation_info)
-            elif reservation.meal_type == "dinner":
-                dinner.append(reservation_info)
-        
-        # ایجاد پیام با دکمه‌های تایید تحویل
-        message = f"<b>\U0001F4E6 رزروهای روز {persian_days[selected_day]}:</b>\n\n"
-        
-        # نمایش رزروهای صبحانه
-        if breakfast:
-            message += "<b>\U0001F374 صبحانه:</b>\n"
-            for i, res in enumerate(breakfast, start=1):
-                status = "\U00002705" if res["is_delivered"] else "\U0001F551"
-                message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {res['food']} - {status}\n"
-            message += "\n"
-        
-        # نمایش رزروهای ناهار
-        if lunch:
-            message += "<b>\U0001F35C ناهار:</b>\n"
-            for i, res in enumerate(lunch, start=1):
-                status = "\U00002705" if res["is_delivered"] else "\U0001F551"
-                message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {res['food']} - {status}\n"
-            message += "\n"
-        
-        # نمایش رزروهای شام
-        if dinner:
-            message += "<b>\U0001F35D شام:</b>\n"
-            for i, res in enumerate(dinner, start=1):
-                status = "\U00002705" if res["is_delivered"] else "\U0001F551"
-                message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {res['food']} - {status}\n"
-            message += "\n"
-        
-        message += "برای تایید تحویل یک غذا، پیام جدیدی فرستاده و کد تغذیه دانشجو را وارد کنید."
-        
-        await query.edit_message_text(
-            message,
+    query = update.callback_query
+    
+    # دریافت رزروهای روز انتخاب شده؛ درخواست‌های هم‌زمان برای یک روز یک کوئری مشترک دارند
+    user_id = update.effective_user.id
+    reservations = await single_flight.do(
+        ("day_roster", selected_day, session_router.prefers_primary(user_id)),
+        lambda: asyncio.to_thread(load_day_roster, selected_day, user_id)
+    )
+    
+    if not reservations:
+        await edit_message_text(
+            query,
+            f"<b>\U0001F4E6 رزروهای روز {persian_days[selected_day]}:</b>\n\n"
+            "هیچ رزروی برای این روز ثبت نشده است.",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
@@ -752,63 +1189,147 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    # پردازش دکمه جستجو با کد تغذیه
-    if query.data == "search_by_feeding_code":
-        await query.edit_message_text(
-            "<b>\U0001F50D جستجو با کد تغذیه:</b>\n\n"
-            "لطفاً کد تغذیه دانشجوی مورد نظر را وارد کنید:",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
-            ])
-        )
+    # گروه‌بندی رزروها بر اساس نوع وعده
+    breakfast = []
+    lunch = []
+    dinner = []
+    
+    for reservation_info in reservations:
+        if reservation_info["meal_type"] == "breakfast":
+            breakfast.append(reservation_info)
+        elif reservation_info["meal_type"] == "lunch":
+            lunch.append(reservation_info)
+        elif reservation_info["meal_type"] == "dinner":
+            dinner.append(reservation_info)
+    
+    # ایجاد پیام با دکمه‌های تایید تحویل
+    message = f"<b>\U0001F4E6 رزروهای روز {persian_days[selected_day]}:</b>\n\n"
+    
+    # نمایش رزروهای صبحانه
+    if breakfast:
+        message += "<b>\U0001F374 صبحانه:</b>\n"
+        for i, res in enumerate(breakfast, start=1):
+            status = "\U00002705" if res["is_delivered"] else "\U0001F551"
+            message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {dish_catalog.name(res['dish_id'])} - {status}\n"
+        message += "\n"
+    
+    # نمایش رزروهای ناهار
+    if lunch:
+        message += "<b>\U0001F35C ناهار:</b>\n"
+        for i, res in enumerate(lunch, start=1):
+            status = "\U00002705" if res["is_delivered"] else "\U0001F551"
+            message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {dish_catalog.name(res['dish_id'])} - {status}\n"
+        message += "\n"
+    
+    # نمایش رزروهای شام
+    if dinner:
+        message += "<b>\U0001F35D شام:</b>\n"
+        for i, res in enumerate(dinner, start=1):
+            status = "\U00002705" if res["is_delivered"] else "\U0001F551"
+            message += f"{i}. کد تغذیه: {res['feeding_code']} - غذا: {dish_catalog.name(res['dish_id'])} - {status}\n"
+        message += "\n"
+    
+    message += "برای تایید تحویل یک غذا، پیام جدیدی فرستاده و کد تغذیه دانشجو را وارد کنید."
+    
+    await edit_message_text(
+        query,
+        message,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
+        ])
+    )
+
+async def search_by_feeding_code(update: Update, context: CallbackContext) -> None:
+    """درخواست کد تغذیه برای جستجو"""
+    query = update.callback_query
+    await edit_message_text(
+        query,
+        "<b>\U0001F50D جستجو با کد تغذیه:</b>\n\n"
+        "لطفاً کد تغذیه دانشجوی مورد نظر را وارد کنید:",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
+        ])
+    )
+
+async def confirm_delivery(update: Update, context: CallbackContext, reservation_id: int) -> None:
+    """تایید تحویل غذای یک رزرو"""
+    if not is_owner(update.effective_chat.id):
         return
     
-    # پردازش تایید تحویل غذا
-    if query.data.startswith("confirm_delivery_"):
-        reservation_id = int(query.data.split("_")[2])
-        
-        # به‌روزرسانی وضعیت تحویل رزرو
+    query = update.callback_query
+    
+    # به‌روزرسانی وضعیت تحویل رزرو
+    try:
         reservation = db_session.query(Reservation).filter_by(id=reservation_id).first()
-        if reservation:
+        if reservation and not reservation.is_delivered:
             reservation.is_delivered = True
             reservation.delivery_time = datetime.datetime.now()
+            kitchen_counters.add(db_session, reservation.reservation_date, reservation.meal_type, delivered=1)
             db_session.commit()
-            
-            await query.edit_message_text(
-                "\U00002705 تحویل غذا با موفقیت تایید شد.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت تحویل", callback_data="admin_delivery_management")]
-                ])
-            )
-        else:
-            await query.edit_message_text(
-                "\U0001F6AB خطا: رزرو مورد نظر یافت نشد.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
-                ])
-            )
-        return
-
-async def reserve_all_meals(update: Update, context: CallbackContext, selected_day: str) -> None:
-    """رزرو تمام وعده‌های یک روز"""
-    user_id = str(update.effective_user.id)
-    if user_id not in students:
-        await update.callback_query.edit_message_text(
-            "\U0001F6AB لطفاً ابتدا کد تغذیه خود را ثبت کنید.",
+    except Exception as e:
+        if not is_db_unavailable(e):
+            raise
+        # تایید تحویل در دفتر محلی ذخیره و پس از برقراری دیتابیس اعمال می‌شود
+        reset_db_session()
+        await write_journal.append(KIND_DELIVER, reservation_id=reservation_id)
+        await edit_message_text(
+            query,
+            "\U00002705 تحویل غذا ثبت شد.\n\n"
+            "\U0001F551 به دلیل قطع موقت ارتباط با دیتابیس، تایید تحویل پس از برقراری ارتباط ثبت نهایی می‌شود.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
-                [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
+                [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت تحویل", callback_data="admin_delivery_management")]
             ])
         )
         return
     
-    feeding_code = students[user_id]
-    student = db_session.query(Student).filter_by(feeding_code=feeding_code).first()
+    if reservation:
+        session_router.mark_write(update.effective_user.id)
+        
+        # رسید تحویل به صورت پیامک در پس‌زمینه ارسال می‌شود
+        send_delivery_receipt({
+            "student_id": reservation.student_id,
+            "day": reservation.day,
+            "meal_type": reservation.meal_type,
+            "food": dish_catalog.name(reservation.dish_id),
+        })
+        
+        await edit_message_text(
+            query,
+            "\U00002705 تحویل غذا با موفقیت تایید شد.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت تحویل", callback_data="admin_delivery_management")]
+            ])
+        )
+    else:
+        await edit_message_text(
+            query,
+            "\U0001F6AB خطا: رزرو مورد نظر یافت نشد.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_delivery_management")]
+            ])
+        )
+
+async def reserve_all_meals(update: Update, context: CallbackContext, selected_day: str) -> None:
+    """رزرو تمام وعده‌های یک روز (دکمه‌های قدیمی بدون تاریخ؛ نزدیک‌ترین روز آینده با این نام)"""
+    await reserve_all_meals_on(update, context, upcoming_date(selected_day))
+
+async def reserve_all_meals_on(update: Update, context: CallbackContext, reservation_date: datetime.date, menu_version: int = None) -> None:
+    """رزرو تمام وعده‌های یک تاریخ"""
+    if not jalali_calendar.is_bookable(reservation_date):
+        await send_expired_date_message(update, reservation_date)
+        return
     
-    if not student:
-        await update.callback_query.edit_message_text(
-            "\U0001F6AB خطا در پیدا کردن اطلاعات شما. لطفاً دوباره کد تغذیه خود را ثبت کنید.",
+    selected_day = weekday_name(reservation_date)
+    if menu_version is not None and menu_version != menu_store.day_version(selected_day):
+        await show_date_menu(update, context, reservation_date, MENU_CHANGED_NOTICE)
+        return
+    user_id = update.effective_user.id
+    if user_id not in students:
+        await edit_message_text(
+            update.callback_query,
+            "\U0001F6AB لطفاً ابتدا کد تغذیه خود را ثبت کنید.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
                 [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
@@ -816,40 +1337,92 @@ async def reserve_all_meals(update: Update, context: CallbackContext, selected_d
         )
         return
     
-    # دریافت اطلاعات منوی روز
-    meals = menu_data[selected_day]
-    
-    # ایجاد رزرو برای هر سه وعده
-    for meal_type, food in meals.items():
-        # بررسی اینکه آیا رزروی مشابه قبلاً ثبت شده است
-        existing_reservation = db_session.query(Reservation).filter_by(
-            student_id=student.id,
-            day=selected_day,
-            meal_type=meal_type
-        ).first()
+    feeding_code = students[user_id]
+    try:
+        student = db_session.query(Student).filter_by(feeding_code=feeding_code).first()
         
-        if existing_reservation:
-            # به‌روزرسانی رزرو موجود
-            existing_reservation.food = food
-        else:
-            # ایجاد رزرو جدید
-            reservation = Reservation(
-                student_id=student.id,
-                day=selected_day,
-                meal_type=meal_type,
-                food=food
+        if not student:
+            await edit_message_text(
+                update.callback_query,
+                "\U0001F6AB خطا در پیدا کردن اطلاعات شما. لطفاً دوباره کد تغذیه خود را ثبت کنید.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
+                    [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
+                ])
             )
-            db_session.add(reservation)
+            return
+        
+        # دریافت اطلاعات منوی روز
+        meals = menu_store.meals(selected_day)
+        
+        if reservation_pipeline.running:
+            # حالت ثبت گروهی: درخواست‌ها در صف قرار می‌گیرند و پس از commit گروهی نتیجه برمی‌گردد
+            results = await asyncio.gather(*(
+                reservation_pipeline.submit(student.id, selected_day, reservation_date, meal_type, dish_id)
+                for meal_type, dish_id in meals.items()
+            ))
+            sold_out_meals = [
+                meal_type for meal_type, result in zip(meals.keys(), results) if result == RESULT_SOLD_OUT
+            ]
+        else:
+            # ایجاد رزرو برای هر سه وعده
+            sold_out_meals = []
+            for meal_type, dish_id in meals.items():
+                # بررسی اینکه آیا رزروی مشابه قبلاً ثبت شده است
+                existing_reservation = db_session.query(Reservation).filter(
+                    Reservation.student_id == student.id,
+                    Reservation.on_date(reservation_date),
+                    Reservation.meal_type == meal_type
+                ).first()
+            
+                if existing_reservation:
+                    # به‌روزرسانی رزرو موجود
+                    existing_reservation.dish_id = dish_id
+                elif not capacity_manager.try_reserve(db_session, selected_day, meal_type):
+                    # ظرفیت این وعده تکمیل شده است
+                    sold_out_meals.append(meal_type)
+                else:
+                    # ایجاد رزرو جدید
+                    reservation = Reservation(
+                        student_id=student.id,
+                        day=selected_day,
+                        reservation_date=reservation_date,
+                        meal_type=meal_type,
+                        dish_id=dish_id
+                    )
+                    db_session.add(reservation)
+                    kitchen_counters.add(db_session, reservation_date, meal_type, reserved=1)
+            
+            try:
+                db_session.commit()
+            except Exception as e:
+                db_session.rollback()
+                logger.error(f"خطا در ثبت رزرو: {e}")
+                raise
+    except Exception as e:
+        if not is_db_unavailable(e):
+            raise
+        # رزرو در دفتر محلی ذخیره و پس از برقراری دیتابیس ثبت می‌شود
+        await journal_reservations(update, feeding_code, selected_day, reservation_date, menu_store.meals(selected_day))
+        return
     
-    db_session.commit()
+    # خواندن‌های بعدی این کاربر از دیتابیس اصلی انجام می‌شود تا رزرو جدید را ببیند
+    session_router.mark_write(user_id)
     
     # نمایش پیام موفقیت‌آمیز
     persian_day = persian_days[selected_day]
-    await update.callback_query.edit_message_text(
-        f"<b>\U00002705 رزرو شما برای تمام وعده‌های روز {persian_day} با موفقیت ثبت شد:</b>\n\n"
-        f"\U0001F374 صبحانه: {meals['breakfast']}\n"
-        f"\U0001F35C ناهار: {meals['lunch']}\n"
-        f"\U0001F35D شام: {meals['dinner']}\n",
+    reserved_lines = "".join(
+        f"\U0001F374 {persian_meals.get(meal_type, meal_type)}: {dish_catalog.name(dish_id)}\n"
+        for meal_type, dish_id in meals.items() if meal_type not in sold_out_meals
+    )
+    sold_out_lines = "".join(
+        f"\U0001F6AB {persian_meals.get(meal_type, meal_type)}: ظرفیت تکمیل شده است\n"
+        for meal_type in sold_out_meals
+    )
+    await edit_message_text(
+        update.callback_query,
+        f"<b>\U00002705 رزرو شما برای وعده‌های روز {persian_day} ({jalali_label(reservation_date)}) ثبت شد:</b>\n\n"
+        f"{reserved_lines}{sold_out_lines}",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("\U0001F4C5 مشاهده رزروها", callback_data="show_reservations")],
@@ -857,11 +1430,69 @@ async def reserve_all_meals(update: Update, context: CallbackContext, selected_d
         ])
     )
 
+async def journal_reservations(update: Update, feeding_code: str, selected_day: str, reservation_date: datetime.date, meals: dict) -> None:
+    """ذخیره رزروها در دفتر محلی هنگام قطع دیتابیس و اطلاع به کاربر"""
+    reset_db_session()
+    for meal_type, dish_id in meals.items():
+        await write_journal.append(
+            KIND_RESERVE, feeding_code=feeding_code, day=selected_day,
+            reservation_date=reservation_date.isoformat(), meal_type=meal_type, dish_id=dish_id
+        )
+    
+    meal_lines = "".join(
+        f"\U0001F374 {persian_meals.get(meal_type, meal_type)}: {dish_catalog.name(dish_id)}\n" for meal_type, dish_id in meals.items()
+    )
+    await edit_message_text(
+        update.callback_query,
+        f"<b>\U0001F551 رزرو شما برای روز {persian_days[selected_day]} ({jalali_label(reservation_date)}) دریافت شد:</b>\n\n"
+        f"{meal_lines}\n"
+        "به دلیل قطع موقت ارتباط با دیتابیس، رزرو پس از برقراری ارتباط ثبت نهایی می‌شود.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
+        ])
+    )
+
+async def send_sold_out_message(update: Update, selected_day: str, selected_meal: str) -> None:
+    """اعلام تکمیل ظرفیت یک وعده"""
+    await edit_message_text(
+        update.callback_query,
+        f"\U0001F6AB ظرفیت وعده {persian_meals[selected_meal]} روز {persian_days[selected_day]} تکمیل شده است.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت به روزها", callback_data="view_menu")]
+        ])
+    )
+
+async def send_expired_date_message(update: Update, reservation_date: datetime.date) -> None:
+    """اعلام خارج بودن تاریخ از بازه رزرو (مثلاً دکمه پیامی که روز آن گذشته است)"""
+    await edit_message_text(
+        update.callback_query,
+        f"\U0001F6AB رزرو برای تاریخ {jalali_label(reservation_date)} امکان‌پذیر نیست. لطفاً دوباره روز مورد نظر را انتخاب کنید.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\U0001F519 بازگشت به روزها", callback_data="view_menu")]
+        ])
+    )
+
 async def reserve_meal(update: Update, context: CallbackContext, selected_day: str, selected_meal: str) -> None:
-    """رزرو یک وعده غذایی خاص"""
-    user_id = str(update.effective_user.id)
+    """رزرو یک وعده غذایی خاص (دکمه‌های قدیمی بدون تاریخ؛ نزدیک‌ترین روز آینده با این نام)"""
+    await reserve_meal_on(update, context, upcoming_date(selected_day), selected_meal)
+
+async def reserve_meal_on(update: Update, context: CallbackContext, reservation_date: datetime.date, selected_meal: str, menu_version: int = None) -> None:
+    """رزرو یک وعده غذایی خاص در یک تاریخ"""
+    if not jalali_calendar.is_bookable(reservation_date):
+        await send_expired_date_message(update, reservation_date)
+        return
+    
+    selected_day = weekday_name(reservation_date)
+    # غذای این وعده پس از نمایش منو تغییر کرده است؛ منوی جدید دوباره نمایش داده می‌شود
+    if menu_version is not None and menu_version != menu_store.item_version(selected_day, selected_meal):
+        await show_date_menu(update, context, reservation_date, MENU_CHANGED_NOTICE)
+        return
+    user_id = update.effective_user.id
+    
     if user_id not in students:
-        await update.callback_query.edit_message_text(
+        await edit_message_text(
+            update.callback_query,
             "\U0001F6AB لطفاً ابتدا کد تغذیه خود را ثبت کنید.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
@@ -871,50 +1502,83 @@ async def reserve_meal(update: Update, context: CallbackContext, selected_day: s
         return
     
     feeding_code = students[user_id]
-    student = db_session.query(Student).filter_by(feeding_code=feeding_code).first()
-    
-    if not student:
-        await update.callback_query.edit_message_text(
-            "\U0001F6AB خطا در پیدا کردن اطلاعات شما. لطفاً دوباره کد تغذیه خود را ثبت کنید.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
-                [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
-            ])
-        )
+    try:
+        student = db_session.query(Student).filter_by(feeding_code=feeding_code).first()
+        
+        if not student:
+            await edit_message_text(
+                update.callback_query,
+                "\U0001F6AB خطا در پیدا کردن اطلاعات شما. لطفاً دوباره کد تغذیه خود را ثبت کنید.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("\U0001F4DD ثبت کد تغذیه", callback_data="register")],
+                    [InlineKeyboardButton("\U0001F519 بازگشت به منوی اصلی", callback_data="back_to_menu")]
+                ])
+            )
+            return
+        
+        # دریافت اطلاعات غذا
+        dish_id = menu_store.dish_id(selected_day, selected_meal)
+        
+        if reservation_pipeline.running:
+            # حالت ثبت گروهی: پاسخ پس از commit تراکنش گروهی داده می‌شود
+            result = await reservation_pipeline.submit(student.id, selected_day, reservation_date, selected_meal, dish_id)
+            if result == RESULT_SOLD_OUT:
+                await send_sold_out_message(update, selected_day, selected_meal)
+                return
+        else:
+            # بررسی اینکه آیا رزروی مشابه قبلاً ثبت شده است
+            existing_reservation = db_session.query(Reservation).filter(
+                Reservation.student_id == student.id,
+                Reservation.on_date(reservation_date),
+                Reservation.meal_type == selected_meal
+            ).first()
+            
+            if existing_reservation:
+                # به‌روزرسانی رزرو موجود
+                existing_reservation.dish_id = dish_id
+            else:
+                # گرفتن سهم از ظرفیت در همان تراکنش ثبت رزرو؛ تغییر غذای رزرو موجود ظرفیتی نمی‌گیرد
+                # و حتی در وعده تکمیل شده مجاز است
+                if not capacity_manager.try_reserve(db_session, selected_day, selected_meal):
+                    db_session.rollback()
+                    await send_sold_out_message(update, selected_day, selected_meal)
+                    return
+            
+                # ایجاد رزرو جدید
+                reservation = Reservation(
+                    student_id=student.id,
+                    day=selected_day,
+                    reservation_date=reservation_date,
+                    meal_type=selected_meal,
+                    dish_id=dish_id
+                )
+                db_session.add(reservation)
+                kitchen_counters.add(db_session, reservation_date, selected_meal, reserved=1)
+            
+            try:
+                db_session.commit()
+            except Exception as e:
+                db_session.rollback()
+                logger.error(f"خطا در ثبت رزرو: {e}")
+                raise
+    except Exception as e:
+        if not is_db_unavailable(e):
+            raise
+        # رزرو در دفتر محلی ذخیره و پس از برقراری دیتابیس ثبت می‌شود
+        await journal_reservations(update, feeding_code, selected_day, reservation_date, {selected_meal: menu_store.dish_id(selected_day, selected_meal)})
         return
     
-    # دریافت اطلاعات غذا
-    food = menu_data[selected_day][selected_meal]
-    
-    # بررسی اینکه آیا رزروی مشابه قبلاً ثبت شده است
-    existing_reservation = db_session.query(Reservation).filter_by(
-        student_id=student.id,
-        day=selected_day,
-        meal_type=selected_meal
-    ).first()
-    
-    if existing_reservation:
-        # به‌روزرسانی رزرو موجود
-        existing_reservation.food = food
-    else:
-        # ایجاد رزرو جدید
-        reservation = Reservation(
-            student_id=student.id,
-            day=selected_day,
-            meal_type=selected_meal,
-            food=food
-        )
-        db_session.add(reservation)
-    
-    db_session.commit()
+    # خواندن‌های بعدی این کاربر از دیتابیس اصلی انجام می‌شود تا رزرو جدید را ببیند
+    session_router.mark_write(user_id)
     
     # نمایش پیام موفقیت‌آمیز
     persian_day = persian_days[selected_day]
     persian_meal = persian_meals[selected_meal]
     
-    await update.callback_query.edit_message_text(
-        f"<b>\U00002705 رزرو شما برای وعده {persian_meal} روز {persian_day} با موفقیت ثبت شد:</b>\n\n"
-        f"\U0001F374 غذا: {food}\n",
+    await edit_message_text(
+        update.callback_query,
+        f"<b>\U00002705 رزرو شما برای وعده {persian_meal} روز {persian_day} ({jalali_label(reservation_date)}) با موفقیت ثبت شد:</b>\n\n"
+        f"\U0001F374 غذا: {dish_catalog.name(dish_id)}\n",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("\U0001F4C5 مشاهده رزروها", callback_data="show_reservations")],
@@ -936,6 +1600,36 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     user_message = update.message.text.strip()
     
+    # پردازش ظرفیت وارد شده توسط مدیر (پیش از جستجوی کد تغذیه که آن هم عددی است)
+    if context.user_data.get('state') == EDIT_MEAL_CAPACITY and is_owner(user_id):
+        if not user_message.isdigit():
+            await update.message.reply_text("\U0001F6AB ظرفیت باید یک عدد باشد. لطفاً دوباره وارد کنید.")
+            return
+        
+        day = context.user_data.get('edit_day')
+        meal = context.user_data.get('edit_meal')
+        capacity = int(user_message)
+        try:
+            capacity_manager.set_capacity(db_session, day, meal, capacity)
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"خطا در تعیین ظرفیت: {e}")
+            await update.message.reply_text("\U0001F6AB خطا در تعیین ظرفیت.")
+            return
+        
+        context.user_data.pop('state', None)
+        context.user_data.pop('edit_day', None)
+        context.user_data.pop('edit_meal', None)
+        
+        capacity_label = capacity if capacity else "نامحدود"
+        await update.message.reply_text(
+            f"\U00002705 ظرفیت وعده {persian_meals[meal]} روز {persian_days[day]} به {capacity_label} تغییر کرد.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت منو", callback_data="admin_menu_management")]
+            ])
+        )
+        return
+    
     # پردازش کد تغذیه برای مدیران (برای مشاهده و تایید تحویل غذا)
     if is_owner(user_id) and user_message.isdigit():
         feeding_code = user_message
@@ -950,8 +1644,10 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
             )
             return
         
-        # دریافت رزروهای دانشجو
-        reservations = db_session.query(Reservation).filter_by(student_id=student.id).all()
+        # دریافت رزروهای امروز و روزهای آینده دانشجو
+        reservations = db_session.query(Reservation).filter(
+            Reservation.student_id == student.id, Reservation.upcoming()
+        ).order_by(Reservation.reservation_date, Reservation.id).all()
         
         if not reservations:
             await update.message.reply_text(
@@ -962,19 +1658,17 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
             )
             return
         
-        # گروه‌بندی رزروها بر اساس روز
-        reservations_by_day = {}
+        # گروه‌بندی رزروها بر اساس تاریخ
+        reservations_by_date = {}
         for reservation in reservations:
-            if reservation.day not in reservations_by_day:
-                reservations_by_day[reservation.day] = []
-            reservations_by_day[reservation.day].append(reservation)
+            reservations_by_date.setdefault(reservation.reservation_date, []).append(reservation)
         
         # نمایش رزروها به همراه دکمه‌های تایید تحویل
         message = f"<b>\U0001F4C5 رزروهای دانشجو با کد تغذیه {feeding_code}:</b>\n\n"
         
-        for day, day_reservations in reservations_by_day.items():
-            persian_day = persian_days.get(day, day)
-            message += f"<b>\U0001F4C6 روز {persian_day}:</b>\n"
+        for reservation_date, day_reservations in reservations_by_date.items():
+            persian_day = persian_days.get(weekday_name(reservation_date))
+            message += f"<b>\U0001F4C6 روز {persian_day} ({jalali_label(reservation_date)}):</b>\n"
             
             keyboard = []
             for reservation in day_reservations:
@@ -984,14 +1678,14 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
                 if reservation.delivery_time:
                     delivery_time = f" (زمان تحویل: {reservation.delivery_time.strftime('%H:%M:%S')})"
                 
-                message += f"  \U0001F374 {persian_meal}: {reservation.food} - {status}{delivery_time}\n"
+                message += f"  \U0001F374 {persian_meal}: {dish_catalog.name(reservation.dish_id)} - {status}{delivery_time}\n"
                 
                 # اضافه کردن دکمه تایید تحویل فقط برای غذاهای تحویل نشده
                 if not reservation.is_delivered:
                     keyboard.append([
                         InlineKeyboardButton(
                             f"\U00002705 تایید تحویل {persian_meal}",
-                            callback_data=f"confirm_delivery_{reservation.id}"
+                            callback_data=callback_router.encode("confirm_delivery", reservation.id)
                         )
                     ])
             
@@ -1002,22 +1696,28 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
                 meal_texts = []
                 for r in day_reservations:
                     status = "✅ تحویل شده" if r.is_delivered else "🕑 در انتظار تحویل"
-                    meal_text = f"  🍴 {persian_meals.get(r.meal_type, r.meal_type)}: {r.food} - {status}"
+                    meal_text = f"  🍴 {persian_meals.get(r.meal_type, r.meal_type)}: {dish_catalog.name(r.dish_id)} - {status}"
                     meal_texts.append(meal_text)
                 
-                await update.message.reply_text(
-                    f"<b>📆 روز {persian_day}:</b>\n\n" + 
-                    "\n".join(meal_texts),
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                # ارسال از طریق صف تا محدودیت یک پیام در ثانیه برای هر چت رعایت شود
+                day_text = f"<b>📆 روز {persian_day} ({jalali_label(reservation_date)}):</b>\n\n" + "\n".join(meal_texts)
+                day_markup = InlineKeyboardMarkup(keyboard)
+                await send_queue.submit(
+                    update.effective_chat.id,
+                    lambda: update.message.reply_text(day_text, parse_mode="HTML", reply_markup=day_markup),
+                    PRIORITY_INTERACTIVE
                 )
         
         # ارسال پیام نهایی با دکمه بازگشت
-        await update.message.reply_text(
-            "لطفاً از دکمه‌های بالا برای تایید تحویل استفاده کنید.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت تحویل", callback_data="admin_delivery_management")]
-            ])
+        await send_queue.submit(
+            update.effective_chat.id,
+            lambda: update.message.reply_text(
+                "لطفاً از دکمه‌های بالا برای تایید تحویل استفاده کنید.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت تحویل", callback_data="admin_delivery_management")]
+                ])
+            ),
+            PRIORITY_INTERACTIVE
         )
         return
     
@@ -1031,17 +1731,16 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
             meal = context.user_data['edit_meal']
             new_food = user_message
             
-            # به‌روزرسانی منو در دیتابیس
-            menu_item = db_session.query(Menu).filter_by(day=day).first()
-            if menu_item:
-                meal_data = menu_item.meal_data
-                meal_data[meal] = new_food
-                menu_item.meal_data = meal_data
-                db_session.commit()
-                
-                # به‌روزرسانی کش منو
-                menu_data[day][meal] = new_food
-                
+            # به‌روزرسانی همان وعده در دیتابیس با نسخه جدید منو (غذای جدید در صورت نبود به جدول غذاها اضافه می‌شود)
+            try:
+                menu_store.set_dish(db_session, day, meal, dish_catalog.id_for(new_food))
+                updated = True
+            except Exception as e:
+                db_session.rollback()
+                logger.error(f"خطا در به‌روزرسانی منو: {e}")
+                updated = False
+            
+            if updated:
                 await update.message.reply_text(
                     f"<b>\U00002705 منوی غذا با موفقیت به‌روزرسانی شد:</b>\n\n"
                     f"\U0001F4C6 روز: {persian_days[day]}\n"
@@ -1049,6 +1748,7 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
                     f"\U0001F35D غذای جدید: {new_food}",
                     parse_mode="HTML",
                     reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("\U0001F4E2 اطلاع‌رسانی به دانشجویان", callback_data=callback_router.encode("broadcast_menu", day))],
                         [InlineKeyboardButton("\U0001F519 بازگشت به مدیریت منو", callback_data="admin_menu_management")]
                     ])
                 )
@@ -1090,19 +1790,86 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
         ])
     )
 
-async def main() -> None:
-    """شروع ربات."""
-    # دریافت توکن ربات از متغیرهای محیطی
-    token = os.environ.get("TELEGRAM_TOKEN")
-    if not token:
-        logger.error("توکن ربات تلگرام مشخص نشده است. لطفاً در فایل .env آن را تنظیم کنید.")
+# فیلدهای نوع‌دار داده‌های کالبک
+DAY = ChoiceField(persian_days.keys())
+MEAL = ChoiceField(persian_meals.keys())
+RESERVATION_ID = IntField()
+DATE = DateField()
+MENU_VERSION = IntField()
+EXPORT_FORMAT = ChoiceField(FORMATS)
+
+# جدول مسیریابی کالبک‌ها
+callback_router.add("back_to_menu", main_menu)
+callback_router.add("view_menu", view_menu)
+callback_router.add("register", register_callback)
+callback_router.add("show_reservations", show_reservations)
+callback_router.add("reservation_history", show_reservation_history)
+callback_router.add("help", help_command)
+callback_router.add("admin_panel", admin_panel)
+callback_router.add("admin_menu_management", admin_menu_management)
+callback_router.add("admin_users_list", admin_users_list)
+callback_router.add("admin_backup", admin_backup_callback)
+callback_router.add("admin_delivery_management", admin_delivery_management)
+callback_router.add("admin_clear_reservations", admin_clear_reservations)
+callback_router.add("confirm_clear_reservations", confirm_clear_reservations)
+callback_router.add("admin_reminder_broadcast", admin_reminder_broadcast)
+callback_router.add("search_by_feeding_code", search_by_feeding_code)
+callback_router.add("admin_write_journal", admin_write_journal)
+callback_router.add("admin_kitchen", admin_kitchen_dashboard)
+callback_router.add("admin_export", admin_export)
+callback_router.add("export", export_callback, DATE, DATE, EXPORT_FORMAT)
+callback_router.add("broadcast_menu", broadcast_menu_change, DAY)
+callback_router.add("day", show_day_menu, DAY)
+callback_router.add("reserve", reserve_meal, DAY, MEAL)
+callback_router.add("reserve_all", reserve_all_meals, DAY)
+callback_router.add("date", show_date_menu, DATE)
+callback_router.add("reserve_on", reserve_meal_on, DATE, MEAL, MENU_VERSION)
+callback_router.add("reserve_all_on", reserve_all_meals_on, DATE, MENU_VERSION)
+callback_router.add("edit_menu", edit_menu_day, DAY)
+callback_router.add("edit_meal", edit_meal_food, DAY, MEAL)
+callback_router.add("edit_capacity", edit_meal_capacity, DAY, MEAL)
+callback_router.add("delivery_day", delivery_day_roster, DAY)
+callback_router.add("confirm_delivery", confirm_delivery, RESERVATION_ID)
+
+# داده‌های کالبک با قالب قدیمی (دکمه‌های پیام‌هایی که پیش از این ارسال شده‌اند)
+callback_router.add_legacy("broadcast_menu_", "broadcast_menu")
+callback_router.add_legacy("day_", "day")
+callback_router.add_legacy("reserve_all_", "reserve_all")
+callback_router.add_legacy("reserve_", "reserve")
+callback_router.add_legacy("edit_menu_", "edit_menu")
+callback_router.add_legacy("edit_meal_", "edit_meal")
+callback_router.add_legacy("edit_capacity_", "edit_capacity")
+callback_router.add_legacy("delivery_day_", "delivery_day")
+callback_router.add_legacy("confirm_delivery_", "confirm_delivery")
+
+async def error_handler(update: object, context: CallbackContext) -> None:
+    """اعلام حالت فقط‌خواندنی به کاربر در صورت قطع دیتابیس به جای بی‌پاسخ ماندن آپدیت"""
+    if not is_db_unavailable(context.error):
+        logger.error(f"خطا در پردازش آپدیت: {context.error}", exc_info=context.error)
         return
     
-    # نمایش وضعیت اتصال ربات
-    logger.info(f"در حال شروع ربات با توکن: {token[:5]}...{token[-5:]}")
+    # نشست مشترک پس از خطای اتصال باید بازنشانی شود
+    reset_db_session()
     
-    # ایجاد درخواست‌کننده با تنظیمات مناسب
-    application = Application.builder().token(token).build()
+    if not isinstance(update, Update):
+        return
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("\U0001F4D6 مشاهده منو", callback_data="view_menu")],
+        [InlineKeyboardButton("\U0001F4D1 منوی اصلی", callback_data="back_to_menu")]
+    ])
+    try:
+        if update.callback_query:
+            await edit_message_text(update.callback_query, DB_UNAVAILABLE_MESSAGE, reply_markup=reply_markup)
+        elif update.effective_message:
+            await update.effective_message.reply_text(DB_UNAVAILABLE_MESSAGE, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"خطا در ارسال پیام حالت فقط‌خواندنی: {e}")
+
+def build_application(token, owns=None):
+    """ساخت Application با تمام مدیریت‌کننده‌ها (برای هر دوره رهبری یک نمونه جدید ساخته می‌شود)"""
+    # وضعیت مکالمه‌ها و user_data در Postgres نگهداری می‌شود تا با راه‌اندازی مجدد از بین نرود
+    persistence = create_persistence(db_session.get_bind(), owns=owns)
+    application = Application.builder().token(token).persistence(persistence).build()
     
     # اضافه کردن مدیریت‌کننده مکالمه برای ثبت نام و عملیات مدیریتی
     conv_handler = ConversationHandler(
@@ -1116,37 +1883,173 @@ async def main() -> None:
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         allow_reentry=True,
+        name="main_conversation",
+        persistent=True,
+        # پایان خودکار مکالمه‌های رها شده (فقط در صورت وجود JobQueue؛ در غیر این صورت state_sweeper آن‌ها را پاک می‌کند)
+        conversation_timeout=STATE_TTL if application.job_queue else None,
     )
+    state_sweeper.register(conv_handler)
     
     # اضافه کردن مدیریت‌کننده‌ها
+    # ثبت زمان آخرین فعالیت هر کاربر پیش از سایر مدیریت‌کننده‌ها
+    application.add_handler(TypeHandler(Update, state_sweeper.touch), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("menu", menu_command))
     application.add_handler(CommandHandler("reservations", reservations_command))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_error_handler(error_handler)
+    return application
+
+async def run_as_leader(token, leader):
+    """اجرای ربات تا زمانی که این پردازش رهبر است"""
+    # کارهای سراسری فقط در پردازش رهبر اجرا می‌شوند (نه در هر worker یا پردازش shard)
+    # کارگر ارسال پیامک (در صورت تنظیم SMS_TRANSPORT)؛ پیامک‌های پردازش‌های shard هم به همین کارگر می‌رسند
+    await sms_worker.start(db_session.get_bind(), transport_from_env())
+    
+    # اعمال نوشتن‌هایی که در زمان قطع دیتابیس در دفتر محلی ذخیره شده‌اند
+    await write_journal.start(db_session.get_bind(), on_delivered=send_delivery_receipt)
+    
+    # تغییر روزانه رزروهای فعال، ساخت پارتیشن هفته‌های آینده و بایگانی هفته‌های گذشته
+    await weekly_rollover.start(db_session.get_bind())
+    
+    # هم‌خوان کردن دوره‌ای شمارنده‌های داشبورد آشپزخانه با جدول رزروها
+    await kitchen_counters.start(db_session.get_bind())
+    
+    # تهیه روزانه فایل‌های تحلیلی هفته‌های بسته شده از replica (در صورت تنظیم ANALYTICS_DIR)
+    await analytics_snapshots.start(session_router.read_engine)
+    
+    if SHARD_WORKERS:
+        # پردازش رهبر فقط آپدیت‌ها را دریافت و بر اساس شناسه کاربر بین پردازش‌ها تقسیم می‌کند
+        # محدودیت سراسری ارسال تلگرام بین رهبر و پردازش‌ها تقسیم می‌شود
+        send_queue.set_share(SHARD_WORKERS + 1)
+        shard_pool = create_shard_pool()
+        application = Application.builder().token(token).build()
+        application.add_handler(TypeHandler(Update, shard_pool.dispatch))
+        await shard_pool.start(token, on_sms=sms_worker.enqueue)
+    else:
+        shard_pool = None
+        application = build_application(token)
     
     # شروع ربات
     await application.initialize()
     await application.start()
     await application.updater.start_polling()
     
+    # ادامه پیام‌های همگانی نیمه‌تمام
+    await resume_broadcasts(application.bot, db_session.get_bind())
+    
+    # پاک‌سازی دوره‌ای وضعیت کاربران بی‌فعالیت
+    if shard_pool is None:
+        await state_sweeper.start(application)
+    
     logger.info("ربات شروع به کار کرد و آماده پاسخگویی است!")
     
-    # ربات را در حالت اجرا نگه می‌داریم تا بتواند به پیام‌ها پاسخ دهد
     try:
-        # به جای توقف، ربات را در حالت اجرا نگه میداریم
+        # ربات تا زمان از دست رفتن قفل رهبری در حال اجرا می‌ماند
+        await leader.wait_lost()
+    finally:
+        await state_sweeper.stop()
+        await stop_broadcasts()
+        await stop_clear()
+        await stop_kitchen_live()
+        await application.updater.stop()
+        await application.stop()
+        if shard_pool is not None:
+            await shard_pool.stop()
+            send_queue.set_share(1)
+        await analytics_snapshots.stop()
+        await kitchen_counters.stop()
+        await weekly_rollover.stop()
+        await write_journal.stop()
+        await sms_worker.stop()
+        
+        # ذخیره آخرین وضعیت مکالمه‌ها در دیتابیس
+        await application.shutdown()
+
+async def run_shard_worker(token, updates, owns, sms_outbox):
+    """اجرای یکی از پردازش‌های پردازش‌کننده آپدیت‌ها (بدون دریافت مستقیم از تلگرام)
+
+    کارهای سراسری (پیامک، اعمال دفتر نوشتن‌ها، تغییر هفته و آشپزخانه) فقط در رهبر اجرا می‌شوند؛
+    پیامک‌ها از طریق sms_outbox به رهبر فرستاده می‌شوند.
+    """
+    application = build_application(token, owns=owns)
+    await application.initialize()
+    await application.start()
+    
+    send_queue.set_share(SHARD_WORKERS + 1)
+    await send_queue.start()
+    sms_worker.forward_to(sms_outbox)
+    if RESERVATION_COALESCING:
+        await reservation_pipeline.start(db_session.get_bind())
+    await menu_store.start(db_session.get_bind())
+    await capacity_manager.start(db_session.get_bind())
+    await state_sweeper.start(application)
+    
+    try:
+        # آپدیت‌ها به ترتیب رسیدن در صف Application قرار می‌گیرند و پشت سر هم پردازش می‌شوند
+        async for data in read_updates(updates):
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await state_sweeper.stop()
+        await stop_clear()
+        await stop_kitchen_live()
+        await capacity_manager.stop()
+        await menu_store.stop()
+        await reservation_pipeline.stop()
+        await send_queue.stop()
+        await application.stop()
+        await application.shutdown()
+
+async def main() -> None:
+    """شروع ربات."""
+    # دریافت توکن ربات از متغیرهای محیطی
+    token = os.environ.get("TELEGRAM_TOKEN")
+    if not token:
+        logger.error("توکن ربات تلگرام مشخص نشده است. لطفاً در فایل .env آن را تنظیم کنید.")
+        return
+    
+    # نمایش وضعیت اتصال ربات
+    logger.info(f"در حال شروع ربات با توکن: {token[:5]}...{token[-5:]}")
+    
+    # شروع صف مرکزی ارسال پیام‌ها
+    await send_queue.start()
+    
+    # شروع ثبت گروهی رزروها (در صورت فعال بودن RESERVATION_COALESCING)
+    if RESERVATION_COALESCING:
+        await reservation_pipeline.start(db_session.get_bind())
+    
+    # بارگذاری دوباره منو در صورت ویرایش آن در پردازش دیگر
+    await menu_store.start(db_session.get_bind())
+    
+    # بارگذاری دوباره ظرفیت‌ها برای نمایش تغییرات ظرفیت در پردازش‌های دیگر
+    await capacity_manager.start(db_session.get_bind())
+    
+    # با چند پردازش (worker) فقط پردازشی که قفل رهبری را دارد پیام‌ها را از تلگرام دریافت می‌کند
+    leader = create_leader_elector(db_session.get_bind())
+    try:
         while True:
-            await asyncio.sleep(3600)  # هر ساعت یکبار چک می‌کنیم
-            logger.info("ربات همچنان در حال اجراست...")
-    except (KeyboardInterrupt, SystemExit):
+            await leader.acquire()
+            try:
+                await run_as_leader(token, leader)
+            except Exception as e:
+                # قفل آزاد می‌شود تا پردازش دیگری (یا همین پردازش در تلاش بعد) رهبر شود
+                logger.error(f"خطا در اجرای ربات: {e}")
+                await leader.release()
+                await asyncio.sleep(leader.interval)
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
         # در صورت درخواست توقف توسط کاربر
         logger.info("در حال متوقف کردن ربات...")
-        
-    # این خطوط فقط در صورت توقف ربات اجرا می‌شوند
-    await application.updater.stop()
-    await application.stop()
+    finally:
+        # این خطوط فقط در صورت توقف ربات اجرا می‌شوند
+        await leader.release()
+        await capacity_manager.stop()
+        await menu_store.stop()
+        await reservation_pipeline.stop()
+        await send_queue.stop()
 
 if __name__ == "__main__":
     try:
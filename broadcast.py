@@ -0,0 +1,182 @@
+import asyncio
+import datetime
+import logging
+from sqlalchemy import and_, exists
+from sqlalchemy.orm import sessionmaker
+from models import Broadcast, Reservation, Student
+from sms import sms_worker
+from send_queue import send_queue, PRIORITY_BULK, PRIORITY_INTERACTIVE
+from metrics import register_collector
+from week_calendar import upcoming_date
+
+logger = logging.getLogger(__name__)
+
+# انواع پیام همگانی
+KIND_MENU_CHANGE = "menu_change"
+KIND_REMINDER = "reminder"
+
+# تعداد دانشجویانی که در هر مرحله از دیتابیس خوانده و ارسال می‌شوند
+BATCH_SIZE = 500
+
+# وظایف در حال اجرا (شناسه پیام همگانی ← task)
+_running = {}
+
+
+def tomorrow():
+    """تاریخ فردا (تاریخ هدف یادآوری رزرو)"""
+    return datetime.date.today() + datetime.timedelta(days=1)
+
+def _target_query(session, kind, reservation_date):
+    """کوئری دانشجویان هدف؛ برای یادآوری فقط کسانی که برای آن تاریخ رزروی ندارند (anti-join)"""
+    query = session.query(Student.id, Student.user_id, Student.phone).filter(Student.user_id.isnot(None))
+    if kind == KIND_REMINDER:
+        query = query.filter(~exists().where(and_(
+            Reservation.student_id == Student.id,
+            Reservation.on_date(reservation_date)
+        )))
+    return query
+
+def _fetch_batch(Session, kind, reservation_date, after_id):
+    """خواندن دسته بعدی دانشجویان بر اساس کلید (keyset) تا پیشرفت کار قابل ادامه باشد"""
+    session = Session()
+    try:
+        return (
+            _target_query(session, kind, reservation_date)
+            .filter(Student.id > after_id)
+            .order_by(Student.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+    finally:
+        session.close()
+
+def _save_progress(Session, broadcast_id, last_student_id, sent, failed, done=False):
+    """ذخیره پیشرفت پیام همگانی در دیتابیس"""
+    session = Session()
+    try:
+        broadcast = session.get(Broadcast, broadcast_id)
+        broadcast.last_student_id = last_student_id
+        broadcast.sent = sent
+        broadcast.failed = failed
+        if done:
+            broadcast.status = "done"
+            broadcast.finished_at = datetime.datetime.now()
+        session.commit()
+    finally:
+        session.close()
+
+def _create_broadcast(Session, kind, message, day, reservation_date, requested_by):
+    session = Session()
+    try:
+        broadcast = Broadcast(
+            kind=kind, message=message, day=day, reservation_date=reservation_date, requested_by=requested_by
+        )
+        session.add(broadcast)
+        session.commit()
+        return broadcast.id
+    finally:
+        session.close()
+
+def _pending_broadcasts(Session):
+    session = Session()
+    try:
+        return [
+            # یادآوری‌های ثبت شده پیش از ستون reservation_date تاریخ را از نام روز می‌گیرند
+            (b.id, b.kind, b.reservation_date or (upcoming_date(b.day) if b.day else None),
+             b.message, b.requested_by, b.last_student_id, b.sent, b.failed)
+            for b in session.query(Broadcast).filter_by(status="running").all()
+        ]
+    finally:
+        session.close()
+
+async def _send_one(bot, chat_id, message):
+    try:
+        await send_queue.submit(
+            chat_id,
+            lambda: bot.send_message(chat_id=chat_id, text=message),
+            PRIORITY_BULK
+        )
+        return True
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # کاربرانی که ربات را مسدود کرده‌اند یا چت آن‌ها در دسترس نیست
+        logger.info(f"ارسال پیام همگانی به {chat_id} ناموفق بود: {e}")
+        return False
+
+async def _run_broadcast(bot, Session, broadcast_id, kind, reservation_date, message, requested_by,
+                         last_student_id=0, sent=0, failed=0):
+    try:
+        while True:
+            rows = await asyncio.to_thread(_fetch_batch, Session, kind, reservation_date, last_student_id)
+            if not rows:
+                break
+
+            targets = [user_id for _, user_id, _ in rows]
+
+            # یادآوری رزرو برای دانشجویانی که شماره تلفن دارند به صورت پیامک هم ارسال می‌شود
+            if kind == KIND_REMINDER:
+                for _, _, phone in rows:
+                    if phone:
+                        sms_worker.enqueue(message, phone=phone)
+
+            results = await asyncio.gather(*(_send_one(bot, chat_id, message) for chat_id in targets))
+            sent += sum(1 for ok in results if ok)
+            failed += sum(1 for ok in results if not ok)
+            last_student_id = rows[-1][0]
+
+            await asyncio.to_thread(_save_progress, Session, broadcast_id, last_student_id, sent, failed)
+
+        await asyncio.to_thread(_save_progress, Session, broadcast_id, last_student_id, sent, failed, True)
+        logger.info(f"پیام همگانی {broadcast_id} پایان یافت: {sent} موفق، {failed} ناموفق")
+
+        if requested_by:
+            await send_queue.send_message(
+                bot,
+                chat_id=requested_by,
+                text=f"\U0001F4E2 ارسال پیام همگانی به پایان رسید.\n\n"
+                     f"\U00002705 ارسال موفق: {sent}\n"
+                     f"\U0001F6AB ارسال ناموفق: {failed}",
+                priority=PRIORITY_INTERACTIVE
+            )
+    except asyncio.CancelledError:
+        # پیشرفت ذخیره شده است و پس از راه‌اندازی مجدد ادامه می‌یابد
+        raise
+    except Exception as e:
+        logger.error(f"خطا در ارسال پیام همگانی {broadcast_id}: {e}")
+    finally:
+        _running.pop(broadcast_id, None)
+
+def _spawn(bot, Session, *args, **kwargs):
+    broadcast_id = args[0]
+    if broadcast_id in _running:
+        return
+    _running[broadcast_id] = asyncio.create_task(_run_broadcast(bot, Session, *args, **kwargs))
+
+async def start_broadcast(bot, engine, kind, message, day=None, reservation_date=None, requested_by=None):
+    """ثبت و شروع یک پیام همگانی در پس‌زمینه؛ یادآوری همیشه همان reservation_date را هدف می‌گیرد"""
+    Session = sessionmaker(bind=engine)
+    broadcast_id = await asyncio.to_thread(
+        _create_broadcast, Session, kind, message, day, reservation_date, requested_by
+    )
+    _spawn(bot, Session, broadcast_id, kind, reservation_date, message, requested_by)
+    return broadcast_id
+
+async def resume_broadcasts(bot, engine):
+    """ادامه پیام‌های همگانی نیمه‌تمام پس از راه‌اندازی مجدد"""
+    Session = sessionmaker(bind=engine)
+    for broadcast_id, kind, reservation_date, message, requested_by, last_id, sent, failed in \
+            await asyncio.to_thread(_pending_broadcasts, Session):
+        logger.info(f"ادامه پیام همگانی {broadcast_id} از دانشجوی {last_id}")
+        _spawn(bot, Session, broadcast_id, kind, reservation_date, message, requested_by,
+               last_student_id=last_id, sent=sent, failed=failed)
+
+async def stop_broadcasts():
+    """توقف وظایف در حال اجرا؛ پیشرفت ذخیره شده باقی می‌ماند"""
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+register_collector("broadcast", lambda: {"running": len(_running)})
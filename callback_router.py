@@ -0,0 +1,169 @@
+import datetime
+import logging
+import time
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# حداکثر طول داده کالبک در تلگرام (بایت)
+MAX_CALLBACK_BYTES = 64
+
+# جداکننده بخش‌های داده کالبک؛ در نام روزها و وعده‌ها استفاده نمی‌شود
+SEPARATOR = "|"
+
+
+class IntField:
+    """فیلد عددی در داده کالبک"""
+
+    def encode(self, value):
+        return str(int(value))
+
+    def decode(self, token):
+        return int(token)
+
+
+class DateField:
+    """فیلد تاریخ در داده کالبک (به صورت شماره روز میلادی)"""
+
+    def encode(self, value):
+        return str(value.toordinal())
+
+    def decode(self, token):
+        return datetime.date.fromordinal(int(token))
+
+
+class ChoiceField:
+    """فیلد انتخابی که به صورت شماره در داده کالبک ذخیره می‌شود"""
+
+    def __init__(self, values):
+        self.values = list(values)
+        self._index = {value: i for i, value in enumerate(self.values)}
+
+    def encode(self, value):
+        return str(self._index[value])
+
+    def decode(self, token):
+        # داده‌های قدیمی نام کامل را دارند، داده‌های جدید شماره را
+        if token in self._index:
+            return token
+        return self.values[int(token)]
+
+
+class CallbackRouter:
+    """جدول مسیریابی کالبک‌ها با داده‌های نوع‌دار و فشرده و ارسال در زمان ثابت"""
+
+    def __init__(self):
+        self._routes = {}
+        self._legacy = []
+        self._hooks = []
+
+    def add(self, name, handler, *fields):
+        """ثبت یک مسیر؛ handler با (update, context, *مقادیر فیلدها) فراخوانی می‌شود"""
+        if SEPARATOR in name:
+            raise ValueError(f"نام مسیر نباید شامل {SEPARATOR} باشد: {name}")
+        self._routes[name] = (handler, fields)
+
+    def add_legacy(self, prefix, name):
+        """پشتیبانی از داده‌های قدیمی با قالب prefix_arg1_arg2 (برای پیام‌هایی که قبلاً ارسال شده‌اند)"""
+        self._legacy.append((prefix, name))
+        self._legacy.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def add_hook(self, hook):
+        """ثبت تابعی که پس از هر ارسال با (نام مسیر، مدت زمان، خطا) فراخوانی می‌شود"""
+        self._hooks.append(hook)
+
+    def encode(self, name, *values):
+        """ساخت داده کالبک برای یک مسیر"""
+        handler, fields = self._routes[name]
+        if len(values) != len(fields):
+            raise ValueError(f"مسیر {name} به {len(fields)} مقدار نیاز دارد")
+        data = SEPARATOR.join([name] + [field.encode(value) for field, value in zip(fields, values)])
+        if len(data.encode('utf-8')) > MAX_CALLBACK_BYTES:
+            raise ValueError(f"داده کالبک بیش از {MAX_CALLBACK_BYTES} بایت است: {data}")
+        return data
+
+    def decode(self, data):
+        """تبدیل داده کالبک به (نام مسیر، مقادیر)؛ در صورت نامعتبر بودن None برمی‌گرداند"""
+        parts = data.split(SEPARATOR)
+        route = self._routes.get(parts[0])
+        tokens = parts[1:]
+
+        if route is None or (not tokens and route[1]):
+            name, tokens = self._decode_legacy(data)
+            if name is None:
+                return None
+            route = self._routes[name]
+        else:
+            name = parts[0]
+
+        fields = route[1]
+        if len(tokens) != len(fields):
+            return None
+        try:
+            return name, [field.decode(token) for field, token in zip(fields, tokens)]
+        except (ValueError, IndexError, KeyError):
+            return None
+
+    def _decode_legacy(self, data):
+        for prefix, name in self._legacy:
+            if data.startswith(prefix):
+                return name, data[len(prefix):].split("_")
+        return None, None
+
+    async def dispatch(self, update, context):
+        """ارسال کالبک به handler ثبت شده؛ اگر مسیری پیدا نشود False برمی‌گرداند"""
+        decoded = self.decode(update.callback_query.data)
+        if decoded is None:
+            logger.warning(f"داده کالبک ناشناخته: {update.callback_query.data}")
+            return False
+
+        name, values = decoded
+        handler = self._routes[name][0]
+        started = time.perf_counter()
+        error = None
+        try:
+            await handler(update, context, *values)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            for hook in self._hooks:
+                try:
+                    hook(name, elapsed, error)
+                except Exception:
+                    pass
+        return True
+
+
+class RouteLatency:
+    """جمع‌آوری تعداد، مجموع و بیشینه زمان اجرای هر مسیر"""
+
+    def __init__(self):
+        self._stats = {}
+
+    def __call__(self, name, elapsed, error):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if error is not None:
+            stats[3] += 1
+
+    def metrics(self):
+        values = {}
+        for name, (count, total, maximum, errors) in self._stats.items():
+            values[f"{name}_count"] = count
+            values[f"{name}_seconds_sum"] = total
+            values[f"{name}_seconds_max"] = maximum
+            values[f"{name}_errors_total"] = errors
+        return values
+
+
+# مسیریاب مشترک کالبک‌ها به همراه زمان‌سنجی هر مسیر
+callback_router = CallbackRouter()
+route_latency = RouteLatency()
+callback_router.add_hook(route_latency)
+register_collector("callback_route", route_latency.metrics)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from models import MealCapacity, Reservation
+from metrics import register_collector
+from week_calendar import upcoming_date
+
+logger = logging.getLogger(__name__)
+
+# فاصله بارگذاری دوباره ظرفیت‌ها برای دیدن تغییرات پردازش‌های دیگر (ثانیه)
+POLL_INTERVAL = 10
+
+# کلید قفل مشورتی تغییر روزانه رزروها؛ هم‌خوان کردن شمارنده‌های ظرفیت هم زیر همین قفل انجام می‌شود
+# تا دو پردازش هم‌زمان شمارنده‌ها را بازنویسی نکنند
+ROLLOVER_LOCK_KEY = 7301946583
+
+# گرفتن یک سهم با یک دستور: UPDATE شرطی روی سطر ظرفیت؛ وعده‌ای که سطر ظرفیت ندارد بدون محدودیت است
+RESERVE_SQL = text("""
+    WITH updated AS (
+        UPDATE meal_capacity SET reserved = reserved + 1
+        WHERE day = :day AND meal_type = :meal_type AND reserved < capacity
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM updated)
+        OR NOT EXISTS (SELECT 1 FROM meal_capacity WHERE day = :day AND meal_type = :meal_type)
+""")
+
+
+class CapacityManager:
+    """مدیریت ظرفیت وعده‌ها با شمارنده اتمیک در دیتابیس
+
+    هر رزرو با یک UPDATE شرطی در دیتابیس سهم می‌گیرد، پس نتیجه به کش هیچ پردازشی
+    وابسته نیست (تغییر ظرفیت در یک shard بلافاصله در همه پردازش‌ها اعمال می‌شود).
+    کش حافظه فقط برای نمایش ظرفیت و برچسب «تکمیل ظرفیت» است و هر POLL_INTERVAL ثانیه
+    دوباره از دیتابیس خوانده می‌شود.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._Session = None
+        self._task = None
+        self._limited = {}  # (روز، وعده) ← ظرفیت
+        self._sold_out = set()
+        self.rejected_total = 0
+
+    def load(self, session):
+        """بارگذاری ظرفیت‌ها از دیتابیس به کش"""
+        limited = {}
+        sold_out = set()
+        for row in session.query(MealCapacity).all():
+            limited[(row.day, row.meal_type)] = row.capacity
+            if row.reserved >= row.capacity:
+                sold_out.add((row.day, row.meal_type))
+        self._limited = limited
+        self._sold_out = sold_out
+
+    def capacity(self, day, meal_type):
+        return self._limited.get((day, meal_type))
+
+    def is_sold_out(self, day, meal_type):
+        """برچسب نمایشی تکمیل ظرفیت (ممکن است تا POLL_INTERVAL ثانیه قدیمی باشد)"""
+        return (day, meal_type) in self._sold_out
+
+    def try_reserve(self, session, day, meal_type):
+        """گرفتن یک سهم از ظرفیت؛ باید در همان تراکنشی که رزرو ثبت می‌شود فراخوانی شود"""
+        key = (day, meal_type)
+        if session.execute(RESERVE_SQL, {"day": day, "meal_type": meal_type}).scalar():
+            return True
+        self._sold_out.add(key)
+        self.rejected_total += 1
+        return False
+
+    def release(self, session, day, meal_type):
+        """آزاد کردن یک سهم از ظرفیت (مثلاً پس از خطا در ثبت رزرو)"""
+        key = (day, meal_type)
+        session.query(MealCapacity).filter(
+            MealCapacity.day == day,
+            MealCapacity.meal_type == meal_type,
+            MealCapacity.reserved > 0
+        ).update({MealCapacity.reserved: MealCapacity.reserved - 1}, synchronize_session=False)
+        self._sold_out.discard(key)
+
+    def set_capacity(self, session, day, meal_type, capacity):
+        """تعیین ظرفیت یک وعده؛ مقدار صفر یا None یعنی بدون محدودیت"""
+        if not capacity:
+            session.query(MealCapacity).filter_by(day=day, meal_type=meal_type).delete(synchronize_session=False)
+            session.commit()
+            self.load(session)
+            return
+
+        def count_reserved():
+            return session.query(func.count(Reservation.id)).filter(
+                Reservation.on_date(upcoming_date(day)), Reservation.meal_type == meal_type
+            ).scalar()
+
+        if session.query(MealCapacity.id).filter_by(day=day, meal_type=meal_type).first() is None:
+            # سطر جدید ابتدا ثبت می‌شود تا رزروهای بعدی شمارنده را افزایش دهند (و پشت قفل سطر منتظر بمانند)
+            session.execute(insert(MealCapacity).values(
+                day=day, meal_type=meal_type, capacity=capacity, reserved=count_reserved()
+            ).on_conflict_do_nothing(index_elements=["day", "meal_type"]))
+            session.commit()
+
+        # قفل سطر پیش از شمارش: رزروهایی که شمارنده را افزایش داده‌اند پیش از گرفتن قفل commit شده‌اند
+        # و در شمارش دیده می‌شوند، و رزروهای بعدی تا پایان این تراکنش منتظر می‌مانند
+        row = session.query(MealCapacity).filter_by(day=day, meal_type=meal_type).with_for_update().one()
+        row.capacity = capacity
+        row.reserved = count_reserved()
+        session.commit()
+        self.load(session)
+
+    def reset(self, session):
+        """صفر کردن شمارنده‌ها پس از حذف همه رزروها؛ در همان تراکنش حذف فراخوانی شود"""
+        session.query(MealCapacity).update({MealCapacity.reserved: 0}, synchronize_session=False)
+        self._sold_out.clear()
+
+    def reconcile(self, session):
+        """هم‌خوان کردن شمارنده‌ها با تعداد واقعی رزروهای امروز و روزهای آینده (روزانه پس از گذشت هر روز اجرا می‌شود)"""
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ROLLOVER_LOCK_KEY})
+        # قفل سطرهای ظرفیت پیش از شمارش تا افزایش‌های هم‌زمان (try_reserve) بازنویسی نشوند
+        rows = session.query(MealCapacity).order_by(MealCapacity.id).with_for_update().all()
+        counts = dict(
+            ((day, meal_type), count)
+            for day, meal_type, count in session.query(
+                Reservation.day, Reservation.meal_type, func.count(Reservation.id)
+            ).filter(Reservation.upcoming()).group_by(Reservation.day, Reservation.meal_type).all()
+        )
+        for row in rows:
+            actual = counts.get((row.day, row.meal_type), 0)
+            if row.reserved != actual:
+                logger.warning(f"اصلاح شمارنده ظرفیت {row.day}/{row.meal_type}: {row.reserved} ← {actual}")
+                row.reserved = actual
+        session.commit()
+        self.load(session)
+
+    def _reload(self):
+        session = self._Session()
+        try:
+            self.load(session)
+        finally:
+            session.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self._reload)
+            except Exception as e:
+                logger.error(f"خطا در بارگذاری ظرفیت وعده‌ها: {e}")
+
+    async def start(self, engine):
+        self._Session = sessionmaker(bind=engine)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self):
+        return {
+            "limited_meals": len(self._limited),
+            "sold_out_meals": len(self._sold_out),
+            "rejected_total": self.rejected_total,
+        }
+
+
+# مدیر مشترک ظرفیت‌ها
+capacity_manager = CapacityManager()
+register_collector("meal_capacity", capacity_manager.metrics)
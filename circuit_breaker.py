@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# تعداد خطاهای اتصال پشت سر هم که پس از آن مدار باز می‌شود
+FAILURE_THRESHOLD = 3
+
+# مدت زمانی (ثانیه) که مدار باز می‌ماند تا دوباره اتصال به دیتابیس امتحان شود
+RESET_TIMEOUT = 15
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """دیتابیس در دسترس نیست و درخواست بدون تلاش برای اتصال رد شد"""
+
+
+def is_db_unavailable(error):
+    """آیا خطا نشان‌دهنده در دسترس نبودن دیتابیس است"""
+    if isinstance(error, (CircuitOpenError, OperationalError, InterfaceError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class CircuitBreaker:
+    """قطع سریع دسترسی به دیتابیس پس از چند خطای اتصال پشت سر هم
+
+    در حالت باز، هر کوئری ORM نشست‌های متصل شده پیش از گرفتن اتصال با CircuitOpenError
+    رد می‌شود تا هر آپدیت منتظر timeout اتصال نماند. پس از RESET_TIMEOUT ثانیه فقط یک
+    کوئری آزمایشی اجازه می‌گیرد؛ موفقیت آن مدار را می‌بندد و شکست آن دوباره بازش می‌کند.
+    اگر نتیجه کوئری آزمایشی تا RESET_TIMEOUT ثانیه ثبت نشود، کوئری آزمایشی دیگری اجازه می‌گیرد.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+        # متریک‌ها
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    @property
+    def is_open(self):
+        """آیا دیتابیس در دسترس نیست (بدون تغییر وضعیت؛ تا موفقیت کوئری آزمایشی باز حساب می‌شود)"""
+        return self.state != STATE_CLOSED
+
+    def allow(self):
+        """آیا کوئری اجازه اجرا دارد؛ در حالت نیمه‌باز فقط یک کوئری آزمایشی اجازه می‌گیرد"""
+        if self.state == STATE_CLOSED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = STATE_HALF_OPEN
+                logger.info("تلاش دوباره برای اتصال به دیتابیس")
+            elif now - self._probe_at < self.reset_timeout:
+                # کوئری آزمایشی قبلی هنوز نتیجه‌ای ثبت نکرده است
+                return False
+            self._probe_at = now
+            return True
+
+    def check(self):
+        """رد سریع درخواست در صورت باز بودن مدار"""
+        if not self.allow():
+            self.rejected_total += 1
+            raise CircuitOpenError("دیتابیس موقتاً در دسترس نیست")
+
+    def record_success(self):
+        if self.state == STATE_CLOSED and not self._failures:
+            return
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                logger.info("اتصال به دیتابیس برقرار شد؛ خروج از حالت فقط‌خواندنی")
+            self.state = STATE_CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self._failures >= self.failure_threshold):
+                self.state = STATE_OPEN
+                self._opened_at = time.monotonic()
+                self.opened_total += 1
+                logger.error(f"دیتابیس در دسترس نیست؛ ربات به مدت {self.reset_timeout} ثانیه در حالت فقط‌خواندنی کار می‌کند")
+
+    def attach(self, engine, *sessions):
+        """ثبت نتیجه هر کوئری روی engine و رد سریع کوئری‌های ORM نشست‌های sessions در حالت باز
+
+        sessions نشست یا sessionmaker هستند؛ نشست‌های دیگر (replica، بایگانی، دفتر نوشتن‌ها)
+        رد نمی‌شوند ولی نتیجه کوئری‌هایشان روی engine همچنان ثبت می‌شود.
+        """
+        @event.listens_for(engine, "handle_error")
+        def _handle_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.record_failure()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after_execute(conn, cursor, statement, parameters, context, executemany):
+            self.record_success()
+
+        def _before_orm_execute(orm_execute_state):
+            self.check()
+
+        def _before_flush(session, flush_context, instances):
+            self.check()
+
+        for target in sessions:
+            event.listen(target, "do_orm_execute", _before_orm_execute)
+            event.listen(target, "before_flush", _before_flush)
+
+    def metrics(self):
+        return {
+            "open": int(self.state == STATE_OPEN),
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+# قطع‌کننده مشترک دسترسی به دیتابیس اصلی
+db_breaker = CircuitBreaker()
+register_collector("db_breaker", db_breaker.metrics)
@@ -0,0 +1,93 @@
+import logging
+import os
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# آدرس دیتابیس replica (اختیاری)؛ در صورت خالی بودن همه خواندن‌ها از دیتابیس اصلی انجام می‌شود
+REPLICA_DATABASE_URL = os.environ.get("REPLICA_DATABASE_URL")
+
+# مدت زمانی (ثانیه) پس از نوشتن که خواندن‌های همان کاربر از دیتابیس اصلی انجام می‌شود تا تاخیر replica دیده نشود
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+
+# کلید نوشتن‌هایی که روی همه کاربران اثر دارند (مثلاً حذف تمام رزروها)
+ALL_USERS = "*"
+
+
+class SessionRouter:
+    """ارسال خواندن‌های فقط‌خواندنی به replica و بازگرداندن خواندن‌های پس از نوشتن به دیتابیس اصلی"""
+
+    def __init__(self, primary_engine, replica_url=REPLICA_DATABASE_URL, window=READ_YOUR_WRITES_SECONDS):
+        self.window = window
+        self.PrimarySession = sessionmaker(bind=primary_engine)
+        if replica_url:
+            self.ReplicaSession = sessionmaker(bind=create_engine(replica_url, pool_pre_ping=True))
+        else:
+            self.ReplicaSession = None
+        self._last_write = {}
+
+        # متریک‌ها
+        self.replica_reads_total = 0
+        self.primary_reads_total = 0
+        self.writes_total = 0
+
+    @property
+    def has_replica(self):
+        return self.ReplicaSession is not None
+
+    @property
+    def read_engine(self):
+        """موتور خواندن‌های سنگین پس‌زمینه (replica در صورت وجود)"""
+        return (self.ReplicaSession or self.PrimarySession).kw["bind"]
+
+    def mark_write(self, key=ALL_USERS):
+        """ثبت زمان نوشتن یک کاربر (شناسه کاربر تلگرام) تا خواندن‌های بعدی او از دیتابیس اصلی باشد"""
+        now = time.monotonic()
+        self._last_write[str(key)] = now
+        self.writes_total += 1
+
+        # حذف کلیدهایی که از پنجره گذشته‌اند
+        if len(self._last_write) > 10000:
+            self._last_write = {
+                written_key: written_at for written_key, written_at in self._last_write.items()
+                if now - written_at < self.window
+            }
+
+    def prefers_primary(self, key=None):
+        """آیا خواندن این کاربر باید از دیتابیس اصلی انجام شود"""
+        if not self.has_replica:
+            return True
+        now = time.monotonic()
+        for written_key in (ALL_USERS, str(key)):
+            written_at = self._last_write.get(written_key)
+            if written_at is not None and now - written_at < self.window:
+                return True
+        return False
+
+    def read_session(self, key=None):
+        """ساخت نشست خواندن برای یک کاربر؛ فراخواننده باید آن را close کند"""
+        if self.prefers_primary(key):
+            self.primary_reads_total += 1
+            return self.PrimarySession()
+        self.replica_reads_total += 1
+        return self.ReplicaSession()
+
+    def metrics(self):
+        return {
+            "replica_enabled": int(self.has_replica),
+            "replica_reads_total": self.replica_reads_total,
+            "primary_reads_total": self.primary_reads_total,
+            "writes_total": self.writes_total,
+        }
+
+
+def create_session_router(primary_engine):
+    """ساخت مسیریاب نشست‌ها و ثبت متریک‌های آن"""
+    router = SessionRouter(primary_engine)
+    register_collector("db_routing", router.metrics)
+    if router.has_replica:
+        logger.info("خواندن‌های فقط‌خواندنی از دیتابیس replica انجام می‌شوند")
+    return router
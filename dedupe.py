@@ -0,0 +1,81 @@
+import asyncio
+from metrics import register_collector
+
+
+class CallbackDeduplicator:
+    """حذف کلیک‌های تکراری؛ فقط کلیکی که هنگام اجرای کلیک قبلی همان دکمه از همان پیام برسد تکراری است
+
+    پس از پایان کلیک، کلیک بعدی (مثلاً دکمه به‌روزرسانی) دوباره اجرا می‌شود.
+    """
+
+    def __init__(self):
+        self._entries = {}  # (کاربر، پیام) ← (داده کالبک، future)
+        self.handled_total = 0
+        self.duplicates_total = 0
+
+    async def run(self, user_id, message_id, data, handler):
+        """اجرای handler برای کلیک جدید؛ کلیک تکراری منتظر کلیک در حال اجرا می‌ماند و False برمی‌گرداند"""
+        key = (user_id, message_id)
+        entry = self._entries.get(key)
+        if entry and entry[0] == data:
+            self.duplicates_total += 1
+            # پیوستن به کلیک در حال اجرا بدون اجرای دوباره
+            await asyncio.wait([entry[1]])
+            return False
+
+        future = asyncio.ensure_future(handler())
+        entry = (data, future)
+        self._entries[key] = entry
+        self.handled_total += 1
+        try:
+            await future
+        finally:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        return True
+
+    def metrics(self):
+        return {
+            "handled_total": self.handled_total,
+            "duplicates_total": self.duplicates_total,
+            "tracked": len(self._entries),
+        }
+
+
+class SingleFlight:
+    """اشتراک نتیجه بین فراخوانی‌های هم‌زمان یکسان؛ فقط یک فراخوانی واقعی انجام می‌شود"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls_total = 0
+        self.shared_total = 0
+
+    async def do(self, key, fn):
+        """fn تابعی بدون آرگومان است که awaitable برمی‌گرداند"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared_total += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(fn())
+        self._inflight[key] = future
+        self.calls_total += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def metrics(self):
+        return {
+            "calls_total": self.calls_total,
+            "shared_total": self.shared_total,
+            "inflight": len(self._inflight),
+        }
+
+
+# نمونه‌های مشترک برای کل ربات
+callback_deduplicator = CallbackDeduplicator()
+single_flight = SingleFlight()
+register_collector("callback_dedupe", callback_deduplicator.metrics)
+register_collector("single_flight", single_flight.metrics)
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import threading
+from sqlalchemy.orm import sessionmaker
+from models import Dish, dish_id_for
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# نام نمایشی غذایی که شناسه آن پیدا نشد
+UNKNOWN_DISH = "نامشخص"
+
+
+class DishCatalog:
+    """نگاشت حافظه‌ای شناسه غذا به نام آن
+
+    منوها، رزروها و گزارش‌ها فقط با شناسه عددی غذا کار می‌کنند و نام فقط هنگام نمایش از
+    این نگاشت خوانده می‌شود. همه غذاها هنگام شروع بارگذاری می‌شوند و غذای جدیدی که پردازش
+    دیگری ساخته باشد با بارگذاری دوباره منو (ensure) اضافه می‌شود. name در حلقه رویداد هیچ‌گاه
+    کوئری اجرا نمی‌کند؛ در صورت نبود شناسه، نگاشت در پس‌زمینه دوباره بارگذاری می‌شود.
+    """
+
+    def __init__(self):
+        self._Session = None
+        self._names = {}
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._refresh = None
+
+        # متریک‌ها
+        self.misses = 0
+
+    def attach(self, engine):
+        self._Session = sessionmaker(bind=engine)
+        self.load()
+
+    def load(self):
+        """بارگذاری همه غذاها از دیتابیس"""
+        session = self._Session()
+        try:
+            rows = session.query(Dish.id, Dish.name).all()
+        finally:
+            session.close()
+        with self._lock:
+            self._names = dict(rows)
+            self._ids = {name: dish_id for dish_id, name in rows}
+
+    def ensure(self, session, dish_ids):
+        """افزودن غذاهایی از dish_ids که در نگاشت نیستند (با نشست فراخواننده)"""
+        missing = set(dish_ids) - self._names.keys()
+        if not missing:
+            return
+        for dish_id, name in session.query(Dish.id, Dish.name).filter(Dish.id.in_(missing)):
+            self._remember(dish_id, name)
+
+    def _remember(self, dish_id, name):
+        with self._lock:
+            self._names[dish_id] = name
+            self._ids[name] = dish_id
+
+    def _lookup(self, dish_id):
+        session = self._Session()
+        try:
+            name = session.query(Dish.name).filter_by(id=dish_id).scalar()
+        finally:
+            session.close()
+        if name is None:
+            logger.warning(f"غذا با شناسه {dish_id} پیدا نشد")
+            return UNKNOWN_DISH
+        self._remember(dish_id, name)
+        return name
+
+    async def _reload(self):
+        try:
+            await asyncio.to_thread(self.load)
+        except Exception as e:
+            logger.error(f"خطا در بارگذاری دوباره غذاها: {e}")
+
+    def name(self, dish_id):
+        name = self._names.get(dish_id)
+        if name is not None:
+            return name
+
+        self.misses += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # خواندن‌هایی که در thread جداگانه اجرا می‌شوند می‌توانند مستقیماً از دیتابیس بخوانند
+            return self._lookup(dish_id)
+
+        # در حلقه رویداد کوئری اجرا نمی‌شود؛ نام تا پایان بارگذاری دوباره نامشخص نمایش داده می‌شود
+        if self._refresh is None or self._refresh.done():
+            self._refresh = loop.create_task(self._reload())
+        return UNKNOWN_DISH
+
+    def id_for(self, name):
+        """شناسه غذا با نام name؛ غذای جدید در تراکنش جداگانه ایجاد می‌شود"""
+        name = name.strip()
+        dish_id = self._ids.get(name)
+        if dish_id is not None:
+            return dish_id
+
+        session = self._Session()
+        try:
+            dish_id = dish_id_for(session, name)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self._remember(dish_id, name)
+        return dish_id
+
+    def metrics(self):
+        return {
+            "dishes": len(self._names),
+            "misses_total": self.misses,
+        }
+
+
+# نگاشت مشترک غذاها
+dish_catalog = DishCatalog()
+register_collector("dishes", dish_catalog.metrics)
@@ -0,0 +1,237 @@
+import datetime
+import logging
+import os
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+from sqlalchemy import text
+from rollover import ARCHIVE_SCHEMA
+from week_calendar import week_start
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# قالب‌های خروجی
+FORMAT_CSV = "csv"
+FORMAT_XLSX = "xlsx"
+FORMATS = (FORMAT_CSV, FORMAT_XLSX)
+
+# تعداد سطرهایی که در هر مرحله از cursor سمت سرور خوانده می‌شود (خروجی XLSX)
+FETCH_SIZE = 2000
+
+# ستون‌های خروجی (عنوان ستون در فایل)
+COLUMNS = [
+    "شناسه رزرو", "تاریخ", "روز", "وعده", "غذا", "کد تغذیه", "تحویل شده", "زمان تحویل", "زمان ثبت رزرو"
+]
+
+# نشانه UTF-8 در ابتدای CSV تا Excel متن فارسی را درست نمایش دهد
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# متریک‌ها
+_stats = {"exports_total": 0, "failed_total": 0, "bytes_total": 0}
+
+
+def _source_tables(connection, start, end):
+    """جدول رزروها به همراه پارتیشن‌های بایگانی شده هفته‌های بازه [start, end]"""
+    tables = ["reservations"]
+    archived = connection.execute(text("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = :schema AND column_name = 'dish_id' AND table_name LIKE 'reservations_w%'
+    """), {"schema": ARCHIVE_SCHEMA}).scalars().all()
+    for name in sorted(archived):
+        try:
+            week = datetime.datetime.strptime(name, "reservations_w%Y%m%d").date()
+        except ValueError:
+            # نسخه‌های پشتیبان حذف رزروها (reservations_w..._cleared_...) خروجی گرفته نمی‌شوند
+            continue
+        if week_start(start) <= week <= week_start(end):
+            tables.append(f"{ARCHIVE_SCHEMA}.{name}")
+    return tables
+
+def _export_query(tables):
+    """کوئری خروجی با پارامترهای psycopg2 (هم برای COPY و هم برای cursor سمت سرور)"""
+    source = "\nUNION ALL\n".join(
+        f"SELECT id, reservation_date, day, meal_type, dish_id, student_id, is_delivered, delivery_time, reservation_time "
+        f"FROM {table} WHERE week_start BETWEEN %(first_week)s AND %(last_week)s "
+        f"AND reservation_date BETWEEN %(start)s AND %(end)s"
+        for table in tables
+    )
+    return f"""
+        SELECT r.id, to_char(r.reservation_date, 'YYYY-MM-DD'), r.day, r.meal_type, d.name, s.feeding_code,
+               CASE WHEN r.is_delivered THEN 'بله' ELSE 'خیر' END,
+               to_char(r.delivery_time, 'YYYY-MM-DD HH24:MI:SS'),
+               to_char(r.reservation_time, 'YYYY-MM-DD HH24:MI:SS')
+        FROM ({source}) r
+        JOIN students s ON s.id = r.student_id
+        JOIN dishes d ON d.id = r.dish_id
+        ORDER BY r.reservation_date, r.id
+    """
+
+def _query_params(start, end):
+    return {"start": start, "end": end, "first_week": week_start(start), "last_week": week_start(end)}
+
+
+class _LineCounter:
+    """شمارش خطوطی که COPY در فایل می‌نویسد"""
+
+    def __init__(self, file):
+        self._file = file
+        self.lines = 0
+
+    def write(self, data):
+        self.lines += data.count(b"\n")
+        return self._file.write(data)
+
+
+def _copy_rows(cursor, counter):
+    """تعداد سطرهای COPY از وضعیت دستور (COPY n)؛ rowcount پس از copy_expert ممکن است -1 باشد
+
+    اگر وضعیت در دسترس نباشد تعداد خطوط نوشته شده برگردانده می‌شود.
+    """
+    status = (cursor.statusmessage or "").split()
+    if len(status) == 2 and status[0] == "COPY" and status[1].isdigit():
+        return int(status[1])
+    return counter.lines
+
+def _write_csv(connection, query, params, file):
+    """نوشتن مستقیم خروجی COPY TO STDOUT در فایل بدون ساختن سطرها در پایتون"""
+    # عنوان فارسی ستون‌ها به جای نام ستون‌های SQL که HEADER در COPY می‌نویسد
+    file.write(UTF8_BOM + (",".join(f'"{column}"' for column in COLUMNS) + "\n").encode("utf-8"))
+    cursor = connection.connection.cursor()
+    counter = _LineCounter(file)
+    try:
+        cursor.copy_expert(f"COPY ({cursor.mogrify(query, params).decode('utf-8')}) TO STDOUT WITH (FORMAT csv)", counter)
+        return _copy_rows(cursor, counter)
+    finally:
+        cursor.close()
+
+
+class XlsxStreamWriter:
+    """نوشتن فایل XLSX تک‌برگی به صورت جریانی (فقط کتابخانه استاندارد)
+
+    سطرها مستقیماً در فایل XML برگه داخل zip نوشته می‌شوند، پس حافظه مصرفی به تعداد
+    سطرها بستگی ندارد. مقادیر متنی به صورت inlineStr ذخیره می‌شوند و برگه راست‌به‌چپ است.
+    """
+
+    def __init__(self, file, sheet_name="reservations"):
+        self._zip = zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED)
+        self._sheet_name = sheet_name
+        self._sheet = None
+        self._row = 0
+
+    def __enter__(self):
+        self._zip.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ))
+        self._zip.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        self._zip.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(self._sheet_name)}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        self._zip.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ))
+        self._sheet = self._zip.open("xl/worksheets/sheet1.xml", "w", force_zip64=True)
+        self._write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetViews><sheetView rightToLeft="1" workbookViewId="0"/></sheetViews>'
+            '<sheetData>'
+        )
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if self._sheet is not None:
+                self._write('</sheetData></worksheet>')
+                self._sheet.close()
+        finally:
+            self._zip.close()
+
+    def _write(self, data):
+        self._sheet.write(data.encode("utf-8"))
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return "<c/>"
+        if isinstance(value, bool):
+            return f'<c t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c><v>{value}</v></c>'
+        return f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
+
+    def write_row(self, values):
+        self._row += 1
+        self._write(f'<row r="{self._row}">' + "".join(self._cell(value) for value in values) + '</row>')
+
+
+def _write_xlsx(connection, query, params, file):
+    """خواندن سطرها با cursor سمت سرور و نوشتن جریانی آن‌ها در XLSX"""
+    rows = 0
+    result = connection.execution_options(stream_results=True, max_row_buffer=FETCH_SIZE).exec_driver_sql(query, params)
+    with XlsxStreamWriter(file) as writer:
+        writer.write_row(COLUMNS)
+        for partition in result.partitions(FETCH_SIZE):
+            for row in partition:
+                writer.write_row(row)
+            rows += len(partition)
+    return rows
+
+
+def export_reservations(session, start, end, fmt=FORMAT_CSV):
+    """خروجی رزروها و تحویل‌های بازه [start, end] در یک فایل موقت
+
+    مسیر فایل و تعداد سطرها برگردانده می‌شود؛ فراخواننده پس از ارسال باید فایل را حذف کند.
+    session فقط خوانده می‌شود (می‌تواند نشست replica باشد) و فراخواننده باید آن را close کند.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"قالب خروجی نامعتبر است: {fmt}")
+
+    connection = session.connection()
+    query = _export_query(_source_tables(connection, start, end))
+    params = _query_params(start, end)
+
+    file = tempfile.NamedTemporaryFile(prefix="reservations_", suffix=f".{fmt}", delete=False)
+    try:
+        with file:
+            if fmt == FORMAT_CSV:
+                rows = _write_csv(connection, query, params, file)
+            else:
+                rows = _write_xlsx(connection, query, params, file)
+    except Exception:
+        _stats["failed_total"] += 1
+        os.remove(file.name)
+        raise
+
+    size = os.path.getsize(file.name)
+    _stats["exports_total"] += 1
+    _stats["bytes_total"] += size
+    logger.info(f"خروجی رزروها {start} تا {end} ({fmt}): {rows} سطر، {size} بایت")
+    return file.name, rows
+
+
+register_collector("export", lambda: dict(_stats))
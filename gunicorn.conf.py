@@ -1,13 +1,8 @@
-
 bind = "0.0.0.0:8080"
 workers = 1
-worker_class = "gthread"
-threads = 4
-timeout = 120
-keepalive = 5
-bind = "0.0.0.0:8080"
-workers = 1
-worker_class = "gthread"
-threads = 4
+# هر worker یک حلقه رویداد دارد که هم درخواست‌های HTTP و هم ربات را اجرا می‌کند؛
+# با چند worker قفل رهبری در Postgres تضمین می‌کند فقط یکی از آن‌ها پیام‌ها را از تلگرام دریافت کند
+wsgi_app = "main:create_app"
+worker_class = "aiohttp.GunicornWebWorker"
 timeout = 120
 keepalive = 5
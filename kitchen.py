@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import logging
+from sqlalchemy import func, case, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from models import MealCounter, Reservation
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# فاصله هم‌خوان کردن شمارنده‌ها با جدول رزروها (ثانیه)
+RECONCILE_INTERVAL = 900
+
+# کلید قفل مشورتی تا در هر نوبت فقط یک پردازش شمارنده‌ها را هم‌خوان کند
+RECONCILE_LOCK_KEY = 7301946584
+
+
+class KitchenCounters:
+    """شمارنده رزروها و تحویل‌های هر (تاریخ، وعده) برای داشبورد آشپزخانه
+
+    شمارنده‌ها با upsert افزایشی در همان تراکنش ثبت رزرو یا تحویل به‌روز می‌شوند، پس خواندن
+    داشبورد فقط چند سطر است. هم‌خوان کردن دوره‌ای، تغییراتی را که از مسیر شمارنده‌ها نگذشته‌اند
+    (مثلاً حذف دسته‌ای رزروها) اصلاح می‌کند.
+    """
+
+    def __init__(self, interval=RECONCILE_INTERVAL):
+        self.interval = interval
+        self._Session = None
+        self._task = None
+
+        # متریک‌ها
+        self.increments_total = 0
+        self.corrections_total = 0
+
+    def add(self, session, reservation_date, meal_type, reserved=0, delivered=0):
+        """افزایش شمارنده‌ها؛ باید در همان تراکنش ثبت رزرو یا تحویل فراخوانی شود"""
+        self.add_many(session, {(reservation_date, meal_type): (reserved, delivered)})
+
+    def add_many(self, session, increments):
+        """افزایش گروهی شمارنده‌ها ((تاریخ، وعده) ← (رزرو، تحویل)) با یک upsert"""
+        rows = [
+            {"reservation_date": reservation_date, "meal_type": meal_type, "reserved": reserved, "delivered": delivered}
+            for (reservation_date, meal_type), (reserved, delivered) in sorted(increments.items())
+            if reserved or delivered
+        ]
+        if not rows:
+            return
+        statement = insert(MealCounter).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["reservation_date", "meal_type"],
+            set_={
+                "reserved": MealCounter.reserved + statement.excluded.reserved,
+                "delivered": MealCounter.delivered + statement.excluded.delivered,
+            }
+        )
+        session.execute(statement)
+        self.increments_total += len(rows)
+
+    def reset(self, session):
+        """حذف همه شمارنده‌ها پس از حذف همه رزروها؛ در همان تراکنش حذف فراخوانی شود"""
+        session.query(MealCounter).delete(synchronize_session=False)
+
+    def on_date(self, session, reservation_date):
+        """شمارنده وعده‌های یک تاریخ (وعده ← (رزرو، تحویل))"""
+        return {
+            meal_type: (reserved, delivered)
+            for meal_type, reserved, delivered in session.query(
+                MealCounter.meal_type, MealCounter.reserved, MealCounter.delivered
+            ).filter(MealCounter.reservation_date == reservation_date)
+        }
+
+    def reconcile(self, session, today=None):
+        """هم‌خوان کردن شمارنده‌های امروز و روزهای آینده با تعداد واقعی رزروها"""
+        today = today or datetime.date.today()
+        # قفل شمارنده‌ها پیش از شمارش تا افزایش‌های هم‌زمان پس از اصلاح اعمال شوند
+        counters = {
+            (row.reservation_date, row.meal_type): row
+            for row in session.query(MealCounter).filter(MealCounter.reservation_date >= today).with_for_update()
+        }
+        actual = {
+            (reservation_date, meal_type): (reserved, delivered)
+            for reservation_date, meal_type, reserved, delivered in session.query(
+                Reservation.reservation_date, Reservation.meal_type,
+                func.count(Reservation.id), func.count(case((Reservation.is_delivered, 1)))
+            ).filter(Reservation.upcoming(today)).group_by(Reservation.reservation_date, Reservation.meal_type)
+        }
+        
+        corrections = []
+        for key in set(counters) | set(actual):
+            row = counters.get(key)
+            current = (row.reserved, row.delivered) if row is not None else (0, 0)
+            expected = actual.get(key, (0, 0))
+            if current != expected:
+                logger.warning(f"اصلاح شمارنده آشپزخانه {key[0]}/{key[1]}: {current[0]}/{current[1]} ← {expected[0]}/{expected[1]}")
+                corrections.append({
+                    "reservation_date": key[0], "meal_type": key[1], "reserved": expected[0], "delivered": expected[1]
+                })
+        if corrections:
+            statement = insert(MealCounter).values(corrections)
+            statement = statement.on_conflict_do_update(
+                index_elements=["reservation_date", "meal_type"],
+                set_={"reserved": statement.excluded.reserved, "delivered": statement.excluded.delivered}
+            )
+            session.execute(statement)
+        
+        # شمارنده روزهای گذشته دیگر خوانده نمی‌شوند
+        session.query(MealCounter).filter(MealCounter.reservation_date < today).delete(synchronize_session=False)
+        session.commit()
+        self.corrections_total += len(corrections)
+
+    def _reconcile(self):
+        session = self._Session()
+        try:
+            if session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": RECONCILE_LOCK_KEY}).scalar():
+                self.reconcile(session)
+            else:
+                session.rollback()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._reconcile)
+            except Exception as e:
+                logger.error(f"خطا در هم‌خوان کردن شمارنده‌های آشپزخانه: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self, engine):
+        self._Session = sessionmaker(bind=engine)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self):
+        return {
+            "increments_total": self.increments_total,
+            "corrections_total": self.corrections_total,
+        }
+
+
+# شمارنده‌های مشترک آشپزخانه
+kitchen_counters = KitchenCounters()
+register_collector("kitchen", kitchen_counters.metrics)
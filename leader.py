@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import text
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# کلید قفل مشورتی Postgres که فقط یک پردازش می‌تواند آن را نگه دارد
+LOCK_KEY = int(os.environ.get("LEADER_LOCK_KEY", "7301946582"))
+
+# فاصله تلاش برای گرفتن قفل و بررسی سلامت اتصال رهبر (ثانیه)
+CHECK_INTERVAL = 2
+
+
+class LeaderElector:
+    """انتخاب یک پردازش برای دریافت پیام‌ها از تلگرام با قفل مشورتی Postgres
+
+    قفل به اتصال دیتابیس وابسته است؛ اگر پردازش رهبر از کار بیفتد اتصال آن بسته
+    شده و قفل آزاد می‌شود و پردازش دیگری در کمتر از CHECK_INTERVAL ثانیه آن را می‌گیرد.
+    """
+
+    def __init__(self, engine, key=LOCK_KEY, interval=CHECK_INTERVAL):
+        self.engine = engine
+        self.key = key
+        self.interval = interval
+        self._connection = None
+        self.is_leader = False
+
+        # متریک‌ها
+        self.elections_total = 0
+        self.lost_total = 0
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _try_lock(self):
+        if self._connection is None:
+            self._connection = self.engine.connect()
+        try:
+            acquired = self._connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+            self._connection.commit()
+            return bool(acquired)
+        except Exception:
+            self._close()
+            raise
+
+    def _check(self):
+        # اگر اتصال قطع شده باشد قفل هم در سمت دیتابیس آزاد شده است
+        try:
+            held = self._connection.execute(
+                text("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid() "
+                     "AND granted AND ((classid::bigint << 32) | objid::bigint) = :key"),
+                {"key": self.key}
+            ).scalar()
+            self._connection.commit()
+            return bool(held)
+        except Exception:
+            self._close()
+            return False
+
+    def _unlock(self):
+        try:
+            if self._connection is not None:
+                self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+                self._connection.commit()
+        finally:
+            self._close()
+
+    async def acquire(self):
+        """صبر تا زمانی که این پردازش رهبر شود"""
+        logged = False
+        while not self.is_leader:
+            try:
+                self.is_leader = await asyncio.to_thread(self._try_lock)
+            except Exception as e:
+                logger.error(f"خطا در گرفتن قفل رهبری: {e}")
+            if self.is_leader:
+                self.elections_total += 1
+                logger.info(f"این پردازش (pid {os.getpid()}) رهبر شد و پیام‌های تلگرام را دریافت می‌کند")
+                return
+            if not logged:
+                logger.info(f"پردازش دیگری رهبر است؛ پردازش {os.getpid()} در انتظار می‌ماند")
+                logged = True
+            await asyncio.sleep(self.interval)
+
+    async def wait_lost(self):
+        """بررسی دوره‌ای قفل؛ زمانی برمی‌گردد که رهبری از دست برود"""
+        while self.is_leader:
+            await asyncio.sleep(self.interval)
+            if not await asyncio.to_thread(self._check):
+                self.is_leader = False
+                self.lost_total += 1
+                logger.warning("رهبری از دست رفت؛ دریافت پیام‌ها متوقف می‌شود")
+
+    async def release(self):
+        """آزاد کردن قفل هنگام توقف تا پردازش دیگری بلافاصله رهبر شود"""
+        self.is_leader = False
+        try:
+            await asyncio.to_thread(self._unlock)
+        except Exception as e:
+            # با بسته شدن اتصال، قفل در سمت دیتابیس آزاد می‌شود
+            logger.error(f"خطا در آزاد کردن قفل رهبری: {e}")
+
+    def metrics(self):
+        return {
+            "is_leader": int(self.is_leader),
+            "elections_total": self.elections_total,
+            "lost_total": self.lost_total,
+        }
+
+
+def create_leader_elector(engine):
+    """ساخت انتخاب‌کننده رهبر و ثبت متریک‌های آن"""
+    elector = LeaderElector(engine)
+    register_collector("leader", elector.metrics)
+    return elector
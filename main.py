@@ -1,64 +1,32 @@
-
-from flask import Flask
-from models import init_db, load_default_menu, Base
-from sqlalchemy import create_engine
-import asyncio
+from aiohttp import web
 from bot_new import main as bot_main
-import threading
+from metrics import render_text as render_metrics
+import asyncio
 import os
 
-app = Flask(__name__)
+# سرور HTTP و ربات تلگرام روی یک حلقه رویداد اجرا می‌شوند (بدون thread جداگانه و nest_asyncio)
 
-@app.route('/')
-def index():
-    return 'Telegram Bot Service is Running'
+async def index(request):
+    return web.Response(text='Telegram Bot Service is Running')
 
-def run_bot():
-    asyncio.run(bot_main())
+async def metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain')
 
-if __name__ == '__main__':
-    # ایجاد اتصال به دیتابیس
-    database_url = os.environ.get('DATABASE_URL')
-    engine = create_engine(database_url)
-    
-    # ایجاد تمام جداول
-    Base.metadata.create_all(engine)
-    
-    # ایجاد اتصال به دیتابیس و بارگذاری منوی پیش‌فرض
-    db_session = init_db()
-    load_default_menu(db_session)
-    
-    # راه‌اندازی ربات در یک thread جداگانه
-    bot_thread = threading.Thread(target=run_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
-    
-    if __name__ == '__main__':
-        # در محیط توسعه
-        if os.environ.get('FLASK_ENV') == 'development':
-            app.run(host='0.0.0.0', port=8080, debug=True)
-        else:
-            # در محیط تولید از Gunicorn استفاده می‌شود
-            import gunicorn.app.base
+async def bot_context(app):
+    """اجرای ربات همراه با چرخه عمر سرور؛ با توقف سرور ربات هم به صورت کامل متوقف می‌شود"""
+    bot_task = asyncio.create_task(bot_main())
+    yield
+    bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
 
-            class StandaloneApplication(gunicorn.app.base.BaseApplication):
-                def __init__(self, app, options=None):
-                    self.options = options or {}
-                    self.application = app
-                    super().__init__()
+async def create_app():
+    """ساخت برنامه وب (برای اجرا با gunicorn و aiohttp.GunicornWebWorker)"""
+    app = web.Application()
+    app.router.add_get('/', index)
+    app.router.add_get('/metrics', metrics)
+    app.cleanup_ctx.append(bot_context)
+    return app
 
-                def load_config(self):
-                    for key, value in self.options.items():
-                        self.cfg.set(key, value)
-
-                def load(self):
-                    return self.application
-
-            options = {
-                'bind': '0.0.0.0:8080',
-                'workers': 1,
-                'worker_class': 'gthread',
-                'threads': 4,
-                'timeout': 120
-            }
-            StandaloneApplication(app, options).run()
+if __name__ == '__main__':
+    # در محیط توسعه و تولید از یک پردازش با یک حلقه رویداد استفاده می‌شود؛ برای چند پردازش از gunicorn.conf.py استفاده کنید
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+from models import MenuItem, menu_version_seq
+from dishes import dish_catalog
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# فاصله بررسی نسخه منو برای دیدن تغییرات پردازش‌های دیگر (ثانیه)
+POLL_INTERVAL = 10
+
+
+class MenuStore:
+    """کش منوی هفتگی (روز ← وعده ← شناسه غذا) همراه با نسخه منو
+
+    هر ویرایش فقط سطر همان (روز، وعده) را به‌روز می‌کند و نسخه جدیدی از menu_version_seq
+    می‌گیرد. کش و نام‌های آماده نمایش با نسخه منو کلید می‌خورند؛ پردازش‌های دیگر با
+    مقایسه بیشترین نسخه تغییر را می‌بینند و فقط در آن صورت منو را دوباره می‌خوانند.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._Session = None
+        self._task = None
+        self._lock = threading.Lock()
+        self._items = {}
+        self._versions = {}
+        self._names = {}
+        self.version = 0
+
+        # متریک‌ها
+        self.reloads_total = 0
+        self.edits_total = 0
+
+    def load(self, session):
+        """خواندن همه وعده‌ها از دیتابیس"""
+        items = {}
+        versions = {}
+        version = 0
+        for day, meal_type, dish_id, item_version in session.query(
+            MenuItem.day, MenuItem.meal_type, MenuItem.dish_id, MenuItem.version
+        ).order_by(MenuItem.id):
+            items.setdefault(day, {})[meal_type] = dish_id
+            versions[(day, meal_type)] = item_version
+            version = max(version, item_version)
+        # نام غذاهای جدیدی که پردازش دیگری به منو اضافه کرده پیش از نمایش خوانده می‌شود
+        dish_catalog.ensure(session, {dish_id for meals in items.values() for dish_id in meals.values()})
+        with self._lock:
+            self._items = items
+            self._versions = versions
+            self._names = {}
+            self.version = version
+        self.reloads_total += 1
+
+    def days(self):
+        return list(self._items)
+
+    def has_day(self, day):
+        return day in self._items
+
+    def meals(self, day):
+        """شناسه غذای وعده‌های یک روز (وعده ← شناسه غذا)"""
+        return self._items[day]
+
+    def dish_id(self, day, meal_type):
+        return self._items[day][meal_type]
+
+    def item_version(self, day, meal_type):
+        """نسخه آخرین تغییر یک وعده"""
+        return self._versions.get((day, meal_type), 0)
+
+    def day_version(self, day):
+        """نسخه آخرین تغییر وعده‌های یک روز"""
+        return max((self.item_version(day, meal_type) for meal_type in self._items.get(day, ())), default=0)
+
+    def names(self, day):
+        """نام غذاهای یک روز برای نمایش؛ تا تغییر نسخه منو از کش خوانده می‌شود"""
+        version = self.version
+        key = (day, version)
+        names = self._names.get(key)
+        if names is None:
+            names = {meal_type: dish_catalog.name(dish_id) for meal_type, dish_id in self._items[day].items()}
+            with self._lock:
+                if self.version == version:
+                    self._names[key] = names
+        return names
+
+    def set_dish(self, session, day, meal_type, dish_id):
+        """تغییر غذای یک وعده با UPDATE همان سطر و گرفتن نسخه جدید منو"""
+        version = session.execute(menu_version_seq.next_value()).scalar()
+        updated = session.query(MenuItem).filter_by(day=day, meal_type=meal_type).update(
+            {MenuItem.dish_id: dish_id, MenuItem.version: version}, synchronize_session=False
+        )
+        if not updated:
+            session.add(MenuItem(day=day, meal_type=meal_type, dish_id=dish_id, version=version))
+        session.commit()
+
+        # خواندن دوباره کل منو (چند ده سطر) تا تغییرات هم‌زمان پردازش‌های دیگر هم دیده شوند
+        self.load(session)
+        self.edits_total += 1
+        return version
+
+    def _latest_version(self):
+        session = self._Session()
+        try:
+            return session.query(func.max(MenuItem.version)).scalar() or 0
+        finally:
+            session.close()
+
+    def _reload(self):
+        session = self._Session()
+        try:
+            self.load(session)
+        finally:
+            session.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await asyncio.to_thread(self._latest_version) != self.version:
+                    await asyncio.to_thread(self._reload)
+                    logger.info(f"منو تغییر کرد؛ نسخه {self.version} بارگذاری شد")
+            except Exception as e:
+                logger.error(f"خطا در بررسی نسخه منو: {e}")
+
+    async def start(self, engine):
+        self._Session = sessionmaker(bind=engine)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self):
+        return {
+            "version": self.version,
+            "reloads_total": self.reloads_total,
+            "edits_total": self.edits_total,
+        }
+
+
+# کش مشترک منو
+menu_store = MenuStore()
+register_collector("menu", menu_store.metrics)
@@ -0,0 +1,32 @@
+import threading
+
+# ثبت‌کننده‌های متریک؛ هر بخش از ربات یک تابع جمع‌آوری ثبت می‌کند که دیکشنری نام ← مقدار برمی‌گرداند
+_collectors = {}
+_lock = threading.Lock()
+
+def register_collector(prefix, collector):
+    """ثبت یک تابع جمع‌آوری متریک با پیشوند مشخص"""
+    with _lock:
+        _collectors[prefix] = collector
+
+def collect():
+    """جمع‌آوری مقدار فعلی تمام متریک‌های ثبت شده"""
+    with _lock:
+        collectors = list(_collectors.items())
+
+    result = {}
+    for prefix, collector in collectors:
+        try:
+            values = collector()
+        except Exception:
+            continue
+        for name, value in values.items():
+            result[f"{prefix}_{name}"] = value
+    return result
+
+def render_text():
+    """تبدیل متریک‌ها به قالب متنی Prometheus"""
+    lines = []
+    for name, value in sorted(collect().items()):
+        lines.append(f"{name} {float(value)}")
+    return "\n".join(lines) + "\n"
@@ -1,18 +1,26 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, JSON, Boolean, DateTime, Text
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, create_engine, JSON, Boolean, Date, DateTime, Text, UniqueConstraint, Index, Sequence, and_, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta
+import logging
 import os
 import json
+from week_calendar import WEEKDAYS, week_start, upcoming_date
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 # کلاس دانشجو برای نگهداری اطلاعات دانشجویان
 class Student(Base):
     __tablename__ = 'students'
+    __table_args__ = (
+        # یکتایی شناسه کاربری فقط برای دانشجویانی که ربات را شروع کرده‌اند
+        Index('uq_students_user_id', 'user_id', unique=True, postgresql_where=text('user_id IS NOT NULL')),
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(String, unique=True, nullable=False)  # شناسه کاربری تلگرام
+    user_id = Column(BigInteger, nullable=True)  # شناسه عددی کاربر تلگرام (برای دانشجویان وارد شده از فایل JSON خالی است)
     feeding_code = Column(String, unique=True, nullable=False)  # کد تغذیه
     phone = Column(String, nullable=True)  # شماره تلفن برای اطلاع‌رسانی‌ها (اختیاری)
     registration_date = Column(DateTime, default=datetime.now)  # تاریخ ثبت‌نام
@@ -23,15 +31,38 @@ class Student(Base):
     def __repr__(self):
         return f"<Student(user_id={self.user_id}, feeding_code={self.feeding_code})>"
 
+# کلاس غذا؛ منوها و رزروها به جای تکرار نام غذا شناسه آن را نگه می‌دارند
+class Dish(Base):
+    __tablename__ = 'dishes'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)  # نام غذا
+    
+    def __repr__(self):
+        return f"<Dish(id={self.id}, name={self.name})>"
+
 # کلاس رزرو برای نگهداری اطلاعات رزروهای غذا
+# جدول بر اساس هفته شمسی (week_start) پارتیشن‌بندی شده است؛ هفته‌های قدیمی بدون DELETE جدا و بایگانی می‌شوند
 class Reservation(Base):
     __tablename__ = 'reservations'
+    __table_args__ = (
+        # هر دانشجو برای هر وعده از هر تاریخ فقط یک رزرو دارد (لازم برای upsert گروهی)؛
+        # کلید پارتیشن باید در ایندکس یکتا باشد
+        Index('uq_reservations_student_date_meal', 'student_id', 'reservation_date', 'meal_type', 'week_start', unique=True),
+        # فهرست رزروهای یک تاریخ (مدیریت تحویل)
+        Index('ix_reservations_date', 'reservation_date'),
+        # رزروهای یک دانشجو در یک بازه تاریخ (رزروهای آینده و سابقه)
+        Index('ix_reservations_student_date', 'student_id', 'reservation_date'),
+        {'postgresql_partition_by': 'RANGE (week_start)'},
+    )
     
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    week_start = Column(Date, primary_key=True)  # شنبه آغاز هفته شمسی (کلید پارتیشن)
+    reservation_date = Column(Date, nullable=False)  # تاریخ وعده
     student_id = Column(Integer, ForeignKey('students.id'), nullable=False)  # کلید خارجی به جدول دانشجویان
     day = Column(String, nullable=False)  # روز هفته (شنبه، یکشنبه، ...)
     meal_type = Column(String, nullable=False)  # نوع وعده غذایی (صبحانه، ناهار، شام)
-    food = Column(String, nullable=False)  # نام غذا
+    dish_id = Column(Integer, ForeignKey('dishes.id'), nullable=False)  # شناسه غذا
     is_delivered = Column(Boolean, default=False)  # وضعیت تحویل غذا
     delivery_time = Column(DateTime, nullable=True)  # زمان تحویل غذا
     reservation_time = Column(DateTime, default=datetime.now)  # زمان ثبت رزرو
@@ -40,19 +71,91 @@ class Reservation(Base):
     student = relationship("Student", back_populates="reservations")
     
     def __repr__(self):
-        return f"<Reservation(student_id={self.student_id}, day={self.day}, meal_type={self.meal_type}, food={self.food}, delivered={self.is_delivered})>"
+        return f"<Reservation(student_id={self.student_id}, date={self.reservation_date}, meal_type={self.meal_type}, dish_id={self.dish_id}, delivered={self.is_delivered})>"
+    
+    @classmethod
+    def on_date(cls, date):
+        """شرط رزروهای یک تاریخ (همراه با کلید پارتیشن تا فقط یک پارتیشن خوانده شود)"""
+        return and_(cls.week_start == week_start(date), cls.reservation_date == date)
+    
+    @classmethod
+    def upcoming(cls, today=None):
+        """شرط رزروهای امروز و روزهای آینده"""
+        today = today or datetime.now().date()
+        return and_(cls.week_start >= week_start(today), cls.reservation_date >= today)
+    
+    @classmethod
+    def between(cls, start, end):
+        """شرط رزروهای بازه [start, end] (همراه با کلید پارتیشن تا فقط پارتیشن‌های همان هفته‌ها خوانده شوند)"""
+        return and_(
+            cls.week_start >= week_start(start), cls.week_start <= week_start(end),
+            cls.reservation_date >= start, cls.reservation_date <= end
+        )
+
+# تاریخ رزروهایی که فقط با نام روز ساخته شده‌اند از نزدیک‌ترین روز آینده با همان نام تعیین می‌شود
+@event.listens_for(Reservation, "before_insert")
+def _fill_reservation_date(mapper, connection, target):
+    if target.reservation_date is None:
+        target.reservation_date = upcoming_date(target.day)
+    if target.week_start is None:
+        target.week_start = week_start(target.reservation_date)
 
-# کلاس منو برای نگهداری منوی غذای هفتگی
+# کلاس منوی قدیمی (همه وعده‌های یک روز در یک JSON)؛ فقط برای انتقال به menu_items نگه داشته شده است
 class Menu(Base):
     __tablename__ = 'menu'
     
     id = Column(Integer, primary_key=True)
     day = Column(String, nullable=False)  # روز هفته
-    meal_data = Column(JSON, nullable=False)  # اطلاعات وعده‌های غذایی در قالب JSON
+    meal_data = Column(JSON, nullable=False)  # نام یا شناسه غذای هر وعده در قالب JSON
     
     def __repr__(self):
         return f"<Menu(day={self.day}, meal_data={self.meal_data})>"
 
+# نسخه منو؛ هر تغییر یک وعده شماره بزرگ‌تری از این sequence می‌گیرد
+menu_version_seq = Sequence('menu_version_seq', metadata=Base.metadata)
+
+# کلاس وعده منو؛ هر (روز، وعده) یک سطر است و ویرایش یک وعده فقط همان سطر را تغییر می‌دهد
+class MenuItem(Base):
+    __tablename__ = 'menu_items'
+    __table_args__ = (UniqueConstraint('day', 'meal_type', name='uq_menu_items_day_meal'),)
+    
+    id = Column(Integer, primary_key=True)
+    day = Column(String, nullable=False)  # روز هفته
+    meal_type = Column(String, nullable=False)  # نوع وعده غذایی
+    dish_id = Column(Integer, ForeignKey('dishes.id'), nullable=False)  # شناسه غذا
+    # نسخه آخرین تغییر این وعده؛ بیشترین نسخه همه سطرها نسخه منو است
+    version = Column(BigInteger, menu_version_seq, server_default=menu_version_seq.next_value(), nullable=False, index=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    def __repr__(self):
+        return f"<MenuItem(day={self.day}, meal_type={self.meal_type}, dish_id={self.dish_id}, version={self.version})>"
+
+# شمارنده رزروها و تحویل‌های هر وعده در هر تاریخ برای داشبورد آشپزخانه؛ همراه با هر رزرو و تحویل به‌روز می‌شود
+class MealCounter(Base):
+    __tablename__ = 'meal_counters'
+    
+    reservation_date = Column(Date, primary_key=True)  # تاریخ وعده
+    meal_type = Column(String, primary_key=True)  # نوع وعده غذایی
+    reserved = Column(Integer, nullable=False, default=0)  # تعداد رزروها
+    delivered = Column(Integer, nullable=False, default=0)  # تعداد تحویل‌ها
+    
+    def __repr__(self):
+        return f"<MealCounter(date={self.reservation_date}, meal_type={self.meal_type}, reserved={self.reserved}, delivered={self.delivered})>"
+
+# کلاس ظرفیت وعده‌ها؛ شمارنده reserved با UPDATE شرطی به صورت اتمیک افزایش می‌یابد
+class MealCapacity(Base):
+    __tablename__ = 'meal_capacity'
+    __table_args__ = (UniqueConstraint('day', 'meal_type', name='uq_meal_capacity_day_meal'),)
+    
+    id = Column(Integer, primary_key=True)
+    day = Column(String, nullable=False)  # روز هفته
+    meal_type = Column(String, nullable=False)  # نوع وعده غذایی
+    capacity = Column(Integer, nullable=False)  # حداکثر تعداد رزرو
+    reserved = Column(Integer, nullable=False, default=0)  # تعداد رزروهای ثبت شده
+    
+    def __repr__(self):
+        return f"<MealCapacity(day={self.day}, meal_type={self.meal_type}, reserved={self.reserved}/{self.capacity})>"
+
 # کلاس جدید برای بک‌آپ‌های دیتابیس
 class DatabaseBackup(Base):
     __tablename__ = 'backups'
@@ -66,23 +169,200 @@ class DatabaseBackup(Base):
     def __repr__(self):
         return f"<DatabaseBackup(filename={self.filename}, created_at={self.created_at})>"
 
+# کلاس برای نگهداری وضعیت پیام‌های همگانی (قابل ادامه پس از راه‌اندازی مجدد)
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # نوع پیام (تغییر منو، یادآوری رزرو)
+    day = Column(String, nullable=True)  # روز مرتبط با پیام
+    reservation_date = Column(Date, nullable=True)  # تاریخ هدف یادآوری (هنگام ایجاد ثابت می‌شود)
+    message = Column(Text, nullable=False)  # متن پیام
+    requested_by = Column(BigInteger, nullable=True)  # شناسه چت مدیر درخواست‌دهنده
+    status = Column(String, nullable=False, default="running")  # وضعیت (running, done)
+    last_student_id = Column(Integer, nullable=False, default=0)  # آخرین دانشجوی پردازش شده
+    sent = Column(Integer, nullable=False, default=0)  # تعداد ارسال موفق
+    failed = Column(Integer, nullable=False, default=0)  # تعداد ارسال ناموفق
+    created_at = Column(DateTime, default=datetime.now)  # زمان ایجاد
+    finished_at = Column(DateTime, nullable=True)  # زمان پایان
+    
+    def __repr__(self):
+        return f"<Broadcast(kind={self.kind}, status={self.status}, sent={self.sent})>"
+
+# کلاس برای نگهداری وضعیت مکالمه‌ها و داده‌های کاربران ربات (persistence)
+class BotState(Base):
+    __tablename__ = 'bot_state'
+    
+    kind = Column(String, primary_key=True)  # نوع داده (user، conversation:نام)
+    key = Column(String, primary_key=True)  # کلید (شناسه کاربر یا کلید مکالمه)
+    data = Column(JSON, nullable=True)  # داده ذخیره شده
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)  # زمان آخرین تغییر
+    
+    def __repr__(self):
+        return f"<BotState(kind={self.kind}, key={self.key})>"
+
+# نام پارتیشن رزروهای یک هفته
+def reservation_partition_name(week):
+    return f"reservations_w{week:%Y%m%d}"
+
+# ایجاد پارتیشن‌های رزرو برای هفته جاری و هفته‌های آینده (در صورت نبود)
+def ensure_reservation_partitions(connection, today=None, weeks=3):
+    import sqlalchemy as sa
+    first_week = week_start(today or datetime.now().date())
+    for i in range(weeks):
+        week = first_week + timedelta(days=7 * i)
+        connection.execute(sa.text(
+            f"CREATE TABLE IF NOT EXISTS {reservation_partition_name(week)} PARTITION OF reservations "
+            f"FOR VALUES FROM ('{week.isoformat()}') TO ('{(week + timedelta(days=7)).isoformat()}')"
+        ))
+
+# جدا کردن پارتیشن هفته‌های قبل از before_week و انتقال آن‌ها به schema بایگانی (فقط تغییر metadata، بدون DELETE)
+def archive_reservation_partitions(connection, before_week, archive_schema):
+    import sqlalchemy as sa
+    partitions = connection.execute(sa.text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'reservations'
+    """)).scalars().all()
+    
+    archived = []
+    for name in sorted(partitions):
+        try:
+            week = datetime.strptime(name, "reservations_w%Y%m%d").date()
+        except ValueError:
+            continue
+        if week >= before_week:
+            continue
+        connection.execute(sa.text(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}"))
+        connection.execute(sa.text(f"ALTER TABLE reservations DETACH PARTITION {name}"))
+        connection.execute(sa.text(f"DROP TABLE IF EXISTS {archive_schema}.{name}"))
+        connection.execute(sa.text(f"ALTER TABLE {name} SET SCHEMA {archive_schema}"))
+        archived.append(name)
+    return archived
+
+# انتقال رزروهای جدول قدیمی به جدول پارتیشن‌بندی شده؛ هر رزرو برای نزدیک‌ترین تاریخ آینده با همان روز ثبت می‌شود
+def migrate_reservations_to_partitions(connection):
+    import sqlalchemy as sa
+    
+    connection.execute(sa.text("ALTER TABLE reservations RENAME TO reservations_legacy"))
+    connection.execute(sa.text("ALTER TABLE reservations_legacy RENAME CONSTRAINT reservations_pkey TO reservations_legacy_pkey"))
+    connection.execute(sa.text("DROP INDEX IF EXISTS uq_reservations_student_day_meal"))
+    connection.execute(sa.text("DROP INDEX IF EXISTS ix_reservations_student_day"))
+    
+    Reservation.__table__.create(connection)
+    ensure_reservation_partitions(connection)
+    
+    dates = {day: upcoming_date(day) for day in WEEKDAYS}
+    date_case = " ".join(f"WHEN '{day}' THEN DATE '{date.isoformat()}'" for day, date in dates.items())
+    week_case = " ".join(f"WHEN '{day}' THEN DATE '{week_start(date).isoformat()}'" for day, date in dates.items())
+    
+    legacy_count = connection.execute(sa.text("SELECT COUNT(*) FROM reservations_legacy")).scalar()
+    invalid_days = connection.execute(sa.text(f"""
+        SELECT day, COUNT(*) FROM reservations_legacy
+        WHERE day IS NULL OR day NOT IN ({", ".join(f"'{day}'" for day in WEEKDAYS)})
+        GROUP BY day
+    """)).all()
+    
+    # در صورت وجود رزرو تکراری (یک دانشجو، یک روز، یک وعده) قدیمی‌ترین رزرو نگه داشته می‌شود
+    migrated = connection.execute(sa.text(f"""
+        INSERT INTO reservations (id, week_start, reservation_date, student_id, day, meal_type, dish_id,
+                                  is_delivered, delivery_time, reservation_time)
+        SELECT DISTINCT ON (student_id, day, meal_type)
+               id, CASE day {week_case} END, CASE day {date_case} END, student_id, day, meal_type, dish_id,
+               is_delivered, delivery_time, reservation_time
+        FROM reservations_legacy
+        WHERE day IN ({", ".join(f"'{day}'" for day in WEEKDAYS)})
+        ORDER BY student_id, day, meal_type, id
+    """)).rowcount
+    invalid_count = sum(count for _, count in invalid_days)
+    if invalid_count:
+        logger.warning(
+            f"{invalid_count} رزرو با روز نامعتبر منتقل نشد: "
+            + ", ".join(f"{day!r} ({count})" for day, count in invalid_days)
+        )
+    if legacy_count - invalid_count - migrated:
+        logger.warning(f"{legacy_count - invalid_count - migrated} رزرو تکراری (دانشجو، روز، وعده) منتقل نشد")
+    logger.info(f"{migrated} رزرو از {legacy_count} رزرو به جدول پارتیشن‌بندی شده منتقل شد")
+    connection.execute(sa.text(
+        "SELECT setval(pg_get_serial_sequence('reservations', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM reservations"
+    ))
+    connection.execute(sa.text("DROP TABLE reservations_legacy"))
+
+# شناسه غذا با نام name (در صورت نبود ایجاد می‌شود؛ ایجاد هم‌زمان در چند پردازش تکراری نمی‌سازد)
+def dish_id_for(session, name):
+    from sqlalchemy.dialects.postgresql import insert
+    session.execute(insert(Dish).values(name=name).on_conflict_do_nothing(index_elements=["name"]))
+    return session.query(Dish.id).filter_by(name=name).scalar()
+
+# تبدیل ستون user_id دانشجویان از متن به BIGINT با ایندکس یکتای جزئی (فقط مقادیر غیر NULL)
+def migrate_student_user_ids(connection):
+    import sqlalchemy as sa
+    
+    connection.execute(sa.text("ALTER TABLE students DROP CONSTRAINT IF EXISTS students_user_id_key"))
+    connection.execute(sa.text("ALTER TABLE students ALTER COLUMN user_id DROP NOT NULL"))
+    connection.execute(sa.text("UPDATE students SET user_id = NULL WHERE user_id !~ '^[0-9]+$'"))
+    connection.execute(sa.text("ALTER TABLE students ALTER COLUMN user_id TYPE BIGINT USING user_id::bigint"))
+    connection.execute(sa.text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_students_user_id ON students (user_id) WHERE user_id IS NOT NULL"
+    ))
+
+# جایگزینی نام غذا با شناسه آن در جدول رزروها (ستون food قدیمی حذف می‌شود)
+def migrate_reservation_food_to_dishes(connection):
+    import sqlalchemy as sa
+    
+    connection.execute(sa.text("""
+        INSERT INTO dishes (name)
+        SELECT DISTINCT food FROM reservations WHERE food IS NOT NULL
+        ON CONFLICT (name) DO NOTHING
+    """))
+    connection.execute(sa.text("ALTER TABLE reservations ADD COLUMN dish_id INTEGER REFERENCES dishes (id)"))
+    connection.execute(sa.text("UPDATE reservations SET dish_id = dishes.id FROM dishes WHERE dishes.name = reservations.food"))
+    connection.execute(sa.text("ALTER TABLE reservations ALTER COLUMN dish_id SET NOT NULL"))
+    connection.execute(sa.text("ALTER TABLE reservations DROP COLUMN food"))
+
+# انتقال منوی قدیمی (JSON هر روز) به جدول menu_items با یک سطر برای هر وعده
+def migrate_menu_to_items(session):
+    if session.query(MenuItem).count() > 0:
+        return
+    for menu_item in session.query(Menu).order_by(Menu.id).all():
+        for meal_type, value in menu_item.meal_data.items():
+            dish_id = value if isinstance(value, int) else dish_id_for(session, value)
+            session.add(MenuItem(day=menu_item.day, meal_type=meal_type, dish_id=dish_id))
+    session.commit()
+
+# کلید قفل advisory ایجاد جداول و مهاجرت‌ها؛ هر worker و shard هنگام import این کار را انجام می‌دهد
+SCHEMA_LOCK_KEY = 7301946585
+
 # تابع برای ایجاد اتصال به دیتابیس و جداول
 def init_db():
     database_url = os.environ.get('DATABASE_URL')
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
+    # timeout کوتاه اتصال تا در صورت قطع دیتابیس هر آپدیت مدت زیادی منتظر نماند
+    engine = create_engine(database_url, pool_pre_ping=True, connect_args={"connect_timeout": 5})
     Session = sessionmaker(bind=engine)
     session = Session()
     
-    # مهاجرت و به‌روزرسانی ساختار دیتابیس
-    migrate_database_schema(session, engine)
+    # فقط یک پردازش هم‌زمان مهاجرت می‌کند؛ بقیه تا پایان آن منتظر می‌مانند و سپس ساختار به‌روز را می‌بینند
+    with engine.connect() as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            Base.metadata.create_all(engine)
+            
+            # مهاجرت و به‌روزرسانی ساختار دیتابیس
+            migrate_database_schema(session, engine)
+            
+            # پارتیشن هفته جاری و هفته‌های آینده باید پیش از اولین رزرو وجود داشته باشند
+            with engine.begin() as connection:
+                ensure_reservation_partitions(connection)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
     
     return session
 
 # تابع برای بارگذاری منوی پیش‌فرض به دیتابیس
 def load_default_menu(session):
     # بررسی اینکه آیا منو قبلاً بارگذاری شده است
-    menu_count = session.query(Menu).count()
+    menu_count = session.query(MenuItem).count()
     if menu_count > 0:
         return
     
@@ -99,8 +379,8 @@ def load_default_menu(session):
     
     # افزودن منوی پیش‌فرض به دیتابیس
     for day, meals in default_menu.items():
-        menu_item = Menu(day=day, meal_data=meals)
-        session.add(menu_item)
+        for meal_type, food in meals.items():
+            session.add(MenuItem(day=day, meal_type=meal_type, dish_id=dish_id_for(session, food)))
     
     session.commit()
 
@@ -112,7 +392,9 @@ def migrate_database_schema(session, engine):
     # بررسی ستون‌های موجود در جدول رزروها
     inspector = inspect(engine)
     reservation_columns = [column['name'] for column in inspector.get_columns('reservations')]
-    student_columns = [column['name'] for column in inspector.get_columns('students')]
+    student_column_types = {column['name']: column['type'] for column in inspector.get_columns('students')}
+    student_columns = list(student_column_types)
+    broadcast_columns = [column['name'] for column in inspector.get_columns('broadcasts')]
     
     # اضافه کردن ستون‌های مورد نیاز به جدول رزروها
     with engine.connect() as connection:
@@ -132,6 +414,27 @@ def migrate_database_schema(session, engine):
         if 'registration_date' not in student_columns:
             connection.execute(sa.text("ALTER TABLE students ADD COLUMN registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP"))
         
+        # تاریخ هدف یادآوری‌ها تا ادامه پس از نیمه‌شب همان تاریخ را هدف بگیرد
+        if 'reservation_date' not in broadcast_columns:
+            connection.execute(sa.text("ALTER TABLE broadcasts ADD COLUMN reservation_date DATE"))
+        
+        # تبدیل شناسه کاربری متنی به BIGINT؛ مقدار "unknown" (دانشجویان وارد شده از فایل JSON) به NULL تبدیل می‌شود
+        if not isinstance(student_column_types['user_id'], sa.BigInteger):
+            migrate_student_user_ids(connection)
+        
+        # نام غذا در رزروها با شناسه جدول غذاها جایگزین می‌شود (پیش از تبدیل به جدول پارتیشن‌بندی شده)
+        if 'dish_id' not in reservation_columns:
+            migrate_reservation_food_to_dishes(connection)
+        
+        # تبدیل جدول قدیمی رزروها (فقط با نام روز) به جدول پارتیشن‌بندی شده بر اساس هفته
+        if 'week_start' not in reservation_columns:
+            migrate_reservations_to_partitions(connection)
+        
+        # ایندکس بازه تاریخ رزروهای هر دانشجو (روی جدول پارتیشن‌بندی شده به همه پارتیشن‌ها اعمال می‌شود)
+        connection.execute(sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_reservations_student_date ON reservations (student_id, reservation_date)"
+        ))
+        
         # ایجاد جدول بک‌آپ اگر وجود نداشته باشد
         connection.execute(sa.text("""
             CREATE TABLE IF NOT EXISTS backups (
@@ -144,13 +447,30 @@ def migrate_database_schema(session, engine):
         """))
         
         connection.commit()
+    
+    migrate_menu_to_items(session)
 
 # تابع برای انتقال داده‌های از فایل JSON به دیتابیس
+# نشانه وارد شدن فایل JSON رزروها در bot_state تا فایل در هر شروع (و در هر پردازش) دوباره وارد نشود
+JSON_MIGRATION_KIND = "migration"
+JSON_MIGRATION_KEY = "reservations_json"
+
 def migrate_from_json_to_db(json_file, session):
+    from sqlalchemy.dialects.postgresql import insert
     try:
         with open(json_file, 'r', encoding='utf-8') as file:
             reservations_data = json.load(file)
             
+            # ثبت نشانه پیش از وارد کردن؛ پردازش‌های هم‌زمان روی همین سطر منتظر می‌مانند و پس از commit آن را می‌بینند
+            claimed = session.execute(
+                insert(BotState).values(
+                    kind=JSON_MIGRATION_KIND, key=JSON_MIGRATION_KEY, data={"file": os.path.basename(json_file)}
+                ).on_conflict_do_nothing(index_elements=["kind", "key"]).returning(BotState.key)
+            ).first()
+            if claimed is None:
+                session.rollback()
+                return False
+            
             # نگاشت روزهای فارسی به انگلیسی
             persian_to_english_days = {
                 "شنبه": "saturday",
@@ -170,30 +490,45 @@ def migrate_from_json_to_db(json_file, session):
             }
             
             # وارد کردن داده‌های رزرو به دیتابیس
+            invalid_days = {}
             for feeding_code, days in reservations_data.items():
                 # بررسی و ایجاد دانشجو
                 student = session.query(Student).filter_by(feeding_code=feeding_code).first()
                 if not student:
-                    student = Student(user_id="unknown", feeding_code=feeding_code)
+                    student = Student(user_id=None, feeding_code=feeding_code)
                     session.add(student)
                     session.flush()  # برای گرفتن شناسه ایجاد شده
                 
                 # وارد کردن رزروها
                 for day_persian, meals in days.items():
                     day_english = persian_to_english_days.get(day_persian, day_persian)
+                    # روز نامعتبر تاریخ ندارد؛ رزروهای آن وارد نمی‌شوند
+                    if day_english not in WEEKDAYS:
+                        invalid_days[day_persian] = invalid_days.get(day_persian, 0) + len(meals)
+                        continue
                     
                     for meal_persian, food in meals.items():
                         meal_english = persian_to_english_meals.get(meal_persian, meal_persian)
                         
-                        reservation = Reservation(
+                        # رزروهایی که پیش از ثبت نشانه وارد شده‌اند دوباره وارد نمی‌شوند
+                        reservation_date = upcoming_date(day_english)
+                        session.execute(insert(Reservation).values(
                             student_id=student.id,
                             day=day_english,
+                            reservation_date=reservation_date,
+                            week_start=week_start(reservation_date),
                             meal_type=meal_english,
-                            food=food
-                        )
-                        session.add(reservation)
+                            dish_id=dish_id_for(session, food)
+                        ).on_conflict_do_nothing(
+                            index_elements=["student_id", "reservation_date", "meal_type", "week_start"]
+                        ))
             
             session.commit()
+            if invalid_days:
+                logger.warning(
+                    f"{sum(invalid_days.values())} رزرو با روز نامعتبر از فایل JSON وارد نشد: "
+                    + ", ".join(f"{day!r} ({count})" for day, count in invalid_days.items())
+                )
             return True
     except (FileNotFoundError, json.JSONDecodeError):
         return False
\ No newline at end of file
@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+import json
+import logging
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from telegram.ext import BasePersistence, PersistenceInput
+from models import BotState
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# فاصله زمانی (ثانیه) که تلگرام تغییرات را به persistence می‌دهد
+UPDATE_INTERVAL = 5
+
+# تاخیر (ثانیه) پیش از نوشتن تغییرات تا همه تغییرات یک دوره در یک تراکنش نوشته شوند
+FLUSH_DELAY = 0.5
+
+KIND_USER = "user"
+CONVERSATION_PREFIX = "conversation:"
+
+# نشانه حذف یک ردیف در صف نوشتن
+_DELETED = object()
+
+
+class PostgresPersistence(BasePersistence):
+    """نگهداری وضعیت مکالمه‌ها و user_data در حافظه و نوشتن دسته‌ای تغییرات در Postgres"""
+
+    def __init__(self, engine, update_interval=UPDATE_INTERVAL, owns=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._Session = sessionmaker(bind=engine)
+        # در اجرای چند پردازشی هر پردازش فقط وضعیت کاربران خود را بارگذاری می‌کند
+        self._owns = owns or (lambda user_id: True)
+        self._user_data = None
+        self._conversations = {}
+        self._dirty = {}  # (نوع، کلید) ← داده یا _DELETED
+        self._flush_task = None
+
+        # متریک‌ها
+        self.flushes_total = 0
+        self.rows_written_total = 0
+
+    # --- خواندن از دیتابیس (فقط هنگام شروع) ---
+
+    def _load(self, kind):
+        session = self._Session()
+        try:
+            return [(row.key, row.data) for row in session.query(BotState).filter_by(kind=kind).all()]
+        finally:
+            session.close()
+
+    async def get_user_data(self):
+        if self._user_data is None:
+            rows = await asyncio.to_thread(self._load, KIND_USER)
+            self._user_data = {int(key): data or {} for key, data in rows if self._owns(int(key))}
+        return self._user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        if name not in self._conversations:
+            rows = await asyncio.to_thread(self._load, CONVERSATION_PREFIX + name)
+            conversations = {tuple(json.loads(key)): state for key, state in rows}
+            self._conversations[name] = {key: state for key, state in conversations.items() if self._owns(key[-1])}
+        return self._conversations[name]
+
+    # --- تغییرات در حافظه و صف نوشتن ---
+
+    def _mark(self, kind, key, data):
+        self._dirty[(kind, key)] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        row_key = json.dumps(list(key))
+        if new_state is None:
+            if key not in conversations:
+                return
+            del conversations[key]
+            self._mark(CONVERSATION_PREFIX + name, row_key, _DELETED)
+        else:
+            if conversations.get(key) == new_state:
+                return
+            conversations[key] = new_state
+            self._mark(CONVERSATION_PREFIX + name, row_key, new_state)
+
+    async def update_user_data(self, user_id, data):
+        if self._user_data is None:
+            self._user_data = {}
+        self._user_data[user_id] = data
+        if data:
+            self._mark(KIND_USER, str(user_id), dict(data))
+        else:
+            self._mark(KIND_USER, str(user_id), _DELETED)
+
+    async def drop_user_data(self, user_id):
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self._mark(KIND_USER, str(user_id), _DELETED)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    # وضعیت داغ در حافظه نگهداری می‌شود؛ به‌روزرسانی‌های هر کاربر همیشه به یک پردازش می‌رسند
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- نوشتن دسته‌ای ---
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(FLUSH_DELAY)
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._write, dirty)
+        except Exception as e:
+            # تغییرات به صف برمی‌گردند تا در نوبت بعد نوشته شوند (مگر اینکه جدیدتر شده باشند)
+            for key, data in dirty.items():
+                self._dirty.setdefault(key, data)
+            logger.error(f"خطا در ذخیره وضعیت ربات: {e}")
+
+    def _write(self, dirty):
+        upserts = []
+        deletes = []
+        now = datetime.datetime.now()
+        for (kind, key), data in dirty.items():
+            if data is _DELETED:
+                deletes.append((kind, key))
+            else:
+                upserts.append({"kind": kind, "key": key, "data": data, "updated_at": now})
+
+        session = self._Session()
+        try:
+            if upserts:
+                statement = insert(BotState).values(upserts)
+                statement = statement.on_conflict_do_update(
+                    index_elements=["kind", "key"],
+                    set_={"data": statement.excluded.data, "updated_at": statement.excluded.updated_at}
+                )
+                session.execute(statement)
+            for kind, key in deletes:
+                session.query(BotState).filter_by(kind=kind, key=key).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.flushes_total += 1
+        self.rows_written_total += len(dirty)
+
+    async def flush(self):
+        """نوشتن همه تغییرات باقی‌مانده (هنگام توقف ربات)"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_dirty()
+
+    def metrics(self):
+        return {
+            "dirty": len(self._dirty),
+            "users": len(self._user_data or {}),
+            "conversations": sum(len(states) for states in self._conversations.values()),
+            "flushes_total": self.flushes_total,
+            "rows_written_total": self.rows_written_total,
+        }
+
+
+def create_persistence(engine, owns=None):
+    """ساخت persistence و ثبت متریک‌های آن"""
+    persistence = PostgresPersistence(engine, owns=owns)
+    register_collector("persistence", persistence.metrics)
+    return persistence
@@ -0,0 +1,74 @@
+import hashlib
+import json
+from collections import OrderedDict
+from telegram.error import BadRequest
+from metrics import register_collector
+
+# حداکثر تعداد پیام‌هایی که هش محتوای آن‌ها نگهداری می‌شود
+MAX_ENTRIES = 20000
+
+
+class RenderCache:
+    """نگهداری هش آخرین محتوای نمایش داده شده در هر پیام برای جلوگیری از ویرایش‌های تکراری"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.edits_total = 0
+        self.avoided_total = 0
+        self.not_modified_total = 0
+
+    @staticmethod
+    def digest(text, parse_mode=None, reply_markup=None):
+        markup = json.dumps(reply_markup.to_dict(), sort_keys=True, ensure_ascii=False) if reply_markup else ""
+        content = f"{parse_mode}\x00{text}\x00{markup}".encode('utf-8')
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def remember(self, key, digest):
+        self._entries[key] = digest
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def metrics(self):
+        return {
+            "edits_total": self.edits_total,
+            "avoided_total": self.avoided_total,
+            "not_modified_total": self.not_modified_total,
+            "entries": len(self._entries),
+        }
+
+
+render_cache = RenderCache()
+register_collector("render_cache", render_cache.metrics)
+
+
+def _message_key(query):
+    if query.message:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+async def edit_message_text(query, text, parse_mode=None, reply_markup=None, **kwargs):
+    """ویرایش پیام کالبک فقط در صورتی که متن یا کیبورد واقعاً تغییر کرده باشد"""
+    key = _message_key(query)
+    digest = render_cache.digest(text, parse_mode, reply_markup)
+    if key is not None and render_cache.get(key) == digest:
+        render_cache.avoided_total += 1
+        return None
+
+    try:
+        result = await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        # پیام از قبل همین محتوا را دارد (مثلاً پس از راه‌اندازی مجدد و خالی بودن کش)
+        if "not modified" not in str(e).lower():
+            raise
+        render_cache.not_modified_total += 1
+        result = None
+
+    render_cache.edits_total += 1
+    if key is not None:
+        render_cache.remember(key, digest)
+    return result
@@ -0,0 +1,260 @@
+import asyncio
+import datetime
+import logging
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from models import ensure_reservation_partitions
+from capacity import capacity_manager
+from kitchen import kitchen_counters
+from rollover import ARCHIVE_SCHEMA, WEEKS_AHEAD
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# تعداد رزروهایی که در هر تراکنش حذف دسته‌ای پاک می‌شوند
+BATCH_SIZE = 5000
+
+# حداکثر زمان انتظار برای قفل جدا کردن پارتیشن‌ها یا TRUNCATE؛ پس از آن حذف دسته‌ای انجام می‌شود
+LOCK_TIMEOUT = "3s"
+
+# حداقل فاصله بین دو به‌روزرسانی پیام پیشرفت (ثانیه)
+PROGRESS_INTERVAL = 2
+
+# کد خطای Postgres برای پایان مهلت گرفتن قفل
+LOCK_NOT_AVAILABLE = "55P03"
+
+# کلید قفل advisory حذف رزروها؛ فقط یک حذف در همه پردازش‌ها (workerها و shardها) اجرا می‌شود
+CLEAR_LOCK_KEY = 7301946586
+
+# وظیفه حذف در حال اجرا در این پردازش
+_running = {}
+
+# متریک‌ها
+_stats = {"runs_total": 0, "fast_runs_total": 0, "deleted_total": 0, "failed_total": 0}
+
+
+def _is_lock_timeout(error):
+    return isinstance(error, OperationalError) and getattr(error.orig, "pgcode", None) == LOCK_NOT_AVAILABLE
+
+def _try_lock(engine):
+    """گرفتن قفل حذف روی اتصال اختصاصی؛ اگر حذف دیگری در حال اجرا باشد None برگردانده می‌شود"""
+    connection = engine.connect()
+    try:
+        acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": CLEAR_LOCK_KEY}).scalar()
+        connection.commit()
+    except Exception:
+        connection.close()
+        raise
+    if not acquired:
+        connection.close()
+        return None
+    return connection
+
+def _unlock(connection):
+    try:
+        connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": CLEAR_LOCK_KEY})
+        connection.commit()
+    except Exception:
+        # اتصال به pool برنمی‌گردد؛ با بسته شدن آن قفل در سمت دیتابیس آزاد می‌شود
+        connection.invalidate()
+        raise
+    finally:
+        connection.close()
+
+def _count(Session):
+    session = Session()
+    try:
+        return session.execute(text("SELECT count(*) FROM reservations")).scalar()
+    finally:
+        session.close()
+
+def _detach_partitions(Session, stamp):
+    """حذف سریع: جدا کردن همه پارتیشن‌ها و انتقال آن‌ها به schema بایگانی به عنوان نسخه پشتیبان
+
+    فقط metadata تغییر می‌کند؛ پارتیشن‌های خالی هفته جاری و هفته‌های آینده در همان تراکنش
+    دوباره ساخته می‌شوند و شمارنده‌های ظرفیت و آشپزخانه صفر می‌شوند.
+    """
+    session = Session()
+    try:
+        connection = session.connection()
+        connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        partitions = connection.execute(text("""
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'reservations'
+        """)).scalars().all()
+
+        connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        snapshots = []
+        for name in sorted(partitions):
+            snapshot = f"{name}_cleared_{stamp}"
+            connection.execute(text(f"ALTER TABLE reservations DETACH PARTITION {name}"))
+            connection.execute(text(f"ALTER TABLE {name} RENAME TO {snapshot}"))
+            connection.execute(text(f"ALTER TABLE {snapshot} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            snapshots.append(f"{ARCHIVE_SCHEMA}.{snapshot}")
+
+        ensure_reservation_partitions(connection, weeks=WEEKS_AHEAD)
+        capacity_manager.reset(session)
+        kitchen_counters.reset(session)
+        session.commit()
+        return snapshots
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _snapshot(Session, stamp):
+    """کپی رزروها در schema بایگانی پیش از حذف دسته‌ای؛ بیشترین شناسه کپی شده برگردانده می‌شود"""
+    snapshot = f"{ARCHIVE_SCHEMA}.reservations_snapshot_{stamp}"
+    session = Session()
+    try:
+        session.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        session.execute(text(f"CREATE TABLE {snapshot} AS SELECT * FROM reservations"))
+        max_id = session.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {snapshot}")).scalar()
+        session.commit()
+        return snapshot, max_id
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _truncate(Session):
+    """TRUNCATE در صورتی که قفل جدول در مهلت کوتاه به دست آید"""
+    session = Session()
+    try:
+        session.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        session.execute(text("TRUNCATE reservations"))
+        capacity_manager.reset(session)
+        kitchen_counters.reset(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _delete_batch(Session, max_id):
+    """حذف یک دسته از رزروهای موجود در نسخه پشتیبان در یک تراکنش کوتاه"""
+    session = Session()
+    try:
+        deleted = session.execute(text("""
+            DELETE FROM reservations WHERE id IN (
+                SELECT id FROM reservations WHERE id <= :max_id LIMIT :limit
+            )
+        """), {"max_id": max_id, "limit": BATCH_SIZE}).rowcount
+        session.commit()
+        return deleted
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _reconcile(Session):
+    session = Session()
+    try:
+        capacity_manager.reconcile(session)
+        kitchen_counters.reconcile(session)
+    finally:
+        session.close()
+
+async def _run_clear(Session, lock_connection, progress, on_done):
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    _stats["runs_total"] += 1
+    try:
+        total = await asyncio.to_thread(_count, Session)
+        await progress(f"\U0001F4BE تهیه نسخه پشتیبان از {total} رزرو...")
+
+        try:
+            snapshots = await asyncio.to_thread(_detach_partitions, Session, stamp)
+        except OperationalError as e:
+            if not _is_lock_timeout(e):
+                raise
+            logger.warning("قفل پارتیشن‌های رزرو در دسترس نبود؛ حذف دسته‌ای انجام می‌شود")
+        else:
+            _stats["fast_runs_total"] += 1
+            _stats["deleted_total"] += total
+            on_done()
+            logger.info(f"{total} رزرو حذف شد؛ نسخه پشتیبان: {', '.join(snapshots)}")
+            await progress(
+                f"\U00002705 تمام رزروها ({total} رزرو) حذف شدند.\n\n"
+                f"\U0001F4BE نسخه پشتیبان: {ARCHIVE_SCHEMA} ({len(snapshots)} جدول)",
+                done=True
+            )
+            return
+
+        snapshot, max_id = await asyncio.to_thread(_snapshot, Session, stamp)
+        try:
+            await asyncio.to_thread(_truncate, Session)
+            deleted = total
+        except OperationalError as e:
+            if not _is_lock_timeout(e):
+                raise
+            deleted = 0
+            last_progress = time.monotonic()
+            while True:
+                count = await asyncio.to_thread(_delete_batch, Session, max_id)
+                if not count:
+                    break
+                deleted += count
+                _stats["deleted_total"] += count
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await progress(f"\U0001F5D1 در حال حذف رزروها: {deleted} از {total}")
+            await asyncio.to_thread(_reconcile, Session)
+        else:
+            _stats["deleted_total"] += deleted
+
+        on_done()
+        logger.info(f"{deleted} رزرو حذف شد؛ نسخه پشتیبان: {snapshot}")
+        await progress(
+            f"\U00002705 تمام رزروها ({deleted} رزرو) حذف شدند.\n\n"
+            f"\U0001F4BE نسخه پشتیبان: {snapshot}",
+            done=True
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        _stats["failed_total"] += 1
+        logger.error(f"خطا در حذف رزروها: {e}")
+        await progress(f"\U0001F6AB در حذف رزروها خطایی رخ داد: {str(e)}", done=True)
+    finally:
+        _running.pop("clear", None)
+        try:
+            await asyncio.to_thread(_unlock, lock_connection)
+        except Exception as e:
+            logger.error(f"خطا در آزاد کردن قفل حذف رزروها: {e}")
+
+def is_clearing():
+    return "clear" in _running
+
+async def start_clear(engine, progress, on_done):
+    """شروع حذف همه رزروها در پس‌زمینه
+
+    progress(text, done=False) برای نمایش پیشرفت و نتیجه و on_done پس از حذف موفق فراخوانی می‌شود.
+    اگر حذف دیگری در این پردازش یا پردازش دیگری در حال اجرا باشد False برگردانده می‌شود؛
+    قفل advisory تا پایان حذف نگه داشته می‌شود.
+    """
+    if is_clearing():
+        return False
+    lock_connection = await asyncio.to_thread(_try_lock, engine)
+    if lock_connection is None:
+        return False
+    Session = sessionmaker(bind=engine)
+    _running["clear"] = asyncio.create_task(_run_clear(Session, lock_connection, progress, on_done))
+    return True
+
+async def stop_clear():
+    """توقف حذف در حال اجرا؛ دسته‌های حذف شده و نسخه پشتیبان باقی می‌مانند"""
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+register_collector("reservation_clear", lambda: {"running": len(_running), **_stats})
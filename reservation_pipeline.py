@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from models import Reservation
+from week_calendar import week_start
+from capacity import capacity_manager
+from kitchen import kitchen_counters
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# نتیجه هر درخواست رزرو
+RESULT_RESERVED = "reserved"
+RESULT_UPDATED = "updated"
+RESULT_SOLD_OUT = "sold_out"
+
+# فاصله جمع‌آوری درخواست‌ها پیش از ثبت گروهی (ثانیه)
+FLUSH_INTERVAL = 0.005
+
+# حداکثر تعداد درخواست در یک تراکنش
+MAX_BATCH = 500
+
+# نشانه توقف در صف؛ درخواست‌های پیش از آن ثبت می‌شوند و سپس پردازش صف پایان می‌یابد
+_STOP = object()
+
+# فعال‌سازی حالت ثبت گروهی با متغیر محیطی
+ENABLED = os.environ.get("RESERVATION_COALESCING", "").strip().lower() in ("1", "true", "yes")
+
+
+class _Intent:
+    __slots__ = ("student_id", "day", "reservation_date", "meal_type", "dish_id", "future")
+
+    def __init__(self, student_id, day, reservation_date, meal_type, dish_id, future):
+        self.student_id = student_id
+        self.day = day
+        self.reservation_date = reservation_date
+        self.meal_type = meal_type
+        self.dish_id = dish_id
+        self.future = future
+
+    @property
+    def key(self):
+        return (self.student_id, self.reservation_date, self.meal_type)
+
+
+class ReservationPipeline:
+    """جمع‌آوری درخواست‌های رزرو و ثبت آن‌ها با یک upsert چندسطری در هر تراکنش"""
+
+    def __init__(self):
+        self._queue = None
+        self._task = None
+        self._Session = None
+        self._batch = []  # دسته در حال ثبت
+
+        # متریک‌ها
+        self.intents_total = 0
+        self.commits_total = 0
+        self.failed_batches_total = 0
+        self.max_batch = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self, engine):
+        """شروع ثبت گروهی رزروها"""
+        if self.running:
+            return
+        self._Session = sessionmaker(bind=engine)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ثبت درخواست‌های باقی‌مانده و توقف
+
+        به جای لغو، نشانه توقف در صف قرار می‌گیرد تا دسته در حال ثبت و درخواست‌های صف
+        ثبت شوند و هر فراخواننده پاسخ خود را بگیرد؛ اگر خود توقف لغو شود، درخواست‌های
+        ثبت نشده لغو می‌شوند تا هیچ فراخواننده‌ای برای همیشه منتظر نماند.
+        """
+        if not self.running:
+            return
+        self._queue.put_nowait(_STOP)
+        try:
+            await asyncio.gather(self._task, return_exceptions=True)
+            # درخواست‌هایی که پس از نشانه توقف رسیده‌اند
+            while not self._queue.empty():
+                batch = [intent for intent in self._drain([]) if intent is not _STOP]
+                if batch:
+                    await self._flush(batch)
+        finally:
+            self._task = None
+            self._cancel_pending()
+
+    async def submit(self, student_id, day, reservation_date, meal_type, dish_id):
+        """ثبت درخواست رزرو؛ پس از commit تراکنش گروهی، نتیجه برگردانده می‌شود"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Intent(student_id, day, reservation_date, meal_type, dish_id, future))
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < MAX_BATCH and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    def _cancel_pending(self):
+        """لغو درخواست‌هایی که ثبت نشده‌اند (دسته در حال ثبت و صف)"""
+        pending = self._batch
+        self._batch = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for intent in pending:
+            if intent is not _STOP and not intent.future.done():
+                intent.future.cancel()
+
+    async def _run(self):
+        try:
+            while True:
+                first = await self._queue.get()
+                if first is _STOP:
+                    return
+                self._batch = [first]
+                await asyncio.sleep(FLUSH_INTERVAL)
+                self._drain(self._batch)
+                stopping = _STOP in self._batch
+                if stopping:
+                    self._batch.remove(_STOP)
+                await self._flush(self._batch)
+                self._batch = []
+                if stopping:
+                    return
+        except asyncio.CancelledError:
+            # لغو بدون stop (مثلاً بسته شدن حلقه رویداد)؛ ممکن است دسته در thread ثبت شده باشد ولی پاسخی داده نمی‌شود
+            self._cancel_pending()
+            raise
+
+    async def _flush(self, batch):
+        try:
+            results = await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            self.failed_batches_total += 1
+            logger.error(f"خطا در ثبت گروهی {len(batch)} رزرو: {e}")
+            for intent in batch:
+                if not intent.future.done():
+                    intent.future.set_exception(e)
+            return
+
+        for intent in batch:
+            if not intent.future.done():
+                intent.future.set_result(results[intent.key])
+
+    def _write(self, batch):
+        # درخواست‌های تکراری (مثلاً چند بار کلیک) در یک درخواست ادغام می‌شوند؛ آخرین درخواست معتبر است
+        latest = {}
+        for intent in batch:
+            latest[intent.key] = intent
+
+        session = self._Session()
+        try:
+            weeks = {week_start(intent.reservation_date) for intent in latest.values()}
+            existing = set(
+                session.query(Reservation.student_id, Reservation.reservation_date, Reservation.meal_type)
+                .filter(Reservation.week_start.in_(weeks))
+                .filter(tuple_(Reservation.student_id, Reservation.reservation_date, Reservation.meal_type).in_(list(latest)))
+                .all()
+            )
+
+            results = {}
+            rows = []
+            increments = {}
+            for key, intent in latest.items():
+                if key in existing:
+                    results[key] = RESULT_UPDATED
+                elif capacity_manager.try_reserve(session, intent.day, intent.meal_type):
+                    results[key] = RESULT_RESERVED
+                    counter_key = (intent.reservation_date, intent.meal_type)
+                    increments[counter_key] = (increments.get(counter_key, (0, 0))[0] + 1, 0)
+                else:
+                    results[key] = RESULT_SOLD_OUT
+                    continue
+                rows.append({
+                    "student_id": intent.student_id,
+                    "week_start": week_start(intent.reservation_date),
+                    "reservation_date": intent.reservation_date,
+                    "day": intent.day,
+                    "meal_type": intent.meal_type,
+                    "dish_id": intent.dish_id,
+                })
+
+            if rows:
+                statement = insert(Reservation).values(rows)
+                statement = statement.on_conflict_do_update(
+                    index_elements=["student_id", "reservation_date", "meal_type", "week_start"],
+                    set_={"dish_id": statement.excluded.dish_id}
+                )
+                session.execute(statement)
+            kitchen_counters.add_many(session, increments)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.intents_total += len(batch)
+        self.commits_total += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        return results
+
+    def metrics(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "intents_total": self.intents_total,
+            "commits_total": self.commits_total,
+            "failed_batches_total": self.failed_batches_total,
+            "max_batch": self.max_batch,
+        }
+
+
+# خط لوله مشترک ثبت گروهی رزروها
+reservation_pipeline = ReservationPipeline()
+register_collector("reservation_pipeline", reservation_pipeline.metrics)
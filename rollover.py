@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from models import ensure_reservation_partitions, archive_reservation_partitions
+from capacity import capacity_manager, ROLLOVER_LOCK_KEY
+from week_calendar import week_start, CACHE_PAST_DAYS
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# schema نگهداری پارتیشن‌های بایگانی شده رزروها
+ARCHIVE_SCHEMA = os.environ.get("RESERVATION_ARCHIVE_SCHEMA", "reservation_archive")
+
+# تعداد هفته‌های گذشته که پیش از بایگانی به جدول رزروها متصل می‌مانند؛ تاریخچه رزروها
+# (CACHE_PAST_DAYS روز گذشته) فقط از جدول رزروها خوانده می‌شود، پس پیش‌فرض تمام آن بازه را پوشش می‌دهد
+KEEP_WEEKS = int(os.environ.get("RESERVATION_KEEP_WEEKS", str(math.ceil(CACHE_PAST_DAYS / 7) + 1)))
+
+# تعداد هفته‌هایی (از هفته جاری) که پارتیشن آن‌ها از پیش ساخته می‌شود
+WEEKS_AHEAD = 3
+
+
+class WeeklyRollover:
+    """تغییر روزانه رزروهای فعال و هفتگی پارتیشن‌ها
+
+    هر شب پس از نیمه‌شب پارتیشن هفته‌های آینده ساخته می‌شود، پارتیشن هفته‌های قدیمی
+    از جدول رزروها جدا و به schema بایگانی منتقل می‌شود (بدون DELETE) و شمارنده‌های
+    ظرفیت با رزروهای امروز و روزهای آینده هم‌خوان می‌شوند.
+    """
+
+    def __init__(self):
+        self._Session = None
+        self._task = None
+
+        # متریک‌ها
+        self.runs_total = 0
+        self.archived_total = 0
+        self.last_run = 0.0
+
+    def run_once(self, today=None):
+        today = today or datetime.date.today()
+        session = self._Session()
+        try:
+            connection = session.connection()
+            if connection.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ROLLOVER_LOCK_KEY}).scalar():
+                ensure_reservation_partitions(connection, today, WEEKS_AHEAD)
+                archived = archive_reservation_partitions(
+                    connection, week_start(today) - datetime.timedelta(days=7 * KEEP_WEEKS), ARCHIVE_SCHEMA
+                )
+                session.commit()
+                if archived:
+                    self.archived_total += len(archived)
+                    logger.info(f"پارتیشن‌های رزرو بایگانی شدند: {', '.join(archived)}")
+                capacity_manager.reconcile(session)
+            else:
+                # پردازش دیگری در حال انجام تغییرات است؛ فقط کش ظرفیت به‌روز می‌شود
+                session.rollback()
+                capacity_manager.load(session)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.runs_total += 1
+        self.last_run = datetime.datetime.now().timestamp()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"خطا در تغییر روزانه رزروها: {e}")
+            # اجرای بعدی کمی پس از نیمه‌شب
+            now = datetime.datetime.now()
+            next_run = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, 1))
+            await asyncio.sleep((next_run - now).total_seconds())
+
+    async def start(self, engine):
+        self._Session = sessionmaker(bind=engine)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self):
+        return {
+            "runs_total": self.runs_total,
+            "archived_partitions_total": self.archived_total,
+            "last_run_timestamp": self.last_run,
+        }
+
+
+weekly_rollover = WeeklyRollover()
+register_collector("rollover", weekly_rollover.metrics)
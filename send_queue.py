@@ -0,0 +1,279 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import time
+from collections import deque
+from telegram.error import RetryAfter
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# اولویت‌های ارسال؛ عدد کمتر زودتر ارسال می‌شود
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# محدودیت‌های تلگرام: حدود ۳۰ پیام در ثانیه در کل و یک پیام در ثانیه برای هر چت
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+
+# حداکثر تعداد تلاش مجدد پس از خطای RetryAfter
+MAX_RETRIES = 5
+
+# حداکثر تعداد درخواست‌های هم‌زمان به API تلگرام
+MAX_CONCURRENCY = 8
+
+# سطل‌های چت بیکار پس از این مدت (ثانیه) حذف می‌شوند
+CHAT_BUCKET_IDLE = 60
+
+
+class TokenBucket:
+    """سطل توکن ساده برای محدود کردن نرخ ارسال"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def try_acquire(self):
+        """برداشتن یک توکن؛ در صورت نبود توکن، زمان انتظار لازم (ثانیه) برگردانده می‌شود"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ("chat_id", "call", "future", "enqueued_at", "attempts", "priority")
+
+    def __init__(self, chat_id, call, future, priority):
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SendQueue:
+    """صف مرکزی ارسال پیام به تلگرام با محدودیت نرخ سراسری و هر چت، اولویت‌بندی و مدیریت RetryAfter"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_concurrency=MAX_CONCURRENCY):
+        self._global_rate = global_rate
+        self._global_burst = global_burst
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self.share = 1
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._parked = {}
+        self._queue = None
+        self._semaphore = None
+        self._dispatcher = None
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._max_concurrency = max_concurrency
+
+        # متریک‌ها
+        self.sent_total = 0
+        self.failed_total = 0
+        self.retry_after_total = 0
+        self.wait_count = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.wait_sum = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BULK: 0.0}
+        self.wait_max = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BULK: 0.0}
+
+    @property
+    def running(self):
+        return self._dispatcher is not None and not self._dispatcher.done()
+
+    async def start(self):
+        """شروع پردازش صف در حلقه رویداد فعلی"""
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        """توقف پردازش صف و لغو درخواست‌های باقی‌مانده"""
+        if not self.running:
+            return
+        self._dispatcher.cancel()
+        try:
+            await self._dispatcher
+        except asyncio.CancelledError:
+            pass
+        self._dispatcher = None
+
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait()[2])
+        for parked in self._parked.values():
+            pending.extend(entry[2] for entry in parked)
+        self._parked.clear()
+        for job in pending:
+            if not job.future.done():
+                job.future.cancel()
+
+    def set_share(self, parts):
+        """تقسیم محدودیت سراسری تلگرام بین parts پردازشی که با یک توکن پیام ارسال می‌کنند"""
+        parts = max(1, int(parts))
+        self.share = parts
+        self._global_bucket = TokenBucket(self._global_rate / parts, max(1, self._global_burst // parts))
+
+    def depth(self):
+        """تعداد درخواست‌های در انتظار ارسال"""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + sum(len(parked) for parked in self._parked.values())
+
+    def enqueue(self, chat_id, call, priority=PRIORITY_INTERACTIVE):
+        """افزودن یک فراخوانی API به صف؛ call تابعی بدون آرگومان است که کوروتین برمی‌گرداند"""
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, call, future, priority)
+        if not self.running:
+            # اگر صف راه‌اندازی نشده باشد، بدون محدودیت ارسال می‌کنیم
+            asyncio.ensure_future(self._run_direct(job))
+            return future
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return future
+
+    async def submit(self, chat_id, call, priority=PRIORITY_INTERACTIVE):
+        """افزودن به صف و انتظار برای نتیجه"""
+        return await self.enqueue(chat_id, call, priority)
+
+    async def send_message(self, bot, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """ارسال پیام از طریق صف"""
+        return await self.submit(
+            chat_id,
+            lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs),
+            priority,
+        )
+
+    async def _run_direct(self, job):
+        try:
+            job.future.set_result(await job.call())
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._prune_chat_buckets()
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_chat_buckets(self):
+        now = time.monotonic()
+        idle = [chat_id for chat_id, bucket in self._chat_buckets.items()
+                if chat_id not in self._parked and now - bucket.updated > CHAT_BUCKET_IDLE]
+        for chat_id in idle:
+            del self._chat_buckets[chat_id]
+
+    def _release_parked(self, chat_id):
+        for entry in self._parked.pop(chat_id, ()):
+            self._queue.put_nowait(entry)
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            job = entry[2]
+            if job.future.cancelled():
+                continue
+
+            # رعایت ترتیب پیام‌های هر چت: اگر پیامی از همین چت منتظر است، پشت آن قرار می‌گیریم
+            if job.chat_id is not None:
+                if job.chat_id in self._parked:
+                    self._parked[job.chat_id].append(entry)
+                    continue
+                delay = self._chat_bucket(job.chat_id).try_acquire()
+                if delay > 0:
+                    self._parked[job.chat_id] = deque([entry])
+                    loop.call_later(delay, self._release_parked, job.chat_id)
+                    continue
+
+            # انتظار برای توکن سراسری و پایان دوره RetryAfter
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                delay = self._global_bucket.try_acquire()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            await self._semaphore.acquire()
+            asyncio.create_task(self._send(entry))
+
+    async def _send(self, entry):
+        priority, seq, job = entry
+        try:
+            job.attempts += 1
+            waited = time.monotonic() - job.enqueued_at
+            try:
+                result = await job.call()
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.retry_after_total += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"محدودیت نرخ تلگرام؛ توقف ارسال به مدت {retry_after} ثانیه")
+                if job.attempts <= MAX_RETRIES:
+                    self._queue.put_nowait(entry)
+                    return
+                self.failed_total += 1
+                job.future.set_exception(e)
+                return
+            except Exception as e:
+                self.failed_total += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+
+            self.sent_total += 1
+            bucket = job.priority if job.priority in self.wait_count else PRIORITY_BULK
+            self.wait_count[bucket] += 1
+            self.wait_sum[bucket] += waited
+            self.wait_max[bucket] = max(self.wait_max[bucket], waited)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._semaphore.release()
+
+    def metrics(self):
+        """متریک‌های صف برای خروجی /metrics"""
+        values = {
+            "queue_depth": self.depth(),
+            "sent_total": self.sent_total,
+            "failed_total": self.failed_total,
+            "retry_after_total": self.retry_after_total,
+            "chat_buckets": len(self._chat_buckets),
+            "global_rate_share": self.share,
+        }
+        for priority, label in ((PRIORITY_INTERACTIVE, "interactive"), (PRIORITY_BULK, "bulk")):
+            values[f"{label}_wait_seconds_count"] = self.wait_count[priority]
+            values[f"{label}_wait_seconds_sum"] = self.wait_sum[priority]
+            values[f"{label}_wait_seconds_max"] = self.wait_max[priority]
+        return values
+
+
+# صف مشترک ارسال برای کل ربات
+send_queue = SendQueue()
+register_collector("telegram_send", send_queue.metrics)
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# تعداد پردازش‌های پردازش‌کننده پیام‌ها؛ صفر یعنی پردازش در همان پردازش دریافت‌کننده
+SHARD_WORKERS = int(os.environ.get("BOT_WORKERS", "0"))
+
+# فاصله بررسی زنده بودن پردازش‌ها (ثانیه)
+SUPERVISE_INTERVAL = 1
+
+# پردازش‌ها با spawn ساخته می‌شوند تا اتصال‌های دیتابیس و حلقه رویداد والد را به ارث نبرند
+_context = multiprocessing.get_context("spawn")
+
+
+def shard_key(update):
+    """کلید تقسیم یک آپدیت؛ همه آپدیت‌های یک کاربر به یک پردازش می‌رسند تا ترتیب آن‌ها حفظ شود"""
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.update_id
+
+
+def owns(index, count):
+    """تابعی که مشخص می‌کند وضعیت یک کاربر متعلق به پردازش شماره index است یا نه"""
+    return lambda user_id: user_id % count == index
+
+
+def _worker_main(index, count, token, updates, sms_outbox):
+    """نقطه شروع هر پردازش؛ آپدیت‌ها را از صف خود می‌خواند و به ترتیب پردازش می‌کند"""
+    # ماژول ربات فقط در پردازش فرزند بارگذاری می‌شود
+    from bot_new import run_shard_worker
+    asyncio.run(run_shard_worker(token, updates, owns(index, count), sms_outbox))
+
+
+class ShardPool:
+    """توزیع آپدیت‌های دریافت شده از تلگرام بین چند پردازش بر اساس شناسه کاربر"""
+
+    def __init__(self, count=SHARD_WORKERS):
+        self.count = count
+        self._queues = []
+        self._processes = []
+        self._token = None
+        self._supervisor = None
+        self._sms_outbox = None
+        self._sms_forwarder = None
+        self._on_sms = None
+
+        # متریک‌ها
+        self.dispatched = [0] * count
+        self.restarts_total = 0
+
+    def _spawn(self, index):
+        process = _context.Process(
+            target=_worker_main,
+            args=(index, self.count, self._token, self._queues[index], self._sms_outbox),
+            name=f"bot-shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"پردازش شماره {index} با pid {process.pid} شروع شد")
+
+    async def start(self, token, on_sms=None):
+        """شروع پردازش‌ها؛ پیامک‌های پردازش‌ها با on_sms(body, phone, student_id) در رهبر ارسال می‌شوند"""
+        self._token = token
+        self._queues = [_context.Queue() for _ in range(self.count)]
+        self._sms_outbox = _context.Queue()
+        self._processes = [None] * self.count
+        for index in range(self.count):
+            self._spawn(index)
+        self._supervisor = asyncio.create_task(self._supervise())
+        self._on_sms = on_sms
+        if on_sms is not None:
+            self._sms_forwarder = asyncio.create_task(self._forward_sms())
+
+    async def _forward_sms(self):
+        # کارگر پیامک فقط در پردازش رهبر اجرا می‌شود؛ با رسیدن None (پس از توقف پردازش‌ها) تمام می‌شود
+        while True:
+            try:
+                item = await asyncio.to_thread(self._sms_outbox.get, True, SUPERVISE_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            body, phone, student_id = item
+            self._on_sms(body, phone=phone, student_id=student_id)
+
+    async def _supervise(self):
+        # هر پردازش مستقل از بقیه دوباره راه‌اندازی می‌شود؛ صف آن در والد باقی می‌ماند و آپدیت‌ها از دست نمی‌روند
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.warning(f"پردازش شماره {index} با کد {process.exitcode} متوقف شد؛ راه‌اندازی مجدد")
+                    self.restarts_total += 1
+                    self._spawn(index)
+
+    async def dispatch(self, update, context=None):
+        """ارسال آپدیت به پردازش مربوط به کاربر (به عنوان TypeHandler در پردازش دریافت‌کننده)"""
+        index = shard_key(update) % self.count
+        self._queues[index].put(update.to_dict())
+        self.dispatched[index] += 1
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+
+        # پیام None به هر پردازش می‌گوید پس از پردازش آپدیت‌های باقی‌مانده متوقف شود
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 30)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        self._queues = []
+
+        # پیامک‌های باقی‌مانده پردازش‌های متوقف شده پیش از None در صف هستند و به کارگر پیامک رهبر می‌رسند
+        if self._sms_forwarder is not None:
+            self._sms_outbox.put(None)
+            await asyncio.gather(self._sms_forwarder, return_exceptions=True)
+            self._sms_forwarder = None
+
+    def metrics(self):
+        values = {"workers": self.count, "restarts_total": self.restarts_total}
+        for index in range(self.count):
+            values[f"dispatched_total_{index}"] = self.dispatched[index]
+            try:
+                values[f"queue_size_{index}"] = self._queues[index].qsize()
+            except (NotImplementedError, IndexError):
+                pass
+        return values
+
+
+async def read_updates(updates):
+    """خواندن آپدیت‌ها از صف بین پردازشی؛ با رسیدن None متوقف می‌شود"""
+    while True:
+        try:
+            data = await asyncio.to_thread(updates.get, True, SUPERVISE_INTERVAL)
+        except queue.Empty:
+            # پردازش والد از بین رفته است
+            if multiprocessing.parent_process() is not None and not multiprocessing.parent_process().is_alive():
+                return
+            continue
+        if data is None:
+            return
+        yield data
+
+
+def create_shard_pool():
+    """ساخت مجموعه پردازش‌ها و ثبت متریک‌های آن"""
+    pool = ShardPool()
+    register_collector("shards", pool.metrics)
+    return pool
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import urllib.request
+from sqlalchemy.orm import sessionmaker
+from models import Student
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# حداکثر تعداد پیامک در هر دسته
+BATCH_SIZE = 50
+
+# حداکثر زمان انتظار برای تکمیل یک دسته (ثانیه)
+BATCH_INTERVAL = 2.0
+
+# حداکثر تعداد ارسال هم‌زمان
+MAX_CONCURRENCY = 5
+
+# تعداد تلاش مجدد و تاخیر پایه (ثانیه) برای تلاش مجدد
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 2.0
+
+# ظرفیت صف؛ در صورت پر بودن، پیامک جدید کنار گذاشته می‌شود تا هندلرها منتظر نمانند
+QUEUE_SIZE = 10000
+
+
+class SmsMessage:
+    """یک پیامک در صف؛ اگر شماره مشخص نباشد از روی شناسه دانشجو پیدا می‌شود"""
+    __slots__ = ("phone", "student_id", "body", "attempts")
+
+    def __init__(self, body, phone=None, student_id=None):
+        self.body = body
+        self.phone = phone
+        self.student_id = student_id
+        self.attempts = 0
+
+
+class TwilioTransport:
+    """ارسال پیامک از طریق Twilio"""
+
+    def __init__(self, account_sid, auth_token, from_number):
+        from twilio.rest import Client
+        self.client = Client(account_sid, auth_token)
+        self.from_number = from_number
+
+    async def send(self, phone, body):
+        await asyncio.to_thread(self.client.messages.create, to=phone, from_=self.from_number, body=body)
+
+
+class FileTransport:
+    """نوشتن پیامک‌ها در فایل (برای توسعه و تست)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, phone, body):
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({"to": phone, "body": body, "time": time.time()}, ensure_ascii=False) + "\n")
+
+    async def send(self, phone, body):
+        await asyncio.to_thread(self._write, phone, body)
+
+
+class HttpTransport:
+    """ارسال پیامک به یک آدرس HTTP به صورت JSON (برای سرویس‌های جایگزین یا تست)"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, phone, body):
+        data = json.dumps({"to": phone, "body": body}, ensure_ascii=False).encode('utf-8')
+        request = urllib.request.Request(self.url, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    async def send(self, phone, body):
+        await asyncio.to_thread(self._post, phone, body)
+
+
+def transport_from_env():
+    """انتخاب روش ارسال پیامک بر اساس متغیر محیطی SMS_TRANSPORT"""
+    kind = os.environ.get("SMS_TRANSPORT", "").strip().lower()
+    if kind == "twilio":
+        return TwilioTransport(
+            os.environ.get("TWILIO_ACCOUNT_SID"),
+            os.environ.get("TWILIO_AUTH_TOKEN"),
+            os.environ.get("TWILIO_FROM_NUMBER"),
+        )
+    if kind == "file":
+        return FileTransport(os.environ.get("SMS_FILE", "sms_outbox.jsonl"))
+    if kind == "http":
+        return HttpTransport(os.environ.get("SMS_HTTP_URL"))
+    return None
+
+
+class SmsWorker:
+    """صف و کارگر ناهمگام ارسال دسته‌ای پیامک با محدودیت هم‌زمانی و تلاش مجدد"""
+
+    def __init__(self, transport=None):
+        self.transport = transport
+        self._queue = None
+        self._task = None
+        self._Session = None
+        self._retry_tasks = set()
+        self._forward = None
+
+        # متریک‌ها
+        self.sent_total = 0
+        self.failed_total = 0
+        self.retried_total = 0
+        self.dropped_total = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self, engine, transport=None):
+        """شروع کارگر پیامک؛ بدون روش ارسال، پیامک‌ها نادیده گرفته می‌شوند"""
+        if transport is not None:
+            self.transport = transport
+        if self.transport is None or self.running:
+            return
+        self._Session = sessionmaker(bind=engine)
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """توقف کارگر پیامک"""
+        if not self.running:
+            return
+        self._task.cancel()
+        for task in list(self._retry_tasks):
+            task.cancel()
+        await asyncio.gather(self._task, *self._retry_tasks, return_exceptions=True)
+        self._task = None
+
+    def forward_to(self, outbox):
+        """ارسال پیامک‌های این پردازش از طریق صف بین پردازشی به پردازش رهبر (در پردازش‌های shard)"""
+        self._forward = outbox
+
+    def enqueue(self, body, phone=None, student_id=None):
+        """افزودن پیامک به صف بدون انتظار؛ هندلرها هیچ تاخیری از ارسال پیامک نمی‌بینند"""
+        if self._forward is not None:
+            self._forward.put((body, phone, student_id))
+            return True
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait(SmsMessage(body, phone=phone, student_id=student_id))
+            return True
+        except asyncio.QueueFull:
+            self.dropped_total += 1
+            return False
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + BATCH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _resolve_phones(self, student_ids):
+        session = self._Session()
+        try:
+            rows = session.query(Student.id, Student.phone).filter(Student.id.in_(student_ids)).all()
+            return {student_id: phone for student_id, phone in rows}
+        finally:
+            session.close()
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        while True:
+            batch = await self._next_batch()
+
+            # پیدا کردن شماره‌ها به صورت یکجا برای پیامک‌هایی که فقط شناسه دانشجو دارند
+            missing = {message.student_id for message in batch if not message.phone and message.student_id}
+            if missing:
+                try:
+                    phones = await asyncio.to_thread(self._resolve_phones, list(missing))
+                except Exception as e:
+                    logger.error(f"خطا در دریافت شماره تلفن دانشجویان: {e}")
+                    phones = {}
+                for message in batch:
+                    if not message.phone and message.student_id:
+                        message.phone = phones.get(message.student_id)
+
+            batch = [message for message in batch if message.phone]
+            await asyncio.gather(*(self._send(message, semaphore) for message in batch))
+
+    async def _send(self, message, semaphore):
+        async with semaphore:
+            message.attempts += 1
+            try:
+                await self.transport.send(message.phone, message.body)
+                self.sent_total += 1
+            except Exception as e:
+                if message.attempts > MAX_RETRIES:
+                    self.failed_total += 1
+                    logger.error(f"ارسال پیامک به {message.phone} ناموفق بود: {e}")
+                    return
+                self.retried_total += 1
+                delay = RETRY_BASE_DELAY * 2 ** (message.attempts - 1)
+                task = asyncio.create_task(self._requeue(message, delay))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+
+    async def _requeue(self, message, delay):
+        await asyncio.sleep(delay)
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped_total += 1
+
+    def metrics(self):
+        """متریک‌های صف پیامک"""
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "sent_total": self.sent_total,
+            "failed_total": self.failed_total,
+            "retried_total": self.retried_total,
+            "dropped_total": self.dropped_total,
+        }
+
+
+# کارگر مشترک پیامک برای کل ربات
+sms_worker = SmsWorker()
+register_collector("sms", sms_worker.metrics)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from telegram.ext import ConversationHandler
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# مدت بی‌فعالیتی (ثانیه) که پس از آن وضعیت مکالمه و user_data کاربر حذف می‌شود
+STATE_TTL = 30 * 60
+
+# فاصله اجرای پاک‌سازی (ثانیه)
+SWEEP_INTERVAL = 5 * 60
+
+
+class StateSweeper:
+    """حذف وضعیت مکالمه‌ها و user_data کاربرانی که مدتی فعالیت نداشته‌اند"""
+
+    def __init__(self, ttl=STATE_TTL, interval=SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.interval = interval
+        self._last_seen = {}
+        self._conversation_handlers = []
+        self._started = time.monotonic()
+        self._task = None
+        self._application = None
+
+        # متریک‌ها
+        self.evicted_conversations_total = 0
+        self.evicted_user_data_total = 0
+
+    def register(self, conversation_handler):
+        """ثبت ConversationHandler برای پاک‌سازی مکالمه‌های رها شده"""
+        self._conversation_handlers.append(conversation_handler)
+
+    async def touch(self, update, context):
+        """ثبت زمان آخرین فعالیت کاربر (به عنوان TypeHandler در گروه -1 اجرا می‌شود)"""
+        if update.effective_user:
+            self._last_seen[update.effective_user.id] = time.monotonic()
+
+    async def start(self, application):
+        """شروع پاک‌سازی دوره‌ای"""
+        self._application = application
+        self._started = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # با ساخت Application جدید (مثلاً پس از تغییر رهبر) مدیریت‌کننده‌ها دوباره ثبت می‌شوند
+        self._conversation_handlers = []
+        self._application = None
+        self._last_seen.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"خطا در پاک‌سازی وضعیت کاربران: {e}")
+
+    def _is_idle(self, user_id, now):
+        return now - self._last_seen.get(user_id, self._started) > self.ttl
+
+    def sweep(self):
+        """حذف وضعیت کاربران بی‌فعالیت؛ تعداد مکالمه‌ها و user_data حذف شده برگردانده می‌شود"""
+        now = time.monotonic()
+        evicted_conversations = 0
+        evicted_user_data = 0
+
+        for handler in self._conversation_handlers:
+            # کلید مکالمه‌ها (chat_id, user_id) است؛ ConversationHandler متد عمومی برای پایان دادن ندارد
+            conversations = handler._conversations
+            for key, state in list(conversations.items()):
+                if isinstance(state, int) and self._is_idle(key[-1], now):
+                    handler._update_state(ConversationHandler.END, key)
+                    evicted_conversations += 1
+
+        if self._application is not None:
+            for user_id, data in list(self._application.user_data.items()):
+                if data and self._is_idle(user_id, now):
+                    self._application.drop_user_data(user_id)
+                    evicted_user_data += 1
+
+        for user_id in [user_id for user_id in self._last_seen if self._is_idle(user_id, now)]:
+            del self._last_seen[user_id]
+
+        self.evicted_conversations_total += evicted_conversations
+        self.evicted_user_data_total += evicted_user_data
+        if evicted_conversations or evicted_user_data:
+            logger.info(
+                f"پاک‌سازی وضعیت: {evicted_conversations} مکالمه و {evicted_user_data} user_data حذف شد؛ "
+                f"{self.conversation_count()} مکالمه و {self.user_data_count()} user_data باقی ماند"
+            )
+        return evicted_conversations, evicted_user_data
+
+    def conversation_count(self):
+        return sum(len(handler._conversations) for handler in self._conversation_handlers)
+
+    def user_data_count(self):
+        if self._application is None:
+            return 0
+        return sum(1 for data in self._application.user_data.values() if data)
+
+    def metrics(self):
+        return {
+            "conversations": self.conversation_count(),
+            "user_data": self.user_data_count(),
+            "tracked_users": len(self._last_seen),
+            "evicted_conversations_total": self.evicted_conversations_total,
+            "evicted_user_data_total": self.evicted_user_data_total,
+        }
+
+
+# پاک‌کننده مشترک وضعیت کاربران
+state_sweeper = StateSweeper()
+register_collector("user_state", state_sweeper.metrics)
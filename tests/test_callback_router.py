@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import types
+import pytest
+from callback_router import CallbackRouter, ChoiceField, DateField, IntField, MAX_CALLBACK_BYTES
+
+DAYS = ["saturday", "sunday", "monday"]
+MEALS = ["breakfast", "lunch", "dinner"]
+
+
+async def _noop(update, context, *values):
+    pass
+
+
+@pytest.fixture
+def router():
+    router = CallbackRouter()
+    router.add("res", _noop, ChoiceField(DAYS), ChoiceField(MEALS))
+    router.add("dlv", _noop, IntField())
+    router.add("dt", _noop, DateField())
+    router.add("menu", _noop)
+    router.add("all", _noop, IntField())
+    router.add_legacy("reserve_", "res")
+    router.add_legacy("deliver_", "dlv")
+    router.add_legacy("deliver_all_", "all")
+    return router
+
+
+def test_encode_is_compact(router):
+    assert router.encode("res", "monday", "dinner") == "res|2|2"
+    assert router.encode("dlv", 1234) == "dlv|1234"
+    assert router.encode("menu") == "menu"
+
+
+def test_round_trip(router):
+    date = datetime.date(2026, 10, 19)
+    assert router.decode(router.encode("res", "sunday", "lunch")) == ("res", ["sunday", "lunch"])
+    assert router.decode(router.encode("dlv", 42)) == ("dlv", [42])
+    assert router.decode(router.encode("dt", date)) == ("dt", [date])
+    assert router.decode(router.encode("menu")) == ("menu", [])
+
+
+def test_choice_field_accepts_full_names(router):
+    assert router.decode("res|monday|dinner") == ("res", ["monday", "dinner"])
+
+
+def test_legacy_prefixes(router):
+    assert router.decode("reserve_monday_lunch") == ("res", ["monday", "lunch"])
+    assert router.decode("deliver_17") == ("dlv", [17])
+
+
+def test_longest_legacy_prefix_wins(router):
+    assert router.decode("deliver_all_5") == ("all", [5])
+
+
+@pytest.mark.parametrize("data", [
+    "unknown",
+    "res|9|0",
+    "res|1",
+    "dlv|abc",
+    "dlv|1|2",
+    "reserve_monday",
+    "reserve_monday_brunch",
+])
+def test_invalid_data_decodes_to_none(router, data):
+    assert router.decode(data) is None
+
+
+def test_encode_validates(router):
+    with pytest.raises(ValueError):
+        router.encode("res", "monday")
+    router.add("long", _noop, IntField())
+    with pytest.raises(ValueError):
+        router.encode("long", 10 ** MAX_CALLBACK_BYTES)
+    with pytest.raises(ValueError):
+        router.add("a|b", _noop)
+
+
+def test_dispatch_calls_handler_and_hooks(router):
+    received = []
+    timings = []
+
+    async def handler(update, context, day, meal):
+        received.append((day, meal))
+
+    router.add("res", handler, ChoiceField(DAYS), ChoiceField(MEALS))
+    router.add_hook(lambda name, elapsed, error: timings.append((name, error)))
+
+    def update(data):
+        return types.SimpleNamespace(callback_query=types.SimpleNamespace(data=data))
+
+    assert asyncio.run(router.dispatch(update("res|0|1"), None)) is True
+    assert asyncio.run(router.dispatch(update("nothing"), None)) is False
+    assert received == [("saturday", "lunch")]
+    assert timings == [("res", None)]
@@ -0,0 +1,137 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, sessionmaker
+import circuit_breaker
+from circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, is_db_unavailable,
+)
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return clock
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=15)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == STATE_CLOSED
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert breaker.opened_total == 1
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == STATE_CLOSED
+
+
+def test_open_breaker_rejects(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.rejected_total == 1
+
+
+def test_is_open_does_not_change_state(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    clock.now += 20
+    assert breaker.is_open
+    assert breaker.is_open
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_allows_single_probe(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    clock.now += 15
+    assert breaker.allow()
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.is_open
+    assert not breaker.allow()
+    assert not breaker.allow()
+
+
+def test_probe_success_closes(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    clock.now += 15
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == STATE_CLOSED
+    assert not breaker.is_open
+    assert breaker.allow() and breaker.allow()
+
+
+def test_probe_failure_reopens(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    clock.now += 15
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert breaker.opened_total == 2
+    assert not breaker.allow()
+    clock.now += 15
+    assert breaker.allow()
+
+
+def test_lost_probe_is_replaced_after_timeout(clock):
+    breaker = CircuitBreaker(reset_timeout=15)
+    _open(breaker)
+    clock.now += 15
+    assert breaker.allow()
+    clock.now += 14
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_attach_only_guards_given_sessions(clock):
+    engine = create_engine("sqlite://")
+    breaker = CircuitBreaker()
+    guarded = Session(engine)
+    Primary = sessionmaker(bind=engine)
+    Other = sessionmaker(bind=engine)
+    breaker.attach(engine, guarded, Primary)
+
+    assert guarded.execute(text("SELECT 1")).scalar() == 1
+    breaker.state = STATE_OPEN
+    breaker._opened_at = clock.now
+
+    with pytest.raises(CircuitOpenError):
+        guarded.execute(text("SELECT 1"))
+    with pytest.raises(CircuitOpenError):
+        Primary().execute(text("SELECT 1"))
+    assert Other().execute(text("SELECT 1")).scalar() == 1
+    assert Session(engine).execute(text("SELECT 1")).scalar() == 1
+
+
+def test_is_db_unavailable():
+    assert is_db_unavailable(CircuitOpenError())
+    assert not is_db_unavailable(ValueError())
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from dedupe import CallbackDeduplicator, SingleFlight
+
+
+def test_duplicate_click_joins_running_handler():
+    calls = []
+
+    async def run():
+        deduplicator = CallbackDeduplicator()
+        release = asyncio.Event()
+
+        async def handler():
+            calls.append(1)
+            await release.wait()
+
+        first = asyncio.create_task(deduplicator.run(1, 10, "res|0|1", handler))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(deduplicator.run(1, 10, "res|0|1", handler))
+        await asyncio.sleep(0)
+        # کلیک تکراری تا پایان کلیک در حال اجرا منتظر می‌ماند
+        assert not second.done()
+        release.set()
+        return await first, await second, deduplicator
+
+    first, second, deduplicator = asyncio.run(run())
+    assert (first, second) == (True, False)
+    assert calls == [1]
+    assert deduplicator.handled_total == 1
+    assert deduplicator.duplicates_total == 1
+
+
+def test_click_after_handler_finished_runs_again():
+    calls = []
+
+    async def handler():
+        calls.append(1)
+
+    async def run():
+        deduplicator = CallbackDeduplicator()
+        results = [await deduplicator.run(1, 10, "data", handler) for _ in range(2)]
+        return results, deduplicator
+
+    results, deduplicator = asyncio.run(run())
+    assert results == [True, True]
+    assert len(calls) == 2
+    assert deduplicator.duplicates_total == 0
+
+
+def test_different_data_message_or_user_is_not_duplicate():
+    calls = []
+
+    async def handler():
+        calls.append(1)
+
+    async def run():
+        deduplicator = CallbackDeduplicator()
+        return [
+            await deduplicator.run(1, 10, "a", handler),
+            await deduplicator.run(1, 10, "b", handler),
+            await deduplicator.run(1, 11, "b", handler),
+            await deduplicator.run(2, 11, "b", handler),
+        ]
+
+    assert asyncio.run(run()) == [True, True, True, True]
+    assert len(calls) == 4
+
+
+def test_failed_handler_is_released():
+    async def failing():
+        raise RuntimeError("boom")
+
+    async def ok():
+        return None
+
+    async def run():
+        deduplicator = CallbackDeduplicator()
+        with pytest.raises(RuntimeError):
+            await deduplicator.run(1, 10, "data", failing)
+        return await deduplicator.run(1, 10, "data", ok), deduplicator
+
+    handled, deduplicator = asyncio.run(run())
+    assert handled is True
+    assert deduplicator.metrics()["tracked"] == 0
+
+
+def test_single_flight_shares_result():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(3)))
+        return results, flight
+
+    results, flight = asyncio.run(run())
+    assert results == ["value"] * 3
+    assert calls == [1]
+    assert flight.shared_total == 2
+    assert flight.metrics()["inflight"] == 0
@@ -0,0 +1,56 @@
+import io
+import types
+import pytest
+from export import COLUMNS, UTF8_BOM, _write_csv
+
+
+class FakeCursor:
+    """cursor شبیه psycopg2 که خروجی COPY را در چند بخش می‌نویسد"""
+
+    def __init__(self, chunks, statusmessage=None):
+        self.chunks = chunks
+        self.statusmessage = statusmessage
+        self.rowcount = -1
+        self.sql = None
+        self.closed = False
+
+    def mogrify(self, query, params):
+        return query.encode("utf-8")
+
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        for chunk in self.chunks:
+            file.write(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+def _connection(cursor):
+    return types.SimpleNamespace(connection=types.SimpleNamespace(cursor=lambda: cursor))
+
+
+ROWS = [b'1,2026-10-19,monday,lunch,"\xd9\x82\xd9\x88\xd8\xb1\xd9\x85\xd9\x87",1001\n', b'2,2026-10-19,monday,din', b'ner,x,1002\n']
+
+
+@pytest.mark.parametrize("statusmessage", [None, "", "SELECT 1"])
+def test_csv_rows_counted_from_written_lines(statusmessage):
+    cursor = FakeCursor(ROWS, statusmessage)
+    file = io.BytesIO()
+    assert _write_csv(_connection(cursor), "SELECT 1", {}, file) == 2
+    assert cursor.closed
+    assert cursor.sql == "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv)"
+
+    header, *rows = file.getvalue().splitlines()
+    assert header.startswith(UTF8_BOM)
+    assert header[len(UTF8_BOM):].decode("utf-8").split(",")[0] == f'"{COLUMNS[0]}"'
+    assert len(rows) == 2
+
+
+def test_csv_rows_taken_from_copy_status():
+    # خط جدید داخل مقدار نقل‌قول شده سطر جدید نیست
+    cursor = FakeCursor([b'1,"two\nlines",1001\n'], "COPY 1")
+    assert _write_csv(_connection(cursor), "SELECT 1", {}, io.BytesIO()) == 1
+
+    cursor = FakeCursor([], "COPY 0")
+    assert _write_csv(_connection(cursor), "SELECT 1", {}, io.BytesIO()) == 0
@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+import threading
+import pytest
+from reservation_pipeline import ReservationPipeline, RESULT_RESERVED
+
+DATE = datetime.date(2026, 10, 19)
+
+
+class FakePipeline(ReservationPipeline):
+    """ثبت بدون پایگاه داده؛ هر فراخوانی _write تا آزاد شدن gate منتظر می‌ماند"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.writing = threading.Event()
+        self.written = []
+
+    def _write(self, batch):
+        self.writing.set()
+        self.gate.wait(5)
+        self.written.append([intent.student_id for intent in batch])
+        return {intent.key: RESULT_RESERVED for intent in batch}
+
+
+def _submit(pipeline, student_id):
+    return asyncio.ensure_future(pipeline.submit(student_id, "monday", DATE, "lunch", 1))
+
+
+def test_submit_is_batched():
+    async def run():
+        pipeline = FakePipeline()
+        await pipeline.start(None)
+        try:
+            futures = [_submit(pipeline, i) for i in range(3)]
+            return pipeline, await asyncio.wait_for(asyncio.gather(*futures), 5)
+        finally:
+            await pipeline.stop()
+
+    pipeline, results = asyncio.run(run())
+    assert results == [RESULT_RESERVED] * 3
+    assert pipeline.written == [[0, 1, 2]]
+
+
+def test_stop_waits_for_batch_in_flight():
+    async def run():
+        pipeline = FakePipeline()
+        pipeline.gate.clear()
+        await pipeline.start(None)
+        first = _submit(pipeline, 1)
+        await asyncio.to_thread(pipeline.writing.wait, 5)
+        # درخواستی که هنگام ثبت دسته اول می‌رسد
+        second = _submit(pipeline, 2)
+        await asyncio.sleep(0)
+        stopping = asyncio.ensure_future(pipeline.stop())
+        await asyncio.sleep(0.01)
+        pipeline.gate.set()
+        await asyncio.wait_for(stopping, 5)
+        return pipeline, await first, await second
+
+    pipeline, first, second = asyncio.run(run())
+    assert (first, second) == (RESULT_RESERVED, RESULT_RESERVED)
+    assert pipeline.written == [[1], [2]]
+    assert not pipeline.running
+
+
+def test_cancelled_stop_cancels_pending_futures():
+    async def run():
+        pipeline = FakePipeline()
+        pipeline.gate.clear()
+        await pipeline.start(None)
+        first = _submit(pipeline, 1)
+        await asyncio.to_thread(pipeline.writing.wait, 5)
+        second = _submit(pipeline, 2)
+        await asyncio.sleep(0)
+        stopping = asyncio.ensure_future(pipeline.stop())
+        await asyncio.sleep(0.01)
+        stopping.cancel()
+        await asyncio.gather(stopping, return_exceptions=True)
+        pipeline.gate.set()
+        return first, second
+
+    first, second = asyncio.run(run())
+    for future in (first, second):
+        with pytest.raises(asyncio.CancelledError):
+            future.result()
@@ -0,0 +1,151 @@
+import asyncio
+import pytest
+from telegram.error import RetryAfter
+import send_queue as send_queue_module
+from send_queue import TokenBucket, SendQueue, MAX_RETRIES, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(send_queue_module.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    for _ in range(3):
+        bucket.try_acquire()
+
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+    # پس از مدت طولانی بیش از ظرفیت توکن جمع نمی‌شود
+    clock.now += 60
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() > 0
+
+
+def test_set_share_divides_global_rate():
+    queue = SendQueue(global_rate=30.0, global_burst=30)
+    queue.set_share(3)
+    assert queue.share == 3
+    assert queue._global_bucket.rate == pytest.approx(10.0)
+    assert queue._global_bucket.capacity == 10
+
+    queue.set_share(0)
+    assert queue.share == 1
+    assert queue._global_bucket.rate == pytest.approx(30.0)
+
+
+def _fast_queue():
+    return SendQueue(global_rate=1000.0, global_burst=1000, chat_rate=1000.0, chat_burst=1000)
+
+
+def test_retry_after_retries_same_call():
+    calls = []
+
+    async def call():
+        calls.append(asyncio.get_running_loop().time())
+        if len(calls) == 1:
+            raise RetryAfter(0.05)
+        return "sent"
+
+    async def run():
+        queue = _fast_queue()
+        await queue.start()
+        try:
+            return queue, await asyncio.wait_for(queue.submit(1, call), 5)
+        finally:
+            await queue.stop()
+
+    queue, result = asyncio.run(run())
+    assert result == "sent"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.04
+    assert queue.retry_after_total == 1
+    assert queue.sent_total == 1
+    assert queue.failed_total == 0
+
+
+def test_retry_after_gives_up_after_max_retries():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise RetryAfter(0.001)
+
+    async def run():
+        queue = _fast_queue()
+        await queue.start()
+        try:
+            with pytest.raises(RetryAfter):
+                await asyncio.wait_for(queue.submit(1, call), 5)
+            return queue
+        finally:
+            await queue.stop()
+
+    queue = asyncio.run(run())
+    assert len(calls) == MAX_RETRIES + 1
+    assert queue.retry_after_total == MAX_RETRIES + 1
+    assert queue.failed_total == 1
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    async def run():
+        queue = _fast_queue()
+        await queue.start()
+        try:
+            with pytest.raises(ValueError):
+                await asyncio.wait_for(queue.submit(1, call), 5)
+            return queue
+        finally:
+            await queue.stop()
+
+    queue = asyncio.run(run())
+    assert len(calls) == 1
+    assert queue.failed_total == 1
+
+
+def test_interactive_sent_before_bulk():
+    order = []
+
+    def call(name):
+        async def send():
+            order.append(name)
+        return send
+
+    async def run():
+        queue = SendQueue(max_concurrency=1)
+        await queue.start()
+        try:
+            # صف پیش از اجرای dispatcher پر می‌شود
+            futures = [queue.enqueue(None, call(f"bulk{i}"), PRIORITY_BULK) for i in range(3)]
+            futures.append(queue.enqueue(None, call("interactive"), PRIORITY_INTERACTIVE))
+            await asyncio.wait_for(asyncio.gather(*futures), 5)
+        finally:
+            await queue.stop()
+
+    asyncio.run(run())
+    assert order == ["interactive", "bulk0", "bulk1", "bulk2"]
@@ -0,0 +1,64 @@
+import datetime
+import pytest
+from week_calendar import (
+    WEEKDAYS, BOOKING_DAYS, JalaliCalendar, upcoming_date, week_start, weekday_name,
+)
+
+# شنبه ۲۵ مهر ۱۴۰۵
+SATURDAY = datetime.date(2026, 10, 17)
+
+
+@pytest.mark.parametrize("offset", range(7))
+def test_week_start_is_the_saturday_of_the_week(offset):
+    assert week_start(SATURDAY + datetime.timedelta(days=offset)) == SATURDAY
+
+
+def test_week_start_of_friday_is_previous_saturday():
+    assert week_start(SATURDAY - datetime.timedelta(days=1)) == SATURDAY - datetime.timedelta(days=7)
+
+
+def test_week_start_across_year_boundary():
+    assert week_start(datetime.date(2027, 1, 1)) == datetime.date(2026, 12, 26)
+
+
+def test_upcoming_date_is_today_or_later():
+    today = datetime.date(2026, 10, 19)
+    assert weekday_name(today) == "monday"
+    assert upcoming_date("monday", today) == today
+    assert upcoming_date("tuesday", today) == datetime.date(2026, 10, 20)
+    assert upcoming_date("sunday", today) == datetime.date(2026, 10, 25)
+
+
+@pytest.mark.parametrize("day", WEEKDAYS)
+def test_upcoming_date_matches_day(day):
+    today = datetime.date(2026, 10, 19)
+    date = upcoming_date(day, today)
+    assert weekday_name(date) == day
+    assert 0 <= (date - today).days < 7
+
+
+def test_jalali_labels():
+    calendar = JalaliCalendar()
+    assert calendar.label(datetime.date(2024, 3, 20)) == "1403/01/01"
+    assert calendar.label(SATURDAY) == "1405/07/25"
+
+
+def test_jalali_cache_window():
+    calendar = JalaliCalendar(past_days=2, ahead_days=2)
+    today = datetime.date.today()
+    calendar.label(today)
+    calendar.label(today + datetime.timedelta(days=2))
+    assert calendar.hits == 2
+    calendar.label(today + datetime.timedelta(days=3))
+    assert calendar.misses == 1
+    assert calendar.metrics()["cached_dates"] == 5
+
+
+def test_booking_dates():
+    calendar = JalaliCalendar()
+    today = datetime.date.today()
+    dates = calendar.booking_dates()
+    assert dates == [today + datetime.timedelta(days=offset) for offset in range(BOOKING_DAYS)]
+    assert calendar.is_bookable(today)
+    assert not calendar.is_bookable(today - datetime.timedelta(days=1))
+    assert not calendar.is_bookable(today + datetime.timedelta(days=BOOKING_DAYS))
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import pytest
+from sqlalchemy.exc import OperationalError
+import write_journal as write_journal_module
+from circuit_breaker import CircuitBreaker
+from write_journal import WriteJournal, KIND_DELIVER, KIND_RESERVE
+
+
+class FakeSession:
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StoreJournal(WriteJournal):
+    """دفتری که نوشتن‌ها را به جای دیتابیس در دیکشنری اعمال می‌کند (با همان قواعد idempotent)"""
+
+    def __init__(self, path):
+        super().__init__(path=str(path))
+        self._Session = FakeSession
+        self.reservations = {}
+        self.delivered = set()
+        self.calls = []
+        self.fail_at = None
+
+    def _check_available(self, entry):
+        self.calls.append(entry["id"])
+        if self.fail_at == len(self.calls):
+            raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    def _apply_reserve(self, session, entry):
+        self._check_available(entry)
+        if entry["feeding_code"] == "unknown":
+            return False, None
+        self.reservations[(entry["feeding_code"], entry["day"], entry["meal_type"])] = entry["dish_id"]
+        return True, None
+
+    def _apply_deliver(self, session, entry):
+        self._check_available(entry)
+        if entry["reservation_id"] in self.delivered:
+            return True, None
+        self.delivered.add(entry["reservation_id"])
+        return True, {"reservation_id": entry["reservation_id"]}
+
+
+@pytest.fixture(autouse=True)
+def breaker(monkeypatch):
+    breaker = CircuitBreaker()
+    monkeypatch.setattr(write_journal_module, "db_breaker", breaker)
+    return breaker
+
+
+def _journal_lines(journal):
+    with open(journal.path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _fill(journal):
+    async def fill():
+        await journal.append(KIND_RESERVE, feeding_code="100", day="monday", meal_type="lunch", dish_id=1)
+        await journal.append(KIND_RESERVE, feeding_code="100", day="monday", meal_type="lunch", dish_id=2)
+        await journal.append(KIND_DELIVER, reservation_id=7)
+        await journal.append(KIND_DELIVER, reservation_id=7)
+    asyncio.run(fill())
+
+
+def test_append_is_persisted(tmp_path):
+    journal = StoreJournal(tmp_path / "journal.log")
+    _fill(journal)
+    assert journal.pending == 4
+    assert [entry["kind"] for entry in _journal_lines(journal)] == [KIND_RESERVE] * 2 + [KIND_DELIVER] * 2
+
+
+def test_replay_applies_each_write_once(tmp_path):
+    journal = StoreJournal(tmp_path / "journal.log")
+    _fill(journal)
+    delivered = []
+    journal._on_delivered = delivered.append
+
+    assert asyncio.run(journal.replay()) == 4
+    assert journal.reservations == {("100", "monday", "lunch"): 2}
+    assert journal.delivered == {7}
+    assert delivered == [{"reservation_id": 7}]
+    assert journal.pending == 0
+    assert _journal_lines(journal) == []
+
+    # اعمال دوباره هیچ نوشتنی را تکرار نمی‌کند
+    calls = list(journal.calls)
+    assert asyncio.run(journal.replay()) == 0
+    assert journal.calls == calls
+
+
+def test_replay_stops_when_database_goes_down(tmp_path):
+    journal = StoreJournal(tmp_path / "journal.log")
+    _fill(journal)
+    journal.fail_at = 3
+
+    assert asyncio.run(journal.replay()) == 2
+    assert journal.pending == 2
+    assert [entry["kind"] for entry in _journal_lines(journal)] == [KIND_DELIVER, KIND_DELIVER]
+
+    journal.fail_at = None
+    assert asyncio.run(journal.replay()) == 2
+    assert journal.reservations == {("100", "monday", "lunch"): 2}
+    assert journal.delivered == {7}
+    assert _journal_lines(journal) == []
+
+
+def test_rejected_write_is_dropped(tmp_path):
+    journal = StoreJournal(tmp_path / "journal.log")
+    asyncio.run(journal.append(KIND_RESERVE, feeding_code="unknown", day="monday", meal_type="lunch", dish_id=1))
+
+    assert asyncio.run(journal.replay()) == 1
+    assert journal.rejected_total == 1
+    assert journal.replayed_total == 0
+    assert _journal_lines(journal) == []
+
+
+def test_replay_skipped_while_breaker_open(tmp_path, breaker):
+    journal = StoreJournal(tmp_path / "journal.log")
+    _fill(journal)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+    assert asyncio.run(journal.replay()) == 0
+    assert journal.calls == []
+    assert journal.pending == 4
+
+
+def test_leader_replays_writes_appended_by_another_process(tmp_path):
+    path = tmp_path / "journal.log"
+    shard = StoreJournal(path)
+    _fill(shard)
+    leader = StoreJournal(path)
+    assert leader.pending == 0
+
+    assert asyncio.run(leader.replay()) == 4
+    assert leader.delivered == {7}
+
+    asyncio.run(shard.refresh())
+    assert shard.pending == 0
@@ -0,0 +1,107 @@
+import datetime
+import threading
+from jdatetime import date as JalaliDate
+from metrics import register_collector
+
+# ترتیب روزها مطابق datetime.weekday()
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# هفته شمسی از شنبه شروع می‌شود
+SATURDAY = WEEKDAYS.index("saturday")
+
+# تعداد روزهای قابل رزرو از امروز (هر روز هفته دقیقاً یک تاریخ دارد؛ ظرفیت‌ها بر اساس روز هفته هستند)
+BOOKING_DAYS = 7
+
+# بازه تاریخ‌هایی که برچسب شمسی آن‌ها از پیش محاسبه می‌شود (روز نسبت به امروز)
+CACHE_PAST_DAYS = 28
+CACHE_AHEAD_DAYS = 28
+
+
+def week_start(date):
+    """تاریخ شنبه آغاز هفته شمسی که date در آن است"""
+    return date - datetime.timedelta(days=(date.weekday() - SATURDAY) % 7)
+
+
+def upcoming_date(day, today=None):
+    """نزدیک‌ترین تاریخ (امروز یا بعد از آن) که روز هفته آن day است؛ رزرو هر روز برای این تاریخ ثبت می‌شود"""
+    today = today or datetime.date.today()
+    return today + datetime.timedelta(days=(WEEKDAYS.index(day) - today.weekday()) % 7)
+
+
+def weekday_name(date):
+    """نام انگلیسی روز هفته مطابق کلیدهای منو"""
+    return WEEKDAYS[date.weekday()]
+
+
+def _to_jalali(date):
+    return JalaliDate.fromgregorian(date=date).strftime("%Y/%m/%d")
+
+
+class JalaliCalendar:
+    """کش تبدیل تاریخ میلادی به برچسب شمسی برای پنجره فعال
+
+    تبدیل jdatetime نسبتاً کند است و در هر نمایش منو و رزروها برای چند تاریخ تکرار می‌شود؛
+    برچسب تاریخ‌های چند هفته قبل و بعد از امروز یک بار در روز محاسبه و از دیکشنری خوانده می‌شود.
+    """
+
+    def __init__(self, past_days=CACHE_PAST_DAYS, ahead_days=CACHE_AHEAD_DAYS):
+        self.past_days = past_days
+        self.ahead_days = ahead_days
+        self._today = None
+        self._labels = {}
+        self._booking_dates = []
+        self._lock = threading.Lock()
+
+        # متریک‌ها
+        self.hits = 0
+        self.misses = 0
+
+    def _refresh(self, today):
+        with self._lock:
+            if self._today == today:
+                return
+            self._labels = {
+                today + datetime.timedelta(days=offset): _to_jalali(today + datetime.timedelta(days=offset))
+                for offset in range(-self.past_days, self.ahead_days + 1)
+            }
+            self._booking_dates = [today + datetime.timedelta(days=offset) for offset in range(BOOKING_DAYS)]
+            self._today = today
+
+    def label(self, date):
+        today = datetime.date.today()
+        if self._today != today:
+            self._refresh(today)
+        label = self._labels.get(date)
+        if label is None:
+            # تاریخ خارج از پنجره (مثلاً رزروهای بایگانی شده)
+            self.misses += 1
+            return _to_jalali(date)
+        self.hits += 1
+        return label
+
+    def booking_dates(self):
+        """تاریخ‌های قابل رزرو از امروز به ترتیب"""
+        today = datetime.date.today()
+        if self._today != today:
+            self._refresh(today)
+        return self._booking_dates
+
+    def is_bookable(self, date):
+        dates = self.booking_dates()
+        return dates[0] <= date <= dates[-1]
+
+    def metrics(self):
+        return {
+            "cached_dates": len(self._labels),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+        }
+
+
+jalali_calendar = JalaliCalendar()
+register_collector("jalali_calendar", jalali_calendar.metrics)
+
+
+def jalali_label(date):
+    """نمایش تاریخ به صورت شمسی (مثلاً 1405/08/03)"""
+    return jalali_calendar.label(date)
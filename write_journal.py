@@ -0,0 +1,270 @@
+import asyncio
+import contextlib
+import datetime
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from sqlalchemy.orm import sessionmaker
+from models import Student, Reservation
+from capacity import capacity_manager
+from kitchen import kitchen_counters
+from dishes import dish_catalog
+from circuit_breaker import db_breaker, is_db_unavailable
+from metrics import register_collector
+from week_calendar import upcoming_date
+
+logger = logging.getLogger(__name__)
+
+# فایل دفتر نوشتن‌هایی که در زمان قطع دیتابیس دریافت شده‌اند (هر خط یک JSON)
+JOURNAL_PATH = os.environ.get("WRITE_JOURNAL_PATH", "write_journal.log")
+
+# فاصله بررسی دفتر برای اعمال نوشتن‌های باقی‌مانده (ثانیه)
+REPLAY_INTERVAL = 5
+
+KIND_RESERVE = "reserve"
+KIND_DELIVER = "deliver"
+
+
+class WriteJournal:
+    """دفتر محلی فقط‌افزودنی برای رزروها و تایید تحویل‌ها هنگام قطع دیتابیس
+
+    هر نوشتن پیش از پاسخ به کاربر با fsync روی دیسک ذخیره می‌شود. پس از برقراری
+    دوباره دیتابیس، نوشتن‌ها به ترتیب و به صورت idempotent اعمال و از دفتر حذف می‌شوند
+    (رزرو تکراری فقط غذا را به‌روز می‌کند و تحویل تکراری اثری ندارد).
+    """
+
+    def __init__(self, path=JOURNAL_PATH, interval=REPLAY_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._Session = None
+        self._on_delivered = None
+        self._task = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._oldest = None
+
+        # متریک‌ها
+        self.appended_total = 0
+        self.replayed_total = 0
+        self.rejected_total = 0
+
+    # --- فایل دفتر ---
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # قفل جداگانه تا پردازش‌های دیگر (worker یا shard) هم‌زمان در دفتر ننویسند یا آن را اعمال نکنند
+        with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # خط نیمه‌کاره (قطع برق در میانه نوشتن)
+                    logger.warning(f"خط نامعتبر در دفتر نوشتن نادیده گرفته شد: {line[:100]}")
+        return entries
+
+    def _refresh_stats(self, entries):
+        self._pending = len(entries)
+        self._oldest = entries[0]["at"] if entries else None
+
+    def _append(self, entry):
+        with self._locked():
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = entry["at"]
+        self.appended_total += 1
+
+    def _rewrite(self, entries):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    async def append(self, kind, **data):
+        """ذخیره یک نوشتن در دفتر (پس از بازگشت، روی دیسک ماندگار است)"""
+        entry = {"id": uuid.uuid4().hex, "kind": kind, "at": time.time(), **data}
+        await asyncio.to_thread(self._append, entry)
+        logger.warning(f"دیتابیس در دسترس نیست؛ {kind} در دفتر محلی ذخیره شد")
+
+    # --- اعمال نوشتن‌ها ---
+
+    def _apply_reserve(self, session, entry):
+        student_id = session.query(Student.id).filter_by(feeding_code=entry["feeding_code"]).scalar()
+        if student_id is None:
+            return False, None
+        if entry.get("reservation_date"):
+            reservation_date = datetime.date.fromisoformat(entry["reservation_date"])
+        else:
+            reservation_date = upcoming_date(entry["day"])
+        # نوشتن‌های قدیمی دفتر نام غذا را دارند
+        dish_id = entry["dish_id"] if "dish_id" in entry else dish_catalog.id_for(entry["food"])
+        existing_reservation = session.query(Reservation).filter(
+            Reservation.student_id == student_id,
+            Reservation.on_date(reservation_date),
+            Reservation.meal_type == entry["meal_type"]
+        ).first()
+        if existing_reservation:
+            existing_reservation.dish_id = dish_id
+        elif not capacity_manager.try_reserve(session, entry["day"], entry["meal_type"]):
+            # ظرفیت در زمان قطع دیتابیس تکمیل شده است
+            session.rollback()
+            return False, None
+        else:
+            session.add(Reservation(
+                student_id=student_id, day=entry["day"], reservation_date=reservation_date,
+                meal_type=entry["meal_type"], dish_id=dish_id
+            ))
+            kitchen_counters.add(session, reservation_date, entry["meal_type"], reserved=1)
+        session.commit()
+        return True, None
+
+    def _apply_deliver(self, session, entry):
+        reservation = session.query(Reservation).filter_by(id=entry["reservation_id"]).first()
+        if reservation is None:
+            return False, None
+        if reservation.is_delivered:
+            return True, None
+        info = {
+            "student_id": reservation.student_id,
+            "day": reservation.day,
+            "meal_type": reservation.meal_type,
+            "food": dish_catalog.name(reservation.dish_id),
+        }
+        reservation.is_delivered = True
+        reservation.delivery_time = datetime.datetime.fromtimestamp(entry["at"])
+        kitchen_counters.add(session, reservation.reservation_date, reservation.meal_type, delivered=1)
+        session.commit()
+        return True, info
+
+    def _replay(self):
+        """اعمال نوشتن‌های دفتر به ترتیب؛ با قطع دوباره دیتابیس بقیه برای نوبت بعد می‌مانند"""
+        delivered = []
+        with self._locked():
+            entries = self._read_entries()
+            applied = 0
+            for entry in entries:
+                session = self._Session()
+                try:
+                    if entry["kind"] == KIND_RESERVE:
+                        ok, info = self._apply_reserve(session, entry)
+                    else:
+                        ok, info = self._apply_deliver(session, entry)
+                except Exception as e:
+                    session.rollback()
+                    if is_db_unavailable(e):
+                        break
+                    logger.error(f"خطا در اعمال نوشتن {entry.get('id')} از دفتر: {e}")
+                    ok, info = False, None
+                finally:
+                    session.close()
+
+                applied += 1
+                if ok:
+                    self.replayed_total += 1
+                    if info:
+                        delivered.append(info)
+                else:
+                    self.rejected_total += 1
+                    logger.warning(f"نوشتن {entry.get('id')} از دفتر قابل اعمال نبود و کنار گذاشته شد: {entry}")
+
+            if applied:
+                self._rewrite(entries[applied:])
+            self._refresh_stats(entries[applied:])
+        return applied, delivered
+
+    def _has_entries(self):
+        # پردازش‌های shard فقط در دفتر می‌نویسند و رهبر آن را اعمال می‌کند؛ پس شمارنده حافظه کافی نیست
+        try:
+            return os.path.getsize(self.path) > 0
+        except OSError:
+            return False
+
+    async def replay(self):
+        if not self._has_entries() or not db_breaker.allow():
+            return 0
+        applied, delivered = await asyncio.to_thread(self._replay)
+        if applied:
+            logger.info(f"{applied} نوشتن از دفتر محلی اعمال شد؛ {self._pending} نوشتن باقی مانده است")
+        if self._on_delivered:
+            for info in delivered:
+                self._on_delivered(info)
+        return applied
+
+    async def _run(self):
+        while True:
+            try:
+                await self.replay()
+            except Exception as e:
+                logger.error(f"خطا در اعمال دفتر نوشتن: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self, engine, on_delivered=None):
+        """شروع اعمال دوره‌ای دفتر (فقط در پردازش رهبر)؛ on_delivered برای هر تحویل اعمال شده فراخوانی می‌شود"""
+        self._Session = sessionmaker(bind=engine)
+        self._on_delivered = on_delivered
+        await self.refresh()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # --- وضعیت ---
+
+    async def refresh(self):
+        """خواندن دوباره وضعیت دفتر از فایل (نوشتن‌ها و اعمال‌های پردازش‌های دیگر)"""
+        self._refresh_stats(await asyncio.to_thread(self._read_entries))
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def lag_seconds(self):
+        """قدمت قدیمی‌ترین نوشتن اعمال نشده"""
+        return time.time() - self._oldest if self._oldest else 0.0
+
+    def metrics(self):
+        return {
+            "pending": self._pending,
+            "lag_seconds": self.lag_seconds,
+            "appended_total": self.appended_total,
+            "replayed_total": self.replayed_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+write_journal = WriteJournal()
+register_collector("write_journal", write_journal.metrics)